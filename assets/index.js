@@ -0,0 +1,35 @@
+function tab(id) {
+    document.querySelectorAll('.content').forEach(c => c.classList.remove('active'));
+    document.querySelectorAll('.tab').forEach(t => t.classList.remove('active'));
+    document.getElementById(id).classList.add('active');
+    event.currentTarget.classList.add('active');
+}
+function runSimulation() {
+    const trades = document.getElementById('sim-trades').value.split('\n').map(l => l.trim().split(/\s+/)).filter(p => p[0]).map(p => ({code: p[0], qty: p[1], price: p[2]}));
+    fetch('/api/simulate', {method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({trades: trades})})
+        .then(r => r.json()).then(data => {
+            const out = document.getElementById('sim-result');
+            if (data.error) { out.innerText = data.error; return; }
+            const s = data.scenarios[0], yen = v => '¥' + v.toLocaleString(), diff = v => (v >= 0 ? '+' : '') + v.toLocaleString();
+            const row = (label, value) => '<div class="breakdown-row"><span class="breakdown-label">' + label + '</span><span class="breakdown-val">' + value + '</span></div>';
+            out.innerHTML = row('総資産', yen(s.total_assets) + ' (' + diff(s.diff.total_assets) + ')')
+                + row('評価損益', yen(s.total_profit) + ' (' + diff(s.diff.total_profit) + ')')
+                + row('年配当予想', yen(s.total_div) + ' (' + diff(s.diff.total_div) + ')')
+                + row('取得/現利', s.buy_yield + '% / ' + s.cur_yield + '%')
+                + row('売却の実現損益', yen(s.realized_gain))
+                + Object.entries(s.market_allocation).map(([m, w]) => row(m + ' 比率', w + '%')).join('');
+        });
+}
+function sortMemos() {
+    const container = document.getElementById('memo-container');
+    const memos = Array.from(container.getElementsByClassName('memo-box'));
+    const sortBy = document.getElementById('memo-sort').value;
+    memos.sort((a, b) => {
+        let valA = a.getAttribute('data-' + sortBy);
+        let valB = b.getAttribute('data-' + sortBy);
+        if (sortBy === 'profit' || sortBy === 'market_value') { return parseFloat(valB) - parseFloat(valA); }
+        return valA.localeCompare(valB);
+    });
+    memos.forEach(m => container.appendChild(m));
+}
+new Tablesort(document.getElementById('stock-table'));
@@ -0,0 +1,63 @@
+// Tablesort 互換の最小実装（CDN 版 tablesort + tablesort.number の代わり）
+// 見出しクリックで昇順/降順を切り替え、data-sort 属性があればその値で並べる。
+// 列の値がすべて数値（カンマ・通貨記号・% を除いて）なら数値として比較する。
+function Tablesort(table, options) {
+    if (!(this instanceof Tablesort)) return new Tablesort(table, options);
+    if (!table || table.tagName !== 'TABLE') throw new Error('Element must be a table');
+    this.table = table;
+    this.options = options || {};
+    const head = table.tHead && table.tHead.rows[0];
+    if (!head) return;
+    Array.from(head.cells).forEach((cell, index) => {
+        if (cell.getAttribute('data-sort-method') === 'none') return;
+        cell.setAttribute('role', 'columnheader');
+        cell.addEventListener('click', () => this.sortTable(cell, index));
+    });
+}
+
+Tablesort.cellValue = function (cell) {
+    if (!cell) return '';
+    const value = cell.getAttribute('data-sort');
+    return value !== null ? value : cell.textContent.trim();
+};
+
+Tablesort.toNumber = function (value) {
+    const cleaned = value.replace(/[¥￥$€£,%\s]/g, '');
+    return cleaned !== '' && !isNaN(cleaned) ? parseFloat(cleaned) : null;
+};
+
+Tablesort.prototype.sortTable = function (header, index) {
+    const current = header.getAttribute('aria-sort');
+    const order = current === 'ascending' ? 'descending'
+        : current === 'descending' ? 'ascending'
+        : (this.options.descending ? 'descending' : 'ascending');
+    Array.from(header.parentNode.cells).forEach(c => c.removeAttribute('aria-sort'));
+    header.setAttribute('aria-sort', order);
+
+    Array.from(this.table.tBodies).forEach(body => {
+        const rows = Array.from(body.rows).map((row, position) => {
+            const text = Tablesort.cellValue(row.cells[index]);
+            return {row: row, position: position, text: text, number: Tablesort.toNumber(text)};
+        });
+        const numeric = rows.every(r => r.text === '' || r.number !== null);
+        const sign = order === 'ascending' ? 1 : -1;
+        rows.sort((a, b) => {
+            let diff;
+            if (numeric) {
+                diff = (a.number === null ? -Infinity : a.number) - (b.number === null ? -Infinity : b.number);
+            } else {
+                diff = a.text.localeCompare(b.text, 'ja');
+            }
+            return diff * sign || a.position - b.position;
+        });
+        rows.forEach(r => body.appendChild(r.row));
+    });
+};
+
+Tablesort.prototype.refresh = function () {
+    const header = this.table.tHead && this.table.tHead.querySelector('[aria-sort]');
+    if (!header) return;
+    const order = header.getAttribute('aria-sort');
+    header.setAttribute('aria-sort', order === 'ascending' ? 'descending' : 'ascending');
+    this.sortTable(header, header.cellIndex);
+};
@@ -0,0 +1,240 @@
+# ローカル開発・負荷試験用のスタンドイン（Google スプレッドシートの CSV エクスポートや Yahoo の情報取得を模倣）
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import random
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+class FakeSheetServer:
+    """パスごとに CSV 本文を返す簡易サーバ。ETag / If-None-Match に対応し、リクエスト数と転送量を数える。
+    conditional=False にすると ETag を付けず、毎回本文を返す（条件付き GET が効かないエクスポートの再現）"""
+
+    def __init__(self, sheets=None, host="127.0.0.1", port=0, latency=0.0, conditional=True):
+        self.sheets = dict(sheets or {})
+        self.latency = latency
+        self.conditional = conditional
+        self.stats = {"requests": 0, "not_modified": 0, "bytes_sent": 0}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                body = server.sheets.get(path)
+                if server.latency:
+                    time.sleep(server.latency)
+                with server._lock:
+                    server.stats["requests"] += 1
+                if body is None:
+                    self.send_error(404)
+                    return
+                if isinstance(body, str):
+                    body = body.encode("utf-8")
+                etag = '"' + hashlib.md5(body).hexdigest() + '"' if server.conditional else None
+                if etag and self.headers.get("If-None-Match") == etag:
+                    with server._lock:
+                        server.stats["not_modified"] += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                with server._lock:
+                    server.stats["bytes_sent"] += len(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/csv; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                if etag:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, path):
+        return self.base_url + path
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class FakeFundamentalsProvider:
+    """yf.Ticker(symbol).info の代わり。呼び出し回数を数え、latency 秒だけ待ってから固定値を返す"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+
+    def __call__(self, symbol):
+        self.calls.append(symbol)
+        if self.latency:
+            time.sleep(self.latency)
+        seed = sum(map(ord, symbol))
+        return {
+            "longName": f"{symbol} Holdings",
+            "sector": ["Technology", "Financial Services", "Consumer Cyclical"][seed % 3],
+            "industry": "Test",
+            "marketCap": (seed % 50 + 1) * 10**11,
+            "trailingPE": 5 + seed % 30,
+            "priceToBook": 0.5 + (seed % 20) / 10,
+        }
+
+class FakeTicker:
+    """yf.Ticker の代わり（info・dividends・history だけ）"""
+
+    def __init__(self, yahoo, symbol):
+        self.yahoo = yahoo
+        self.symbol = symbol
+
+    @property
+    def info(self):
+        self.yahoo.record("info", 1)
+        return FakeFundamentalsProvider()(self.symbol)
+
+    @property
+    def dividends(self):
+        self.yahoo.record("dividends", 1)
+        rng = random.Random(zlib.crc32(self.symbol.encode()))
+        dates = pd.date_range(end=pd.Timestamp.now(tz="UTC").normalize(), periods=4, freq="91D")
+        return pd.Series([round(rng.uniform(10, 60), 1)] * len(dates), index=dates)
+
+    def history(self, period="5d", **kwargs):
+        self.yahoo.record("history", 1)
+        return self.yahoo.frame(self.symbol, self.yahoo.business_days(period=period))
+
+class FakeYahoo:
+    """yf.download / yf.Ticker の代わり。シンボルごとに決まった乱数で日足を作るので、何度やっても同じ結果になる。
+    download は latency 秒だけ待つ（gevent でも止まる本物の curl_cffi と同じく、パッチされない sleep で待つ）。
+    log_path を渡すと呼び出しを 1 行ずつ追記するので、複数ワーカーの呼び出し回数も合計できる"""
+
+    def __init__(self, latency=0.0, log_path=None):
+        self.latency = latency
+        self.log_path = log_path
+        self.calls = {}
+        self._lock = threading.Lock()
+        try:
+            from gevent import monkey
+            self._sleep = monkey.get_original("time", "sleep")
+        except ImportError:
+            self._sleep = time.sleep
+
+    def install(self, yf_module):
+        yf_module.download = self.download
+        yf_module.Ticker = self.ticker
+        return self
+
+    def record(self, kind, symbols):
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            if self.log_path:
+                with open(self.log_path, "a") as f:
+                    f.write(f"{kind} {symbols}\n")
+
+    @staticmethod
+    def read_log(log_path):
+        """ログを {種類: 呼び出し回数, 種類_symbols: シンボル数} にまとめる"""
+        totals = {}
+        try:
+            with open(log_path) as f:
+                for line in f:
+                    kind, symbols = line.split()
+                    totals[kind] = totals.get(kind, 0) + 1
+                    totals[kind + "_symbols"] = totals.get(kind + "_symbols", 0) + int(symbols)
+        except FileNotFoundError:
+            pass
+        return totals
+
+    @staticmethod
+    def business_days(period="5d", start=None, interval="1d"):
+        today = pd.Timestamp.now().normalize()
+        if interval != "1d":
+            return pd.date_range(end=pd.Timestamp.now().floor("min"), periods=30, freq=interval.replace("m", "min"))
+        if start is not None:
+            return pd.bdate_range(start=start, end=today)
+        return pd.bdate_range(end=today, periods=int(period.rstrip("d")))
+
+    @staticmethod
+    def frame(symbol, index):
+        rng = np.random.default_rng(zlib.crc32(symbol.encode()))
+        if symbol.endswith("=X"):
+            base = 150.0
+        elif symbol.endswith((".T", ".F", ".N", ".S")):
+            base = float(rng.integers(500, 5000))
+        else:
+            base = float(rng.integers(20, 500))
+        close = base * np.cumprod(1 + rng.normal(0, 0.01, len(index)))
+        return pd.DataFrame({"Open": close, "High": close * 1.01, "Low": close * 0.99,
+                             "Close": close, "Volume": 1000}, index=index)
+
+    def download(self, tickers, period="5d", start=None, interval="1d", **kwargs):
+        tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+        self.record("download", len(tickers))
+        if self.latency:
+            self._sleep(self.latency)
+        index = self.business_days(period, start, interval)
+        return pd.concat({t: self.frame(t, index) for t in tickers}, axis=1)
+
+    def ticker(self, symbol):
+        return FakeTicker(self, symbol)
+
+JP_SAMPLE_CODES = ["7203", "8306", "9432", "6758", "8058", "9984", "4063", "8316", "2914", "7974", "507A", "1306"]
+US_SAMPLE_CODES = ["AAPL", "MSFT", "KO", "JNJ", "VYM", "PG", "T", "XOM"]
+
+def sample_holdings_csv(n=30, seed=0):
+    """保有銘柄シートの見本。同じ n・seed なら同じ CSV を返す"""
+    rng = random.Random(seed)
+    codes = JP_SAMPLE_CODES + US_SAMPLE_CODES
+    lines = ["証券コード,銘柄,取得時,株数,予想配当金,決算発表日,メモ,口座"]
+    for i in range(n):
+        code = codes[i % len(codes)] if i < len(codes) else f"{1300 + i}"
+        us = code in US_SAMPLE_CODES
+        price = rng.randint(20, 400) if us else rng.randint(500, 5000)
+        qty = rng.randint(1, 50) if us else rng.randint(1, 10) * 100
+        dividend = round(price * rng.uniform(0, 0.05), 1)
+        earnings = f"2026/{rng.randint(1, 12)}/{rng.randint(1, 28)}"
+        account = rng.choice(["特定", "NISA", "一般"])
+        lines.append(f"{code},銘柄{i},{price},{qty},{dividend},{earnings},メモ{i},{account}")
+    return "\n".join(lines) + "\n"
+
+def sample_realized_csv():
+    """実利シートの見本（2 行目の集計セルだけ）"""
+    return "項目,実利,配当金,予備,投信リターン\n合計,120000,45000,0,30000\n"
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="CSVファイルをスプレッドシートの代わりに配信する")
+    parser.add_argument("holdings_csv")
+    parser.add_argument("realized_csv", nargs="?")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    sheets = {"/holdings.csv": open(args.holdings_csv, "rb").read()}
+    if args.realized_csv:
+        sheets["/realized.csv"] = open(args.realized_csv, "rb").read()
+    server = FakeSheetServer(sheets, port=args.port)
+    print(f"SPREADSHEET_CSV_URL={server.url('/holdings.csv')}")
+    if args.realized_csv:
+        print(f"SPREADSHEET_REALIZED_URL={server.url('/realized.csv')}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,31 @@
+# gunicorn の設定（gunicorn はカレントディレクトリのこのファイルを自動で読む）
+#
+#   SERVER_MODE      thread（既定）: gthread ワーカー。1 ワーカーが複数スレッドで同時に応答する
+#                    gevent: gevent ワーカー。シート取得は協調 I/O、yfinance は OS スレッドに逃がす
+#                    sync: 従来どおり 1 ワーカー 1 リクエスト
+#   WEB_CONCURRENCY  ワーカー（プロセス）数。既定 2
+#   GUNICORN_THREADS thread モードのワーカーあたりスレッド数。既定 8
+#   GEVENT_CONNECTIONS gevent モードのワーカーあたり同時接続数。既定 100
+#
+# INTRADAY_MODE=1 の分足取得・HOLDINGS_BACKEND=sqlite のシート同期はワーカーごとに動く。
+# 分足はロックを取れた 1 ワーカーだけが Yahoo から取得し、他のワーカーは共有ファイルを読む
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))  # 初回のスナップショット作成は数十秒かかることがある
+
+mode = os.environ.get("SERVER_MODE", "thread")
+if mode == "gevent":
+    try:
+        import gevent  # noqa: F401
+        worker_class = "gevent"
+        worker_connections = int(os.environ.get("GEVENT_CONNECTIONS", "100"))
+    except ImportError:
+        print("gevent が入っていないため thread モードで起動します")
+        mode = "thread"
+if mode == "thread":
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+elif mode == "sync":
+    worker_class = "sync"
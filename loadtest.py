@@ -0,0 +1,209 @@
+# 負荷試験ツール
+#
+# スプレッドシートと Yahoo をローカルのスタンドイン（fake_upstreams.py）に差し替えてアプリを gunicorn で起動し、
+# 同時接続数ごとに決まった順序・本数のリクエストを流して、スループット・レイテンシ分位点・上流への呼び出し回数を出す。
+# 見本データもリクエストの順序も seed で決まるので、--json の出力はバージョン間で diff できる。
+#
+#   python loadtest.py --users 1,10,50 --requests 300 --json before.json
+#   python loadtest.py --mode gevent --workers 4 --yahoo-latency 1.5
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from fake_upstreams import FakeSheetServer, FakeYahoo, sample_holdings_csv, sample_realized_csv
+
+# パス → 重み（合計に対する割合で出現する）
+DEFAULT_MIX = {
+    "/": 60,
+    "/?update_earnings=1": 2,
+    "/earnings": 8,
+    "/performance": 5,
+    "/api/dividends": 5,
+    "/api/fundamentals": 5,
+    "/api/realized": 5,
+    "/api/alerts": 5,
+    "/api/quote_stats": 5,
+}
+
+def create_app():
+    """gunicorn から "loadtest:create_app()" で呼ばれる。ワーカー内で Yahoo をスタンドインに差し替える"""
+    import yfinance
+    FakeYahoo(latency=float(os.environ.get("FAKE_YAHOO_LATENCY", "0")),
+              log_path=os.environ.get("FAKE_YAHOO_LOG")).install(yfinance)
+    import stock_check
+    if os.environ.get("LOADTEST_CACHE_TIMEOUT"):
+        stock_check.CACHE_TIMEOUT = int(os.environ["LOADTEST_CACHE_TIMEOUT"])
+    return stock_check.app
+
+def parse_mix(text):
+    if not text:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for item in text.split(","):
+        path, _, weight = item.rpartition("=")
+        mix[path] = int(weight)
+    return mix
+
+def request_plan(mix, count, seed):
+    """重みどおりのパスを count 本、seed で決まる順序に並べる"""
+    rng = random.Random(seed)
+    paths = sorted(mix)
+    return rng.choices(paths, weights=[mix[p] for p in paths], k=count)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+def summarize(latencies, errors, elapsed=None):
+    values = sorted(latencies)
+    ms = lambda v: None if v is None else round(v * 1000, 1)
+    out = {
+        "requests": len(values) + errors,
+        "errors": errors,
+        "p50_ms": ms(percentile(values, 50)),
+        "p90_ms": ms(percentile(values, 90)),
+        "p99_ms": ms(percentile(values, 99)),
+        "max_ms": ms(values[-1] if values else None),
+    }
+    if elapsed is not None:
+        out["throughput_rps"] = round(len(values) / elapsed, 1) if elapsed else 0.0
+        out["elapsed_s"] = round(elapsed, 2)
+    return out
+
+def run_level(base_url, plan, users):
+    """users 本のスレッドで plan を分け合って流し、全体とパス別の集計を返す"""
+    results = {path: ([], [0]) for path in set(plan)}
+    lock = threading.Lock()
+    cursor = iter(plan)
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                path = next(cursor, None)
+            if path is None:
+                return
+            start = time.perf_counter()
+            try:
+                ok = session.get(base_url + path, timeout=120).status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    results[path][0].append(elapsed)
+                else:
+                    results[path][1][0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        for _ in range(users):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - started
+    latencies = [v for values, _ in results.values() for v in values]
+    errors = sum(e[0] for _, e in results.values())
+    return {
+        "total": summarize(latencies, errors, elapsed),
+        "routes": {path: summarize(values, e[0]) for path, (values, e) in sorted(results.items())},
+    }
+
+def wait_ready(base_url, process, timeout=120):
+    """初回のスナップショット作成まで待つ（この 1 本は計測に入れない）"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("アプリが起動直後に終了しました")
+        try:
+            if requests.get(base_url + "/", timeout=timeout).status_code == 200:
+                return
+        except requests.RequestException:
+            time.sleep(0.5)
+    raise RuntimeError("アプリが時間内に応答しませんでした")
+
+def upstream_counts(sheet_server, yahoo_log):
+    counts = {"sheets": dict(sheet_server.stats)}
+    counts["yahoo"] = FakeYahoo.read_log(yahoo_log)
+    return counts
+
+def diff_counts(after, before):
+    return {group: {k: v - before[group].get(k, 0) for k, v in sorted(values.items())}
+            for group, values in after.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description="スタンドインの上流を相手にアプリへ負荷をかける")
+    parser.add_argument("--mode", default="thread", choices=["thread", "gevent", "sync"], help="SERVER_MODE")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--users", default="1,10,50", help="同時接続数（カンマ区切りで複数段）")
+    parser.add_argument("--requests", type=int, default=300, help="1 段あたりのリクエスト数")
+    parser.add_argument("--mix", help='パス=重み のカンマ区切り（例: "/=80,/api/dividends=20"）')
+    parser.add_argument("--holdings", type=int, default=30, help="見本シートの銘柄数")
+    parser.add_argument("--sheet-latency", type=float, default=0.2)
+    parser.add_argument("--yahoo-latency", type=float, default=1.0)
+    parser.add_argument("--cache-timeout", type=int, help="スナップショットの有効秒数（既定はアプリの値）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--json", help="結果を JSON で保存する（キー順固定で diff しやすい）")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    sheets = FakeSheetServer({"/holdings.csv": sample_holdings_csv(args.holdings, args.seed),
+                              "/realized.csv": sample_realized_csv()},
+                             latency=args.sheet_latency).start()
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    yahoo_log = os.path.join(workdir, "yahoo.log")
+    env = dict(os.environ,
+               SPREADSHEET_CSV_URL=sheets.url("/holdings.csv"),
+               SPREADSHEET_REALIZED_URL=sheets.url("/realized.csv"),
+               STOCK_DATA_DIR=os.path.join(workdir, "data"),
+               FAKE_YAHOO_LATENCY=str(args.yahoo_latency),
+               FAKE_YAHOO_LOG=yahoo_log,
+               SERVER_MODE=args.mode,
+               WEB_CONCURRENCY=str(args.workers),
+               GUNICORN_THREADS=str(args.threads),
+               PORT=str(args.port))
+    if args.cache_timeout:
+        env["LOADTEST_CACHE_TIMEOUT"] = str(args.cache_timeout)
+    here = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "loadtest:create_app()"],
+                               cwd=here, env=env, stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, "gunicorn.log"), "w"))
+    base_url = f"http://127.0.0.1:{args.port}"
+    report = {
+        "config": {k: v for k, v in sorted(vars(args).items()) if k not in ("json", "port")},
+        "mix": dict(sorted(mix.items())),
+        "levels": {},
+    }
+    try:
+        wait_ready(base_url, process)
+        for users in [int(u) for u in args.users.split(",")]:
+            before = upstream_counts(sheets, yahoo_log)
+            level = run_level(base_url, request_plan(mix, args.requests, args.seed), users)
+            level["upstream"] = diff_counts(upstream_counts(sheets, yahoo_log), before)
+            report["levels"][str(users)] = level
+            total = level["total"]
+            print(f"users={users:>4}  {total['throughput_rps']:>7} req/s  p50 {total['p50_ms']} ms  "
+                  f"p90 {total['p90_ms']} ms  p99 {total['p99_ms']} ms  errors {total['errors']}  "
+                  f"sheet GET {level['upstream']['sheets']['requests']}  "
+                  f"yahoo download {level['upstream']['yahoo'].get('download', 0)}")
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        sheets.stop()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"結果を {args.json} に保存しました（ログ: {workdir}）")
+
+if __name__ == "__main__":
+    main()
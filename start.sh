@@ -1,2 +1,3 @@
 #!/bin/bash
-gunicorn stock_check:app --bind 0.0.0.0:$PORT
+# ワーカーの種類・数は gunicorn.conf.py（SERVER_MODE / WEB_CONCURRENCY / GUNICORN_THREADS）で指定する
+gunicorn -c gunicorn.conf.py stock_check:app
@@ -1,15 +1,52 @@
 # VERSION 9.5 - ROBUST TICKER IDENTIFIER FIX (Digital Grid & US Stock Support)
-from flask import Flask, render_template_string, url_for, request
+from flask import Flask, render_template, url_for, request, Response, abort, send_file
+from markupsafe import Markup
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import date, datetime, timedelta, timezone, time as dtime
+from requests.adapters import HTTPAdapter
+from zoneinfo import ZoneInfo
+import numpy as np
 import pandas as pd
+import requests
 import yfinance as yf
+import gzip
+import hashlib
+import hmac
+import io
 import re
+import json
 import os
+import sqlite3
+import sys
+import threading
 import time
+import unicodedata
 
-app = Flask(__name__, static_folder='.', static_url_path='')
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 公開するのは static/ だけ（リポジトリ直下を丸ごと配信しない）
+app = Flask(__name__, static_folder='static')
+
+# 前段のプロキシ（Render）の段数。X-Forwarded-For はクライアントが自由に書けるので、
+# プロキシが付け足した末尾の段だけを信用して remote_addr にする（プロキシなしで直接公開する時は 0）
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "1"))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 
 # --- キャッシュ設定 ---
-cache_storage = {
+# ポートフォリオごとのスナップショットの初期値
+EMPTY_SNAPSHOT = {
     "last_update": 0,
     "results": None,
     "total_profit": 0,
@@ -21,17 +58,73 @@ cache_storage = {
 }
 CACHE_TIMEOUT = 300
 
-SPREADSHEET_CSV_URL = (
+# ローカルに保存するキャッシュ・履歴の置き場所。send_file は相対パスを app.root_path から解決するので、
+# 起動時のカレントディレクトリで絶対パスにしておく
+DATA_DIR = os.path.abspath(os.environ.get("STOCK_DATA_DIR", "data"))
+
+# --- エラーの記録（取得元ごとの件数と直近の履歴） ---
+ERROR_HISTORY = 100
+# 画面の警告に出す取得元の名前
+ERROR_SOURCE_LABELS = {
+    "holdings_sheet": "保有銘柄シート",
+    "realized_sheet": "実利シート",
+    "quotes": "株価",
+    "fx": "為替",
+    "snapshot": "スナップショット",
+}
+
+class ErrorLog:
+    """取得元（source）ごとの失敗件数と直近のエラーを覚える（ログへの出力もここで行う）。
+    begin_collect〜end_collect の間に同じスレッドで起きた取得元は、スナップショットの警告に使う"""
+
+    def __init__(self, maxlen=ERROR_HISTORY):
+        self.recent = deque(maxlen=maxlen)
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def report(self, source, message, exc=None):
+        text = f"{message}: {exc}" if exc is not None else message
+        # 例外があればトレースバックごとログに残す（gunicorn のエラーログへ出る）
+        app.logger.warning(text, exc_info=exc)
+        event = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "source": source,
+            "message": text,
+            "type": type(exc).__name__ if exc is not None else None,
+        }
+        with self.lock:
+            self.counts[source] = self.counts.get(source, 0) + 1
+            self.recent.append(event)
+        collected = getattr(self.local, "sources", None)
+        if collected is not None:
+            collected.add(source)
+
+    def begin_collect(self):
+        self.local.sources = set()
+
+    def end_collect(self):
+        sources = getattr(self.local, "sources", None) or set()
+        self.local.sources = None
+        return sorted(sources)
+
+    def summary(self, limit=ERROR_HISTORY):
+        with self.lock:
+            return {"counts": dict(self.counts), "recent": list(self.recent)[-limit:][::-1]}
+
+error_log = ErrorLog()
+
+SPREADSHEET_CSV_URL = os.environ.get("SPREADSHEET_CSV_URL", (
     "https://docs.google.com/spreadsheets/d/"
     "1vwvK6QfG9LUL5CsR9jSbjNvE4CGjwtk03kjxNiEmR_M"
     "/export?format=csv&gid=1052470389"
-)
+))
 
-SPREADSHEET_REALIZED_URL = (
+SPREADSHEET_REALIZED_URL = os.environ.get("SPREADSHEET_REALIZED_URL", (
     "https://docs.google.com/spreadsheets/d/"
     "1vwvK6QfG9LUL5CsR9jSbjNvE4CGjwtk03kjxNiEmR_M"
     "/export?format=csv&gid=679093275"
-)
+))
 
 def to_float(val):
     try:
@@ -40,340 +133,2919 @@ def to_float(val):
     except:
         return 0.0
 
+def offload(fn, *args, **kwargs):
+    """ブロッキングする外部呼び出しを実行する。yfinance が使う curl_cffi には gevent のパッチが効かないので、
+    gevent ワーカーでは OS スレッドに逃がして他のリクエストを止めない。通常のスレッドワーカーではそのまま呼ぶ"""
+    monkey = sys.modules.get("gevent.monkey")
+    if monkey is not None and monkey.is_module_patched("socket"):
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
+
+# USDJPY が取れない時に円換算だけ続けるための仮レート（キャッシュはしない）
+USDJPY_FALLBACK = 160.25
+
 def get_stable_usdjpy(data=None):
-    """yfinanceのダウンロード済みdataからUSDJPY=Xを取得する。失敗時はフォールバック"""
+    """yfinanceのダウンロード済みdataからUSDJPY=Xを取得する。単独取得も失敗したら None"""
     try:
         if data is not None and "USDJPY=X" in data.columns.get_level_values(0) if hasattr(data.columns, "get_level_values") else "USDJPY=X" in data:
             df_fx = data["USDJPY=X"].dropna(subset=["Close"]) if hasattr(data.columns, "get_level_values") else data.dropna(subset=["Close"])
             if not df_fx.empty:
                 return float(df_fx["Close"].iloc[-1])
     except Exception as e:
-        print(f"為替データ解析エラー: {e}")
+        error_log.report("fx", "為替データ解析エラー", e)
     # フォールバック: yfinanceで単独取得
     try:
-        fx = yf.Ticker("USDJPY=X")
-        hist = fx.history(period="2d")
+        hist = offload(yf.Ticker("USDJPY=X").history, period="2d")
         if not hist.empty:
             return float(hist["Close"].iloc[-1])
     except Exception as e:
-        print(f"為替単独取得エラー: {e}")
-    return 160.25
+        error_log.report("fx", "為替単独取得エラー", e)
+    return None
+
+def get_fx_rates(data, currencies):
+    """保有銘柄の通貨ごとの円換算レート。USDは従来どおり get_stable_usdjpy で安定取得する"""
+    rates = {"JPY": 1.0}
+    for cur in currencies:
+        if cur in rates:
+            continue
+        if cur == "USD":
+            rates[cur] = get_stable_usdjpy(data) or 0.0
+            continue
+        pair = f"{cur}JPY=X"
+        rate = 0.0
+        try:
+            if data is not None and pair in data.columns.get_level_values(0):
+                df_fx = data[pair].dropna(subset=["Close"])
+                if not df_fx.empty:
+                    rate = float(df_fx["Close"].iloc[-1])
+        except Exception as e:
+            error_log.report("fx", f"為替データ解析エラー ({pair})", e)
+        rates[cur] = rate
+    return rates
+
+# --- 証券コード → ティッカー解決 ---
+# 取引所サフィックス: (市場, 通貨)
+MARKET_SUFFIXES = {
+    ".T": ("JP", "JPY"),
+    ".HK": ("HK", "HKD"),
+    ".SS": ("CN", "CNY"),
+    ".SZ": ("CN", "CNY"),
+    ".TW": ("TW", "TWD"),
+    ".AX": ("AU", "AUD"),
+    ".TO": ("CA", "CAD"),
+    ".DE": ("DE", "EUR"),
+    ".PA": ("FR", "EUR"),
+    ".L": ("GB", "GBp"),   # ロンドンはペンス建て
+    ".F": ("DE", "EUR"),
+    ".V": ("CA", "CAD"),
+}
+# 補助通貨建ての市場: 補助通貨 -> (本位通貨, 倍率)。為替は本位通貨で取得して換算する
+FX_SUBUNITS = {"GBp": ("GBP", 0.01)}
+
+# 自動判定では正しく扱えない銘柄の上書き（証券コード: {symbol, market, currency}）
+# ticker_overrides.json があればその内容で追加・上書きする
+TICKER_OVERRIDES = {}
+TICKER_OVERRIDES_FILE = os.environ.get("TICKER_OVERRIDES_FILE", "ticker_overrides.json")
 
-def get_extra_gains():
+# 「4桁の数字」または「3桁以上の数字＋アルファベット1文字（507Aなど）」は日本株
+JP_CODE_PATTERN = r'\d{4}|\d{3,4}[A-Z]'
+SUFFIX_PATTERN = r'(\.[A-Z]+)$'
+# 米国株のクラス株（BRK.B など）は Yahoo では BRK-B と書く
+US_SHARE_CLASS_PATTERN = r'^([A-Z]+)\.([A-Z])$'
+
+# 証券コード → 解決結果。シート更新をまたいで保持する（上書き設定が変わったら破棄）
+ticker_cache = {}
+ticker_cache_state = {"overrides_mtime": None}
+
+def load_ticker_overrides(path=TICKER_OVERRIDES_FILE):
+    overrides = dict(TICKER_OVERRIDES)
+    try:
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for code, spec in json.load(f).items():
+                    overrides[str(code).strip().upper()] = spec
+    except Exception as e:
+        error_log.report("config", "ティッカー上書き設定の読込エラー", e)
+    return overrides
+
+def make_link_url(code, symbol, market):
+    if market == "JP":
+        return f"https://kabutan.jp/stock/?code={symbol.removesuffix('.T')}"
+    return f"https://finance.yahoo.com/quote/{symbol}"
+
+def ticker_info(code, symbol, market, currency):
+    return {
+        "symbol": symbol,
+        "market": market,
+        "currency": currency,
+        "link_url": make_link_url(code, symbol, market),
+        "is_us": market == "US",
+    }
+
+def classify_codes(codes, overrides=None):
+    """証券コード列をまとめて判定し {code: ticker_info} を返す（正規表現は列単位で一度だけ適用）"""
+    overrides = TICKER_OVERRIDES if overrides is None else overrides
+    codes = pd.Series(pd.unique(pd.Series(codes, dtype=object)), dtype=object)
+    if codes.empty:
+        return {}
+    is_jp = codes.str.fullmatch(JP_CODE_PATTERN)
+    suffix = codes.str.extract(SUFFIX_PATTERN, expand=False)
+
+    resolved = {}
+    for code, jp, suf in zip(codes, is_jp, suffix):
+        spec = overrides.get(code)
+        if spec:
+            symbol = spec.get("symbol", code)
+            market = spec.get("market", "US")
+            currency = spec.get("currency", "USD")
+        elif jp:
+            symbol, market, currency = f"{code}.T", "JP", "JPY"
+        elif isinstance(suf, str) and suf in MARKET_SUFFIXES:
+            symbol = code
+            market, currency = MARKET_SUFFIXES[suf]
+        else:
+            symbol = re.sub(US_SHARE_CLASS_PATTERN, r'\1-\2', code)
+            market, currency = "US", "USD"
+        resolved[code] = ticker_info(code, symbol, market, currency)
+    return resolved
+
+def resolve_tickers(codes):
+    """キャッシュ済みの証券コードは再判定せず、新しいコードだけを classify_codes に回す"""
+    mtime = os.path.getmtime(TICKER_OVERRIDES_FILE) if os.path.exists(TICKER_OVERRIDES_FILE) else None
+    if mtime != ticker_cache_state["overrides_mtime"]:
+        ticker_cache.clear()
+        ticker_cache_state["overrides_mtime"] = mtime
+    unknown = [c for c in pd.unique(pd.Series(codes, dtype=object)) if c not in ticker_cache]
+    if unknown:
+        ticker_cache.update(classify_codes(unknown, load_ticker_overrides()))
+    return {c: ticker_cache[c] for c in codes}
+
+# --- 同一銘柄の複数ロット集約 ---
+def to_float_series(s):
+    """to_float の列版（数字・小数点・符号以外を除いて数値化、失敗は0）"""
+    cleaned = s.astype(str).str.replace(r"[^\d.-]", "", regex=True)
+    return pd.to_numeric(cleaned, errors="coerce").fillna(0.0)
+
+def text_column(df, name):
+    return df[name] if name in df.columns else pd.Series(pd.NA, index=df.index, dtype=object)
+
+def join_unique(values):
+    return "\n".join(dict.fromkeys(str(v) for v in values.dropna() if str(v).strip()))
+
+def aggregate_lots(valid_df):
+    """証券コードごとにロットをまとめ、(銘柄単位の表, ロット単位の表) を返す。並びはシートの初出順"""
+    lots = pd.DataFrame({
+        "code": valid_df["証券コード"].to_numpy(),
+        "buy_price": to_float_series(text_column(valid_df, "取得時")).to_numpy(),
+        "qty": to_float_series(text_column(valid_df, "株数")).astype(int).to_numpy(),
+        "annual_div": to_float_series(text_column(valid_df, "予想配当金")).to_numpy(),
+        "name": text_column(valid_df, "銘柄").to_numpy(),
+        "earnings": text_column(valid_df, "決算発表日").to_numpy(),
+        "memo": text_column(valid_df, "メモ").to_numpy(),
+        "account": text_column(valid_df, "口座").fillna("").astype(str).str.strip().replace("", "未設定").to_numpy(),
+    })
+    lots["cost"] = lots["buy_price"] * lots["qty"]
+
+    grouped = lots.groupby("code", sort=False)
+    holdings = grouped.agg(
+        qty=("qty", "sum"),
+        cost=("cost", "sum"),
+        mean_buy_price=("buy_price", "mean"),
+        annual_div=("annual_div", "first"),
+        lot_count=("qty", "size"),
+        name=("name", "first"),
+        earnings=("earnings", "first"),
+    )
+    holdings["memo"] = grouped["memo"].agg(join_unique)
+    # 加重平均取得単価（株数0のロットしかない場合は単純平均）
+    holdings["buy_price"] = (holdings["cost"] / holdings["qty"].where(holdings["qty"] != 0)).fillna(holdings["mean_buy_price"])
+    return holdings, lots
+
+def lot_breakdown(lots, price_jpy, rates):
+    """複数ロットを持つ銘柄について、ロットごとの円建て取得単価・損益を {code: [...]} で返す"""
+    multi = lots[lots.duplicated("code", keep=False)]
+    if multi.empty:
+        return {}
+    price = multi["code"].map(price_jpy).fillna(0.0)
+    rate = multi["code"].map(rates).fillna(0.0)
+    buy_jpy = multi["buy_price"] * rate
+    profit = ((price - buy_jpy) * multi["qty"]).where(price > 0, 0.0).astype(int)
+    profit_pct = ((price - buy_jpy) / buy_jpy.where(buy_jpy > 0) * 100).round(1).fillna(0)
+    breakdown = {}
+    for code, b, q, p, pct in zip(multi["code"], buy_jpy, multi["qty"], profit, profit_pct):
+        breakdown.setdefault(code, []).append({"buy_price": b, "qty": int(q), "profit": int(p), "profit_pct": float(pct)})
+    return breakdown
+
+def extract_quotes(data, symbols):
+    """一括ダウンロード結果から {シンボル: (終値, 前日比, 前日比%)} を取り出す"""
+    quotes = {}
+    for ticker_code in symbols:
+        price, day_change, day_change_pct = 0.0, 0.0, 0.0
+        try:
+            ticker_df = data[ticker_code].dropna(subset=['Close']) if ticker_code in data else pd.DataFrame()
+            
+            if not ticker_df.empty:
+                price = float(ticker_df['Close'].iloc[-1])
+                if len(ticker_df) >= 2:
+                    prev = float(ticker_df['Close'].iloc[-2])
+                    day_change = price - prev
+                    day_change_pct = (day_change / prev) * 100
+        except Exception as e:
+            error_log.report("quotes", f"データ解析エラー ({ticker_code})", e)
+        quotes[ticker_code] = (price, day_change, day_change_pct)
+    return quotes
+
+# --- スプレッドシート取得（条件付き GET + 本文ハッシュ比較） ---
+SHEET_FETCH_TIMEOUT = 15
+
+# 接続をプールして毎回の TLS ハンドシェイクを省く
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+http_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+class SheetFetcher:
+    """CSVエクスポートを ETag / Last-Modified 付きで取得し、本文が前回と同じなら解析結果を使い回す"""
+
+    def __init__(self, url, parse, session=None):
+        self.url = url
+        self.parse = parse
+        self.session = session or http_session
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self.parsed = None
+        self.body_size = 0
+        self.parse_seconds = 0.0
+        self.stats = {
+            "requests": 0,
+            "not_modified": 0,
+            "unchanged_body": 0,
+            "parsed": 0,
+            "bytes_transferred": 0,
+            "bytes_saved": 0,
+            "parse_seconds": 0.0,
+            "parse_seconds_saved": 0.0,
+        }
+
+    def fetch(self):
+        """(解析結果, 変更があったか) を返す"""
+        headers = {}
+        if self.parsed is not None:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+        resp = self.session.get(self.url, headers=headers, timeout=SHEET_FETCH_TIMEOUT)
+        self.stats["requests"] += 1
+
+        if resp.status_code == 304 and self.parsed is not None:
+            self.stats["not_modified"] += 1
+            self.stats["bytes_saved"] += self.body_size
+            self.stats["parse_seconds_saved"] += self.parse_seconds
+            return self.parsed, False
+        resp.raise_for_status()
+
+        body = resp.content
+        self.stats["bytes_transferred"] += len(body)
+        self.etag = resp.headers.get("ETag")
+        self.last_modified = resp.headers.get("Last-Modified")
+        digest = hashlib.sha256(body).hexdigest()
+        if digest == self.digest and self.parsed is not None:
+            self.stats["unchanged_body"] += 1
+            self.stats["parse_seconds_saved"] += self.parse_seconds
+            return self.parsed, False
+
+        started = time.perf_counter()
+        parsed = self.parse(body)
+        self.parse_seconds = time.perf_counter() - started
+        self.stats["parsed"] += 1
+        self.stats["parse_seconds"] += self.parse_seconds
+        self.digest = digest
+        self.body_size = len(body)
+        self.parsed = parsed
+        return parsed, True
+
+# 保有銘柄シートのうちアプリが使う列だけを読む
+HOLDING_COLUMNS = ["証券コード", "銘柄", "取得時", "株数", "予想配当金", "決算発表日", "メモ", "口座"]
+CSV_CHUNK_ROWS = 20000
+CSV_STREAM_THRESHOLD = 4 * 1024 * 1024  # これより大きいシートはチャンク単位で読む
+
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+def normalize_holdings(df):
+    """証券コードを正規化し、銘柄行だけに絞る"""
+    df['証券コード'] = df['証券コード'].fillna("").str.strip().str.upper()
+    return df[df['証券コード'].str.match(r'^[A-Z0-9.-]+$', na=False)]
+
+def read_holdings_frame(body):
+    """必要な列だけを文字列型で読み込む。見出しの空白除去は見出し行だけに対して行う"""
+    header = pd.read_csv(io.BytesIO(body.split(b"\n", 1)[0]), nrows=0).columns
+    rename = {raw: raw.strip() for raw in header if raw.strip() in HOLDING_COLUMNS}
+    if "証券コード" not in rename.values():
+        raise KeyError("証券コード")
+    usecols = list(rename)
+    dtype = {raw: str for raw in usecols}
+
+    if len(body) > CSV_STREAM_THRESHOLD:
+        chunks = pd.read_csv(io.BytesIO(body), usecols=usecols, dtype=dtype, chunksize=CSV_CHUNK_ROWS)
+        valid_df = pd.concat((normalize_holdings(chunk.rename(columns=rename)) for chunk in chunks), ignore_index=True)
+    else:
+        df = pd.read_csv(io.BytesIO(body), usecols=usecols, dtype=dtype, engine=CSV_ENGINE)
+        valid_df = normalize_holdings(df.rename(columns=rename)).reset_index(drop=True)
+    return valid_df
+
+def holdings_from_frame(valid_df):
+    """銘柄行の表からロットを集約し、ティッカーも解決しておく"""
+    holdings, lots = aggregate_lots(valid_df)
+    
+    # 🟢 証券コードの判定はリゾルバでキャッシュ（デジタルグリッド 507A などの日本株新コード・海外市場にも対応）
+    tickers = resolve_tickers(list(holdings.index))
+    return holdings, lots, tickers
+
+def parse_holdings_csv(body):
+    """保有銘柄シートを読み込み、銘柄行だけに絞ってロットを集約し、ティッカーも解決しておく"""
+    return holdings_from_frame(read_holdings_frame(body))
+
+def parse_realized_csv(body):
+    """実利シートの集計セル（実利・配当金・投信リターン）と、あれば台帳部分を読む"""
+    df = pd.read_csv(io.BytesIO(body), header=None, dtype=str)
     try:
-        df = pd.read_csv(SPREADSHEET_REALIZED_URL, header=None)
         realized_gain = to_float(df.iloc[1, 1])
         dividend      = to_float(df.iloc[1, 2])
         trust_return  = to_float(df.iloc[1, 4])
-        return realized_gain, dividend, trust_return
+    except IndexError:
+        realized_gain, dividend, trust_return = 0.0, 0.0, 0.0
+    return {"summary": (realized_gain, dividend, trust_return), "ledger": find_ledger(df)}
+
+def get_extra_gains(portfolio):
+    """台帳があれば台帳の集計、なければシートの集計セルの値を返す。取得に失敗した時は最後に取れた値"""
+    if not portfolio.realized_fetcher.url:
+        return portfolio.last_extra_gains  # 実利シートを登録していないユーザー
+    try:
+        parsed, changed = portfolio.realized_fetcher.fetch()
+        if parsed["ledger"] is None:
+            gains = parsed["summary"]
+        else:
+            if changed:
+                portfolio.ledger_store.sync(parsed["ledger"])
+            gains = portfolio.ledger_store.totals()
+        portfolio.last_extra_gains = gains
+        return gains
     except Exception as e:
-        print(f"実利シート取得エラー: {e}")
-        return 0.0, 0.0, 0.0
+        error_log.report("realized_sheet", "実利シート取得エラー", e)
+        return portfolio.last_extra_gains
 
-@app.route("/")
-def index():
-    global cache_storage
-    current_time = time.time()
-    
-    force_update = request.args.get('update_earnings') == '1'
+# --- 実利シートの取引・配当台帳 ---
+LEDGER_DB_FILE = os.path.join(DATA_DIR, "ledger.db")
+# 台帳の見出しの候補（シートの列名の揺れを吸収する）
+LEDGER_COLUMN_ALIASES = {
+    "date": ["日付", "約定日", "受渡日", "受取日"],
+    "code": ["証券コード", "コード"],
+    "name": ["銘柄", "銘柄名"],
+    "kind": ["種別", "区分", "取引"],
+    "amount": ["金額", "損益", "実現損益", "受取額"],
+}
+LEDGER_KINDS = ("realized", "dividend", "trust")
+
+def ledger_kind(text):
+    text = "" if pd.isna(text) else str(text)
+    if "投信" in text or "投資信託" in text:
+        return "trust"
+    if "配当" in text or "分配" in text:
+        return "dividend"
+    return "realized"
+
+def find_ledger(df):
+    """見出し行（日付と金額の列を含む行）を探し、その下を台帳として返す。なければ None"""
+    for i in range(len(df)):
+        cells = [str(v).strip() for v in df.iloc[i]]
+        columns = {}
+        for key, aliases in LEDGER_COLUMN_ALIASES.items():
+            for j, cell in enumerate(cells):
+                if cell in aliases and key not in columns:
+                    columns[key] = j
+        if "date" in columns and "amount" in columns:
+            body = df.iloc[i + 1:]
+            dates = pd.to_datetime(body.iloc[:, columns["date"]].map(
+                lambda v: unicodedata.normalize("NFKC", str(v)).replace("年", "/").replace("月", "/").replace("日", "")),
+                errors="coerce")
+            ledger = pd.DataFrame({
+                "day": dates,
+                "code": body.iloc[:, columns["code"]].fillna("").astype(str).str.strip().str.upper() if "code" in columns else "",
+                "name": body.iloc[:, columns["name"]].fillna("").astype(str).str.strip() if "name" in columns else "",
+                "kind": body.iloc[:, columns["kind"]].map(ledger_kind) if "kind" in columns else "realized",
+                "amount": to_float_series(body.iloc[:, columns["amount"]]),
+            })
+            return ledger[ledger["day"].notna()].reset_index(drop=True)
+    return None
+
+class LedgerStore:
+    """台帳の行を SQLite に保持し、年×銘柄×種別の集計表を行の追加・削除のたびに差分で更新する"""
+
+    def __init__(self, path=LEDGER_DB_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self._initialized = False
+
+    def connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        if not self._initialized:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS ledger (
+                    row_key TEXT PRIMARY KEY, day TEXT, year INTEGER, code TEXT, name TEXT, kind TEXT, amount REAL);
+                CREATE INDEX IF NOT EXISTS ledger_year_code ON ledger(year, code);
+                CREATE TABLE IF NOT EXISTS ledger_totals (
+                    year INTEGER, code TEXT, kind TEXT, name TEXT, amount REAL, PRIMARY KEY (year, code, kind));
+            """)
+            self._initialized = True
+        return conn
+
+    @staticmethod
+    def row_keys(ledger):
+        """行内容＋同一内容の出現回数から行キーを作る（同じ内容の行が複数あっても区別できる）"""
+        content = ledger["day"].dt.strftime("%Y-%m-%d") + "|" + ledger["code"] + "|" + ledger["kind"] + "|" + ledger["amount"].astype(str)
+        occurrence = content.groupby(content).cumcount().astype(str)
+        return [hashlib.sha1(k.encode("utf-8")).hexdigest() for k in content + "#" + occurrence]
+
+    def sync(self, ledger):
+        """シートの台帳と DB を突き合わせ、増えた行・消えた行だけを反映する。(追加数, 削除数) を返す"""
+        ledger = ledger.assign(row_key=self.row_keys(ledger))
+        with self.lock, self.connect() as conn:
+            existing = {k for (k,) in conn.execute("SELECT row_key FROM ledger")}
+            incoming = set(ledger["row_key"])
+            gone = existing - incoming
+            new = ledger[~ledger["row_key"].isin(existing)]
+            for key in gone:
+                year, code, kind, amount = conn.execute(
+                    "SELECT year, code, kind, amount FROM ledger WHERE row_key = ?", (key,)).fetchone()
+                conn.execute("UPDATE ledger_totals SET amount = amount - ? WHERE year = ? AND code = ? AND kind = ?",
+                             (amount, year, code, kind))
+                conn.execute("DELETE FROM ledger WHERE row_key = ?", (key,))
+            for row in new.itertuples():
+                conn.execute("INSERT INTO ledger VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (row.row_key, row.day.date().isoformat(), row.day.year, row.code, row.name, row.kind, row.amount))
+                conn.execute("""INSERT INTO ledger_totals VALUES (?, ?, ?, ?, ?)
+                                ON CONFLICT(year, code, kind) DO UPDATE SET amount = amount + excluded.amount, name = excluded.name""",
+                             (row.day.year, row.code, row.kind, row.name, row.amount))
+            conn.execute("DELETE FROM ledger_totals WHERE abs(amount) < 1e-9")
+        return len(new), len(gone)
+
+    def totals(self):
+        """全期間の (実利, 配当金, 投信リターン)"""
+        with self.connect() as conn:
+            sums = dict(conn.execute("SELECT kind, SUM(amount) FROM ledger_totals GROUP BY kind").fetchall())
+        return tuple(float(sums.get(kind) or 0.0) for kind in LEDGER_KINDS)
+
+    def by_ticker(self, year, kind=None):
+        query = "SELECT code, name, kind, amount FROM ledger_totals WHERE year = ?"
+        params = [year]
+        if kind:
+            query += " AND kind = ?"
+            params.append(kind)
+        with self.connect() as conn:
+            rows = conn.execute(query + " ORDER BY amount DESC", params).fetchall()
+        return [{"code": c, "name": n, "kind": k, "amount": round(a, 2)} for c, n, k, a in rows]
+
+    def by_year(self):
+        with self.connect() as conn:
+            rows = conn.execute("SELECT year, kind, SUM(amount) FROM ledger_totals GROUP BY year, kind ORDER BY year").fetchall()
+        out = {}
+        for year, kind, amount in rows:
+            out.setdefault(year, dict.fromkeys(LEDGER_KINDS, 0.0))[kind] = round(amount, 2)
+        return out
+
+
+# --- 決算発表日インデックス ---
+JST = timezone(timedelta(hours=9))
+EARNINGS_SORT_SENTINEL = "9999-12-31"
+EARNINGS_PAST_GRACE_DAYS = 90  # 年なしの日付がこれより過去なら翌年とみなす
+
+# 「2025/5/14」「2025-05-14」「2025年5月14日」「5/14(水)」「5月14日」などシートで見かける書式
+EARNINGS_DATE_PATTERNS = [
+    re.compile(r'^(?P<y>\d{4})\s*[/\-.年]\s*(?P<m>\d{1,2})\s*[/\-.月]\s*(?P<d>\d{1,2})'),
+    re.compile(r'^(?P<m>\d{1,2})\s*[/月]\s*(?P<d>\d{1,2})'),
+]
 
-    if not force_update and cache_storage["results"] and (current_time - cache_storage["last_update"] < CACHE_TIMEOUT):
-        realized_gain, dividend, trust_return = get_extra_gains()
-        return render_template_string(HTML_TEMPLATE,
-                                     results=cache_storage["results"],
-                                     total_profit=cache_storage["total_profit"],
-                                     total_dividend_income=cache_storage["total_div"],
-                                     total_assets=cache_storage["total_assets"],
-                                     realized_gain=realized_gain,
-                                     dividend=dividend,
-                                     trust_return=trust_return,
-                                     usdjpy=cache_storage.get("usdjpy", 160.0))
+def today_jst():
+    return datetime.now(JST).date()
 
+def parse_earnings_date(val, today=None):
+    """決算発表日セルの文字列を date に変換する。解釈できない場合は None"""
+    if val is None:
+        return None
+    text = unicodedata.normalize("NFKC", str(val)).strip()
+    if not text or text in ("nan", "---", "99/99"):
+        return None
+    today = today or today_jst()
+    for pattern in EARNINGS_DATE_PATTERNS:
+        m = pattern.match(text)
+        if not m:
+            continue
+        month, day = int(m.group("m")), int(m.group("d"))
+        year = int(m.group("y")) if "y" in m.groupdict() and m.group("y") else None
+        try:
+            if year is not None:
+                return date(year, month, day)
+            parsed = date(today.year, month, day)
+            if parsed < today - timedelta(days=EARNINGS_PAST_GRACE_DAYS):
+                parsed = date(today.year + 1, month, day)
+            return parsed
+        except ValueError:
+            return None
+    return None
+
+class EarningsIndex:
+    """決算発表日順に並べた銘柄の索引。スナップショット更新時に一度だけ作り、範囲検索は二分探索で行う"""
+
+    def __init__(self, results):
+        entries = sorted((r for r in results if r.get("earnings_date")),
+                         key=lambda r: (r["earnings_date"], r["code"]))
+        self._entries = entries
+        self._dates = [r["earnings_date"] for r in entries]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def all(self):
+        return list(self._entries)
+
+    def between(self, start, end):
+        """start〜end（両端含む）に決算発表がある銘柄"""
+        lo = bisect_left(self._dates, start)
+        hi = bisect_right(self._dates, end)
+        return self._entries[lo:hi]
+
+    def upcoming(self, days, today=None):
+        today = today or today_jst()
+        return self.between(today, today + timedelta(days=days))
+
+    def month(self, year, month):
+        first = date(year, month, 1)
+        last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+        return self.between(first, last)
+
+EARNINGS_RANGES = {
+    "7d": "今後7日",
+    "30d": "今後30日",
+    "month": "今月",
+    "all": "すべて",
+}
+
+def query_earnings(index, range_key, today=None):
+    today = today or today_jst()
+    if range_key == "7d":
+        return index.upcoming(7, today)
+    if range_key == "30d":
+        return index.upcoming(30, today)
+    if range_key == "month":
+        return index.month(today.year, today.month)
+    return index.all()
+
+def ics_escape(text):
+    return str(text).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+ICS_LINE_OCTETS = 75
+
+def ics_fold(line):
+    """RFC 5545 の行折り返し（75 オクテットごとに CRLF + 空白で続ける。UTF-8 の文字の途中では切らない）"""
+    parts = []
+    current, size, limit = "", 0, ICS_LINE_OCTETS
+    for ch in line:
+        n = len(ch.encode("utf-8"))
+        if size + n > limit:
+            parts.append(current)
+            # 続きの行は先頭の空白も 75 オクテットに含める
+            current, size, limit = " ", 1, ICS_LINE_OCTETS
+        current += ch
+        size += n
+    parts.append(current)
+    return "\r\n".join(parts)
+
+def build_earnings_ics(index):
+    """決算発表日インデックスから iCalendar (終日イベント) を生成する"""
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//stock-app//earnings//JA",
+        "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:決算発表日",
+    ]
+    seen = set()
+    for r in index.all():
+        d = r["earnings_date"]
+        if (r["code"], d) in seen:
+            continue
+        seen.add((r["code"], d))
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{r['code']}-{d.strftime('%Y%m%d')}@stock-app",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART;VALUE=DATE:{d.strftime('%Y%m%d')}",
+            f"DTEND;VALUE=DATE:{(d + timedelta(days=1)).strftime('%Y%m%d')}",
+            f"SUMMARY:{ics_escape('決算: ' + r['full_name'] + ' (' + r['code'] + ')')}",
+            f"URL:{r['link_url']}",
+            "END:VEVENT",
+        ]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(ics_fold(line) for line in lines) + "\r\n"
+
+# --- 価格アラート ---
+ALERT_RULES_FILE = os.environ.get("ALERT_RULES_FILE", "alert_rules.json")
+ALERT_OUTBOX_FILE = os.path.join(DATA_DIR, "alerts_outbox.jsonl")
+ALERT_WEBHOOK_URL = os.environ.get("ALERT_WEBHOOK_URL")
+
+# ルール種別: (条件, 通知文)。価格は現地通貨建て、利回り・騰落は%
+ALERT_CONDITIONS = {
+    "price_above": (lambda r, v, today: r["local_price"] > 0 and r["local_price"] >= v,
+                    "{full_name} ({code}) が {value} 以上になりました（現在 {local_price:,.2f}）"),
+    "price_below": (lambda r, v, today: r["local_price"] > 0 and r["local_price"] <= v,
+                    "{full_name} ({code}) が {value} 以下になりました（現在 {local_price:,.2f}）"),
+    "day_move": (lambda r, v, today: abs(r["day_change_pct"]) >= v,
+                 "{full_name} ({code}) の前日比が {day_change_pct:+.2f}% です"),
+    "yield_above": (lambda r, v, today: r["buy_yield"] >= v,
+                    "{full_name} ({code}) の取得利回りが {buy_yield}% になりました"),
+    "earnings_within": (lambda r, v, today: r["earnings_date"] is not None and 0 <= (r["earnings_date"] - today).days <= v,
+                        "{full_name} ({code}) の決算発表が近づいています（{display_earnings}）"),
+}
+
+class AlertEngine:
+    """証券コードごとに索引したアラートルールを、相場が変わった銘柄についてだけ評価する。
+    条件が偽→真に変わった時だけ通知し、同じルールの通知は1日1回までに抑える。
+    gunicorn の各ワーカーが同じルールを評価するので、1日1回の判定は outbox をロックして書く直前にも行う"""
+
+    def __init__(self, rules_file=ALERT_RULES_FILE, outbox_file=ALERT_OUTBOX_FILE, webhook_url=ALERT_WEBHOOK_URL):
+        self.rules_file = rules_file
+        self.outbox_file = outbox_file
+        self.webhook_url = webhook_url
+        self.rules_mtime = None
+        self.rules_by_code = {}
+        self.fingerprints = {}
+        self.active = {}
+        self.last_date = None
+        self.sent = self._load_sent_keys(today_jst())
+
+    def _load_sent_keys(self, today):
+        """outbox に書かれた今日の通知キー（昨日以前の分は重複判定に要らない）"""
+        suffix = f"@{today.isoformat()}"
+        sent = set()
+        try:
+            if os.path.exists(self.outbox_file):
+                with open(self.outbox_file, encoding="utf-8") as f:
+                    for line in f:
+                        key = json.loads(line)["key"]
+                        if key.endswith(suffix):
+                            sent.add(key)
+        except Exception as e:
+            error_log.report("alerts", "アラート送信履歴の読込エラー", e)
+        return sent
+
+    def set_rules(self, rules):
+        rules_by_code = {}
+        for rule in rules:
+            if not isinstance(rule, dict) or rule.get("type") not in ALERT_CONDITIONS:
+                error_log.report("config", f"不明なアラート種別: {rule}")
+                continue
+            try:
+                code = str(rule["code"]).strip().upper()
+                rule = dict(rule, code=code, value=float(rule["value"]))
+            except (KeyError, TypeError, ValueError) as e:
+                error_log.report("config", f"アラートルールの書式エラー: {rule}", e)
+                continue
+            rule.setdefault("id", f"{code}:{rule['type']}:{rule['value']}")
+            rules_by_code.setdefault(code, []).append(rule)
+        self.rules_by_code = rules_by_code
+        # ルールが変わったら全銘柄を評価し直す
+        self.fingerprints.clear()
+
+    def load_rules(self):
+        """ルールファイルが更新されていれば読み直す"""
+        mtime = os.path.getmtime(self.rules_file) if os.path.exists(self.rules_file) else None
+        if mtime == self.rules_mtime:
+            return
+        self.rules_mtime = mtime
+        rules = []
+        if mtime is not None:
+            try:
+                with open(self.rules_file, encoding="utf-8") as f:
+                    rules = json.load(f)
+            except Exception as e:
+                error_log.report("config", "アラートルールの読込エラー", e)
+        self.set_rules(rules)
+
+    def evaluate(self, results, today=None):
+        """スナップショットの銘柄行を受け取り、新しく発火した通知を返す"""
+        today = today or today_jst()
+        self.load_rules()
+        if today != self.last_date:
+            # 日付が変わると決算日までの日数が変わるので全件評価。前日までの通知キーは捨てる
+            self.fingerprints.clear()
+            self.last_date = today
+            self.sent = {key for key in self.sent if key.endswith(f"@{today.isoformat()}")}
+
+        fired = []
+        for r in results:
+            rules = self.rules_by_code.get(r["code"])
+            if not rules:
+                continue
+            fingerprint = (r["local_price"], r["day_change_pct"], r["buy_yield"], r["earnings_date"])
+            if self.fingerprints.get(r["code"]) == fingerprint:
+                continue
+            self.fingerprints[r["code"]] = fingerprint
+            for rule in rules:
+                condition, message = ALERT_CONDITIONS[rule["type"]]
+                hit = bool(condition(r, rule["value"], today))
+                was = self.active.get(rule["id"], False)
+                self.active[rule["id"]] = hit
+                key = f"{rule['id']}@{today.isoformat()}"
+                if hit and not was and key not in self.sent:
+                    self.sent.add(key)
+                    fired.append({
+                        "key": key,
+                        "rule_id": rule["id"],
+                        "code": r["code"],
+                        "type": rule["type"],
+                        "value": rule["value"],
+                        "message": message.format(value=rule["value"], **r),
+                        "at": datetime.now(JST).isoformat(timespec="seconds"),
+                    })
+        if fired:
+            fired = self.deliver(fired, today)
+        return fired
+
+    def deliver(self, notifications, today=None):
+        """ローカルの outbox に追記し、Webhook が設定されていれば裏で送る。
+        他のワーカーが先に書いた通知は外し、実際に書いたものを返す"""
+        today = today or today_jst()
+        try:
+            os.makedirs(os.path.dirname(self.outbox_file) or ".", exist_ok=True)
+            with open(self.outbox_file + ".lock", "w") as lock:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                written = self._load_sent_keys(today)
+                notifications = [n for n in notifications if n["key"] not in written]
+                with open(self.outbox_file, "a", encoding="utf-8") as f:
+                    for n in notifications:
+                        f.write(json.dumps(n, ensure_ascii=False) + "\n")
+        except Exception as e:
+            error_log.report("alerts", "アラート outbox 書込エラー", e)
+        if self.webhook_url and notifications:
+            threading.Thread(target=self._post_webhook, args=(notifications,), daemon=True).start()
+        return notifications
+
+    def _post_webhook(self, notifications):
+        try:
+            http_session.post(self.webhook_url, json={"alerts": notifications}, timeout=10)
+        except Exception as e:
+            error_log.report("alerts", "アラート Webhook 送信エラー", e)
+
+    def recent(self, limit=50):
+        if not os.path.exists(self.outbox_file):
+            return []
+        with open(self.outbox_file, encoding="utf-8") as f:
+            lines = deque(f, maxlen=max(limit, 0))
+        return [json.loads(line) for line in reversed(lines)]
+
+alert_engine = AlertEngine()
+
+# --- 市場の取引時間 ---
+NY_TZ = ZoneInfo("America/New_York")
+
+# 市場: (タイムゾーン, 取引セッション)。東証は昼休みあり
+MARKET_SESSIONS = {
+    "JP": (JST, [(dtime(9, 0), dtime(11, 30)), (dtime(12, 30), dtime(15, 30))]),
+    "US": (NY_TZ, [(dtime(9, 30), dtime(16, 0))]),
+}
+
+# 土日以外の休場日（東証は年末年始の休業日を含む）
+MARKET_HOLIDAYS = {
+    "JP": {date.fromisoformat(d) for d in [
+        "2026-01-01", "2026-01-02", "2026-01-12", "2026-02-11", "2026-02-23", "2026-03-20",
+        "2026-04-29", "2026-05-04", "2026-05-05", "2026-05-06", "2026-07-20", "2026-08-11",
+        "2026-09-21", "2026-09-22", "2026-09-23", "2026-10-12", "2026-11-03", "2026-11-23", "2026-12-31",
+        "2027-01-01", "2027-01-11", "2027-02-11", "2027-02-23", "2027-03-22", "2027-04-29",
+        "2027-05-03", "2027-05-04", "2027-05-05", "2027-07-19", "2027-08-11", "2027-09-20",
+        "2027-09-23", "2027-10-11", "2027-11-03", "2027-11-23", "2027-12-31",
+    ]},
+    "US": {date.fromisoformat(d) for d in [
+        "2026-01-01", "2026-01-19", "2026-02-16", "2026-04-03", "2026-05-25", "2026-06-19",
+        "2026-07-03", "2026-09-07", "2026-11-26", "2026-12-25",
+        "2027-01-01", "2027-01-18", "2027-02-15", "2027-03-26", "2027-05-31", "2027-06-18",
+        "2027-07-05", "2027-09-06", "2027-11-25", "2027-12-24",
+    ]},
+}
+
+def is_trading_day(market, day):
+    return day.weekday() < 5 and day not in MARKET_HOLIDAYS.get(market, ())
+
+def is_market_open(market, now=None):
+    """取引セッション中なら True（対応していない市場は常に False）"""
+    if market not in MARKET_SESSIONS:
+        return False
+    tz, sessions = MARKET_SESSIONS[market]
+    local = (now or datetime.now(timezone.utc)).astimezone(tz)
+    if not is_trading_day(market, local.date()):
+        return False
+    t = local.time()
+    return any(start <= t < end for start, end in sessions)
+
+def last_session_end(market, now):
+    """直近に終わったセッションの終了時刻（同じ取引日内のみ。なければ None）"""
+    tz, sessions = MARKET_SESSIONS[market]
+    local = now.astimezone(tz)
+    if not is_trading_day(market, local.date()):
+        return None
+    ends = [datetime.combine(local.date(), end, tz) for _, end in sessions]
+    past = [e for e in ends if e <= local]
+    return max(past) if past else None
+
+def next_session_start(market, now):
+    tz, sessions = MARKET_SESSIONS[market]
+    local = now.astimezone(tz)
+    for offset in range(15):
+        day = local.date() + timedelta(days=offset)
+        if not is_trading_day(market, day):
+            continue
+        for start, _ in sessions:
+            start_at = datetime.combine(day, start, tz)
+            if start_at > local:
+                return start_at
+    return None
+
+# --- 相場キャッシュの有効期限 ---
+QUOTE_TTL_OPEN = int(os.environ.get("QUOTE_TTL_OPEN", 60))
+QUOTE_TTL_FAILED = 60
+POST_CLOSE_GRACE = timedelta(minutes=30)  # 引け後しばらくは終値の確定を待って取り直す
+
+def quote_ttl(market, now=None):
+    """取引中は短く、閉まっている間は次の寄り付きまでキャッシュする秒数"""
+    now = now or datetime.now(timezone.utc)
+    if market not in MARKET_SESSIONS:
+        return CACHE_TIMEOUT
+    if is_market_open(market, now):
+        return QUOTE_TTL_OPEN
+    ended = last_session_end(market, now)
+    if ended is not None and now - ended < POST_CLOSE_GRACE:
+        return QUOTE_TTL_OPEN
+    next_start = next_session_start(market, now)
+    if next_start is None:
+        return CACHE_TIMEOUT
+    return max(QUOTE_TTL_OPEN, int((next_start - now).total_seconds()))
+
+class QuoteCache:
+    """シンボルごとの終値・為替レートのキャッシュ。期限切れのシンボルだけをまとめてダウンロードする"""
+
+    def __init__(self):
+        self.entries = {}  # シンボル -> (値, 期限の UNIX 時刻)
+        self.lock = threading.Lock()
+        self.stats = {"downloads": 0, "symbols_fetched": 0, "symbols_cached": 0}
+
+    def _fresh(self, symbol, now_ts):
+        entry = self.entries.get(symbol)
+        return entry is not None and entry[1] > now_ts
+
+    def get(self, symbol_markets, currencies, force=False, now=None):
+        """({シンボル: (終値, 前日比, 前日比%)}, {通貨: 円レート}) を返す"""
+        now = now or datetime.now(timezone.utc)
+        now_ts = now.timestamp()
+        subunits = {cur: FX_SUBUNITS[cur] for cur in currencies if cur in FX_SUBUNITS}
+        currencies = {FX_SUBUNITS[cur][0] if cur in FX_SUBUNITS else cur for cur in currencies}
+        fx_markets = {f"{cur}JPY=X": None for cur in currencies if cur != "JPY"}
+        wanted = dict(symbol_markets, **fx_markets)
+        # 為替は円換算にしか使わないので、保有銘柄のどれかの市場が動いている間だけ取り直す
+        held_markets = set(symbol_markets.values())
+        fx_ttl = min((quote_ttl(m, now) for m in held_markets), default=CACHE_TIMEOUT)
+
+        with self.lock:
+            stale = [s for s in wanted if force or not self._fresh(s, now_ts)]
+            self.stats["symbols_cached"] += len(wanted) - len(stale)
+            if stale:
+                # 一括ダウンロード（為替も同時取得）
+                try:
+                    data = offload(yf.download, stale, period="5d", group_by='ticker', progress=False, actions=False)
+                except Exception as e:
+                    error_log.report("quotes", "株価一括取得エラー", e)
+                    raise
+                self.stats["downloads"] += 1
+                self.stats["symbols_fetched"] += len(stale)
+                # ついでに直近の日足を価格履歴に蓄積しておく
+                price_store.add_frame(data, stale)
+                stale_quotes = extract_quotes(data, [s for s in stale if s not in fx_markets])
+                stale_currencies = {pair[:3] for pair in stale if pair in fx_markets}
+                stale_rates = get_fx_rates(data, stale_currencies)
+                for symbol in stale:
+                    if symbol in fx_markets:
+                        value = stale_rates.get(symbol[:3], 0.0)
+                        ok = value > 0
+                    else:
+                        value = stale_quotes[symbol]
+                        ok = value[0] > 0
+                    if not ok:
+                        ttl = QUOTE_TTL_FAILED
+                    elif symbol in fx_markets:
+                        ttl = fx_ttl
+                    else:
+                        ttl = quote_ttl(wanted[symbol], now)
+                    self.entries[symbol] = (value, now_ts + ttl)
+
+            quotes = {s: self.entries[s][0] for s in symbol_markets}
+            fx_rates = {"JPY": 1.0}
+            fx_rates.update({pair[:3]: self.entries[pair][0] for pair in fx_markets})
+        for sub, (base, factor) in subunits.items():
+            fx_rates[sub] = fx_rates[base] * factor
+        if "USD" in fx_rates and fx_rates["USD"] <= 0:
+            # 取得失敗は QUOTE_TTL_FAILED で取り直す。それまでの間も毎回警告に出す
+            error_log.report("fx", f"USD/JPY が取得できないため仮レート {USDJPY_FALLBACK} で換算しています")
+            fx_rates["USD"] = USDJPY_FALLBACK
+        return quotes, fx_rates
+
+quote_cache = QuoteCache()
+
+# --- 日中モード（分足のリングバッファ） ---
+# gunicorn のワーカーごとに取得すると Yahoo への分足リクエストが WEB_CONCURRENCY 倍になるので、
+# ロックファイルを取れた 1 ワーカーだけが取得し、結果を共有ファイルに書き出して他のワーカーはそれを読む
+INTRADAY_MODE = os.environ.get("INTRADAY_MODE") == "1"
+INTRADAY_LOCK_FILE = os.path.join(DATA_DIR, "intraday.lock")
+INTRADAY_SHARED_FILE = os.path.join(DATA_DIR, "intraday.json")
+INTRADAY_INTERVAL = os.environ.get("INTRADAY_INTERVAL", "5m")
+INTERVAL_SECONDS = {"1m": 60, "5m": 300}
+INTRADAY_CAPACITY = 400  # 1分足でも米国市場1日分（390本）が収まる
+MARKET_CLOSED_POLL_SECONDS = 300
+SESSION_GAP_SECONDS = 4 * 3600  # これ以上間が空いたら新しい取引日とみなしてバッファを空にする
+
+class RingBuffer:
+    """固定長の (時刻, 値) リングバッファ。何日動かしてもメモリ使用量は容量で頭打ち"""
+
+    def __init__(self, capacity=INTRADAY_CAPACITY):
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+    def last_time(self):
+        if not self.size:
+            return None
+        return int(self.times[(self.start + self.size - 1) % self.capacity])
+
+    def extend(self, times, values):
+        """最後の時刻より新しい点だけを追加し、追加した件数を返す"""
+        times = np.asarray(times, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        last = self.last_time()
+        if last is not None:
+            newer = times > last
+            times, values = times[newer], values[newer]
+            if len(times) and times[0] - last > SESSION_GAP_SECONDS:
+                self.clear()
+        n = len(times)
+        if n == 0:
+            return 0
+        if n >= self.capacity:
+            self.times[:] = times[-self.capacity:]
+            self.values[:] = values[-self.capacity:]
+            self.start, self.size = 0, self.capacity
+            return n
+        idx = (self.start + self.size + np.arange(n)) % self.capacity
+        self.times[idx] = times
+        self.values[idx] = values
+        overflow = max(0, self.size + n - self.capacity)
+        self.start = (self.start + overflow) % self.capacity
+        self.size = min(self.capacity, self.size + n)
+        return n
+
+    def ordered(self):
+        idx = (self.start + np.arange(self.size)) % self.capacity
+        return self.times[idx], self.values[idx]
+
+def sparkline_points(values, width=60, height=16):
+    """SVG polyline 用の座標列"""
+    lo, hi = float(values.min()), float(values.max())
+    span = (hi - lo) or 1.0
+    xs = np.linspace(0, width, len(values))
+    ys = height - (values - lo) / span * height
+    return " ".join(f"{x:.1f},{y:.1f}" for x, y in zip(xs, ys))
+
+class IntradayStore:
+    """保有銘柄の分足終値をシンボルごとのリングバッファに保持する"""
+
+    def __init__(self, interval=INTRADAY_INTERVAL, capacity=INTRADAY_CAPACITY):
+        self.interval = interval
+        self.capacity = capacity
+        self.buffers = {}
+        self.lock = threading.Lock()
+        self.polls = 0
+        self.loaded_mtime = None
+
+    def update(self, data, symbols):
+        """yf.download の分足結果をバッファに追記する"""
+        multi = hasattr(data.columns, "get_level_values") and data.columns.nlevels > 1
+        with self.lock:
+            for symbol in symbols:
+                try:
+                    if multi:
+                        if symbol not in data.columns.get_level_values(0):
+                            continue
+                        close = data[symbol]["Close"].dropna()
+                    else:
+                        close = data["Close"].dropna()
+                    if close.empty:
+                        continue
+                    times = np.fromiter((ts.timestamp() for ts in close.index), dtype=np.float64, count=len(close)).astype(np.int64)
+                    buf = self.buffers.setdefault(symbol, RingBuffer(self.capacity))
+                    buf.extend(times, close.to_numpy(dtype=np.float64))
+                except Exception as e:
+                    error_log.report("intraday", f"分足データ解析エラー ({symbol})", e)
+
+    def poll(self, markets_by_symbol, now=None):
+        """取引中の市場の銘柄だけ分足を取得する。両市場とも閉まっていれば何もせず False"""
+        symbols = [s for s, market in markets_by_symbol.items() if is_market_open(market, now)]
+        if not symbols:
+            return False
+        data = offload(yf.download, symbols, period="1d", interval=self.interval, group_by='ticker', progress=False, actions=False)
+        self.polls += 1
+        if data is not None and not data.empty:
+            self.update(data, symbols)
+        return True
+
+    def dump(self, path):
+        """全バッファを時刻順の配列で書き出す（他のワーカーが load で読む）"""
+        with self.lock:
+            data = {symbol: [t.tolist(), v.tolist()] for symbol, (t, v) in
+                    ((symbol, buf.ordered()) for symbol, buf in self.buffers.items())}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def load(self, path):
+        """取得役のワーカーが書き出したバッファを読み込む。前回読んだ時から更新がなければ何もしない"""
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        if mtime is None or mtime == self.loaded_mtime:
+            return False
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        buffers = {}
+        for symbol, (times, values) in data.items():
+            buffers[symbol] = RingBuffer(self.capacity)
+            buffers[symbol].extend(times, values)
+        with self.lock:
+            self.buffers = buffers
+        self.loaded_mtime = mtime
+        return True
+
+    def sparklines(self, symbols):
+        out = {}
+        with self.lock:
+            for symbol in symbols:
+                buf = self.buffers.get(symbol)
+                if buf is not None and len(buf) >= 2:
+                    out[symbol] = sparkline_points(buf.ordered()[1])
+        return out
+
+intraday_store = IntradayStore()
+
+def acquire_intraday_lock(path=INTRADAY_LOCK_FILE):
+    """取得役のロックを取れたらファイルを返す（プロセスが終わるとロックは外れ、別のワーカーが引き継ぐ）。
+    fcntl がない環境では全ワーカーが自分で取得する"""
+    if fcntl is None:
+        return True
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    f = open(path, "w")
     try:
-        df = pd.read_csv(SPREADSHEET_CSV_URL)
-        df.columns = df.columns.str.strip()
-        df['証券コード'] = df['証券コード'].astype(str).str.strip().str.upper()
-        
-        valid_df = df[df['証券コード'].str.match(r'^[A-Z0-9.-]+$', na=False)].copy()
-        
-        # 🟢 判定ロジックの大改造（デジタルグリッド 507A などの日本株新コードにも完全対応）
-        tickers_map = {}
-        is_us_stock_map = {}
-        for c in valid_df['証券コード']:
-            # 「4桁の数字」または「3桁以上の数字＋アルファベット1文字（507Aなど）」は日本株
-            if c.isdigit() and len(c) == 4:
-                is_us = False
-            elif re.match(r'^\d{3,4}[A-Z]$', c):
-                is_us = False
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f
+    except OSError:
+        f.close()
+        return None
+
+def intraday_loop():
+    """保有銘柄の分足を取引時間中だけ定期取得する（市場が閉まっている間は取得しない）。
+    取得役でないワーカーは取得役が書き出したバッファを読むだけ"""
+    leader = None
+    while True:
+        polled = False
+        try:
+            leader = leader or acquire_intraday_lock()
+            if leader:
+                results = [r for p in portfolios.all() for r in p.snapshot["results"] or []]
+                polled = intraday_store.poll({r["symbol"]: r["market"] for r in results})
+                if polled:
+                    intraday_store.dump(INTRADAY_SHARED_FILE)
             else:
-                is_us = True
-                
-            tickers_map[c] = c if is_us else f"{c}.T"
-            is_us_stock_map[c] = is_us
-            
-        unique_tickers = list(set(tickers_map.values()))
-        
-        # USDJPY=Xを一括ダウンロードに含める
-        download_tickers = unique_tickers + ["USDJPY=X"]
-        
-        # 一括ダウンロード（為替も同時取得）
-        data = yf.download(download_tickers, period="5d", group_by='ticker', progress=False, actions=False)
-        
-        usdjpy = get_stable_usdjpy(data)
-        results = []
-        
-        for _, row in valid_df.iterrows():
-            c = row['証券コード']
-            ticker_code = tickers_map[c]
-            is_us_stock = is_us_stock_map[c]
-            
-            price, day_change, day_change_pct = 0.0, 0.0, 0.0
-            
+                # ファイルを見るだけなので取引時間外も取得役と同じ間隔で確認する
+                intraday_store.load(INTRADAY_SHARED_FILE)
+                polled = True
+        except Exception as e:
+            error_log.report("intraday", "分足取得エラー", e)
+        time.sleep(INTERVAL_SECONDS.get(INTRADAY_INTERVAL, 300) if polled else MARKET_CLOSED_POLL_SECONDS)
+
+def start_intraday_poller():
+    thread = threading.Thread(target=intraday_loop, name="intraday-poller", daemon=True)
+    thread.start()
+    return thread
+
+# --- 配当カレンダー ---
+DIVIDEND_HISTORY_FILE = os.path.join(DATA_DIR, "dividend_history.json")
+DIVIDEND_HISTORY_TTL = 7 * 86400
+# 権利落ち月から支払月までのおおよその月数
+PAYMENT_MONTH_OFFSET = {"JP": 3, "US": 1}
+# 履歴が取れない銘柄の支払月（日本株は中間・期末、米国株は四半期）
+DEFAULT_PAYMENT_MONTHS = {"JP": [6, 12], "US": [3, 6, 9, 12]}
+
+class DividendHistoryStore:
+    """シンボルごとの配当履歴（権利落ち日, 1株配当）をローカルの JSON にキャッシュする。取得は裏スレッドで行う"""
+
+    def __init__(self, path=DIVIDEND_HISTORY_FILE, ttl=DIVIDEND_HISTORY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, encoding="utf-8") as f:
+                    return json.load(f)
+        except Exception as e:
+            error_log.report("dividends", "配当履歴キャッシュの読込エラー", e)
+        return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+    def events(self, symbol):
+        """[(権利落ち日, 1株配当), ...]。未取得なら None"""
+        entry = self.entries.get(symbol)
+        if entry is None:
+            return None
+        return [(date.fromisoformat(d), amount) for d, amount in entry["events"]]
+
+    def version(self, symbol):
+        entry = self.entries.get(symbol)
+        return entry["fetched"] if entry else None
+
+    def stale_symbols(self, symbols, now=None):
+        now = now or time.time()
+        return [s for s in symbols if s not in self.entries or now - self.entries[s]["fetched"] > self.ttl]
+
+    def refresh(self, symbols):
+        for symbol in symbols:
             try:
-                if len(unique_tickers) == 1:
-                    ticker_df = data.dropna(subset=['Close'])
-                else:
-                    ticker_df = data[ticker_code].dropna(subset=['Close']) if ticker_code in data else pd.DataFrame()
-                
-                if not ticker_df.empty:
-                    price = float(ticker_df['Close'].iloc[-1])
-                    if len(ticker_df) >= 2:
-                        prev = float(ticker_df['Close'].iloc[-2])
-                        day_change = price - prev
-                        day_change_pct = (day_change / prev) * 100
+                series = offload(lambda: yf.Ticker(symbol).dividends)
+                cutoff = pd.Timestamp.now(tz=series.index.tz) - pd.Timedelta(days=730) if len(series) else None
+                events = [(ts.date().isoformat(), float(v)) for ts, v in series.items() if ts >= cutoff] if len(series) else []
             except Exception as e:
-                print(f"データ解析エラー ({ticker_code}): {e}")
+                error_log.report("dividends", f"配当履歴取得エラー ({symbol})", e)
+                continue
+            with self.lock:
+                self.entries[symbol] = {"fetched": time.time(), "events": events}
+        with self.lock:
+            try:
+                self._save()
+            except Exception as e:
+                error_log.report("dividends", "配当履歴キャッシュの保存エラー", e)
 
-            annual_div = to_float(row.get("予想配当金", 0))
-            buy_price = to_float(row.get("取得時"))
-            qty = int(to_float(row.get("株数")))
+    def refresh_async(self, symbols):
+        """期限切れの履歴だけを裏で取り直す（すでに実行中なら何もしない）"""
+        stale = self.stale_symbols(symbols)
+        if not stale or not self.refreshing.acquire(blocking=False):
+            return
 
-            rate = usdjpy if is_us_stock else 1.0
-            
-            price_jpy = price * rate
-            buy_price_jpy = buy_price * rate
-            annual_div_jpy = annual_div * rate
-            day_change_jpy = day_change * rate
+        def run():
+            try:
+                self.refresh(stale)
+            finally:
+                self.refreshing.release()
 
-            profit = int((price_jpy - buy_price_jpy) * qty) if price > 0 else 0
-            market_value = int(price_jpy * qty)
-            div_amt = int(annual_div_jpy * qty)
+        threading.Thread(target=run, name="dividend-history", daemon=True).start()
 
-            display_earnings = str(row.get("決算発表日", "---"))
-            if display_earnings == "nan" or display_earnings == "":
-                display_earnings = "---"
+def payment_month_weights(events, market, today):
+    """今月から12か月分の支払い比率（合計1）。直近の権利落ちを1年後にずらして支払月に割り振る"""
+    weights = np.zeros(12)
+    offset = PAYMENT_MONTH_OFFSET.get(market, 1)
+    # 支払月ごとに最新の配当額だけを使う（13か月分見るので同じ月が2回入ることがある）
+    latest = {}
+    for d, amount in sorted(events or []):
+        if 0 <= (today - d).days <= 400:
+            latest[(d.month - 1 + offset) % 12 + 1] = amount
+    if latest:
+        for pay_month, amount in latest.items():
+            weights[(pay_month - today.month) % 12] += amount
+    else:
+        for pay_month in DEFAULT_PAYMENT_MONTHS.get(market, DEFAULT_PAYMENT_MONTHS["US"]):
+            weights[(pay_month - today.month) % 12] += 1.0
+    total = weights.sum()
+    return weights / total if total > 0 else weights
 
-            earnings_sort = display_earnings if "/" in display_earnings else "99/99"
-            name = str(row.get("銘柄", ""))
-            
-            link_url = f"https://finance.yahoo.com/quote/{c}" if is_us_stock else f"https://kabutan.jp/stock/?code={c}"
-            
-            results.append({
-                "code": c, "name": name[:4], "full_name": name,
-                "price": price_jpy, "buy_price": buy_price_jpy, "qty": qty,
-                "market_value": market_value,
-                "day_change": day_change_jpy, "day_change_pct": round(day_change_pct, 2),
-                "profit": profit, "profit_pct": round(((price_jpy - buy_price_jpy) / buy_price_jpy * 100), 1) if buy_price_jpy > 0 else 0,
-                "memo": str(row.get("メモ", "")) if not pd.isna(row.get("メモ")) else "",
-                "earnings": earnings_sort, "display_earnings": display_earnings,
-                "buy_yield": round((annual_div_jpy / buy_price_jpy * 100), 2) if buy_price_jpy > 0 else 0,
-                "cur_yield": round((annual_div_jpy / price_jpy * 100), 2) if price_jpy > 0 else 0,
-                "div_amt": div_amt,
-                "link_url": link_url,
-                "is_us": is_us_stock
-            })
+class DividendProjector:
+    """銘柄ごとの12か月配当ベクトルを保持し、保有株数・予想配当・履歴が変わった銘柄だけ計算し直す。
+    ベクトルは保有株数込みなので、ポートフォリオごとに 1 つ持つ"""
+
+    def __init__(self):
+        self.vectors = {}  # code -> (キー, 円建て月次ベクトル)
+
+    def project(self, results, store, today=None):
+        today = today or today_jst()
+        month_key = (today.year, today.month)
+        vectors = {}
+        for r in results:
+            key = (r["symbol"], r["qty"], r["div_amt"], month_key, store.version(r["symbol"]))
+            cached = self.vectors.get(r["code"])
+            if cached is not None and cached[0] == key:
+                vectors[r["code"]] = cached
+            else:
+                weights = payment_month_weights(store.events(r["symbol"]), r["market"], today)
+                vectors[r["code"]] = (key, weights * r["div_amt"])
+        self.vectors = vectors
+        return self.calendar(results, vectors, today)
+
+    @staticmethod
+    def calendar(results, vectors, today):
+        names = {r["code"]: r["full_name"] for r in results}
+        codes = [c for c in names if c in vectors]
+        matrix = np.array([vectors[c][1] for c in codes]) if codes else np.zeros((0, 12))
+        totals = matrix.sum(axis=0) if codes else np.zeros(12)
+        months = []
+        for i in range(12):
+            year = today.year + (today.month - 1 + i) // 12
+            month = (today.month - 1 + i) % 12 + 1
+            entries = sorted(({"code": c, "name": names[c], "amount": int(matrix[j, i])}
+                            for j, c in enumerate(codes) if matrix[j, i] >= 1), key=lambda x: -x["amount"])
+            months.append({"month": f"{year}-{month:02d}", "label": f"{year}年{month}月", "amount": int(totals[i]), "entries": entries})
+        return {"months": months, "total": int(totals.sum()), "max": int(totals.max()) if len(totals) else 0}
+
+dividend_store = DividendHistoryStore()
+
+# --- 銘柄の基本情報（ファンダメンタルズ） ---
+FUNDAMENTALS_FILE = os.path.join(DATA_DIR, "fundamentals.json")
+# 項目: (yfinance の info キー, 有効期限[秒])。社名や業種はめったに変わらないので長め
+FUNDAMENTAL_FIELDS = {
+    "long_name": ("longName", 30 * 86400),
+    "sector": ("sector", 30 * 86400),
+    "industry": ("industry", 30 * 86400),
+    "market_cap": ("marketCap", 86400),
+    "per": ("trailingPE", 86400),
+    "pbr": ("priceToBook", 86400),
+}
+# info に無かった項目（ETF の PER など）は、この間隔で取り直す
+FUNDAMENTALS_MISSING_RETRY = 86400
+FUNDAMENTALS_BATCH_SIZE = 10
+FUNDAMENTALS_BATCH_PAUSE = 5.0  # バッチ間の待ち時間（Yahoo への負荷を抑える）
+
+def yfinance_info_provider(symbol):
+    return offload(lambda: yf.Ticker(symbol).info)
+
+class FundamentalsStore:
+    """保有銘柄の PER・PBR・時価総額などを項目ごとの期限付きでディスクにキャッシュする。
+    取得は裏スレッドでバッチごとに間隔を空けて行い、リクエスト処理中には取得しない"""
+
+    def __init__(self, path=FUNDAMENTALS_FILE, provider=yfinance_info_provider,
+                 batch_size=FUNDAMENTALS_BATCH_SIZE, batch_pause=FUNDAMENTALS_BATCH_PAUSE):
+        self.path = path
+        self.provider = provider
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+        self.entries = self._load()  # シンボル -> {項目: [値, 取得時刻]}
+
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, encoding="utf-8") as f:
+                    return json.load(f)
+        except Exception as e:
+            error_log.report("fundamentals", "ファンダメンタルズキャッシュの読込エラー", e)
+        return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with self.lock:
+            data = json.dumps(self.entries, ensure_ascii=False)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    def get(self, symbol):
+        """キャッシュ済みの値だけを返す（期限切れでも値は返す）"""
+        with self.lock:
+            entry = self.entries.get(symbol, {})
+            return {field: value for field, (value, _) in entry.items()}
+
+    def due_symbols(self, symbols, now=None):
+        """いずれかの項目が期限切れ・未取得のシンボル"""
+        now = now or time.time()
+        due = []
+        with self.lock:
+            for symbol in symbols:
+                entry = self.entries.get(symbol, {})
+                if any(self._expired(entry.get(field), ttl, now) for field, (_, ttl) in FUNDAMENTAL_FIELDS.items()):
+                    due.append(symbol)
+        return due
+
+    @staticmethod
+    def _expired(item, ttl, now):
+        if item is None:
+            return True
+        value, fetched = item
+        return now - fetched > (ttl if value is not None else min(ttl, FUNDAMENTALS_MISSING_RETRY))
+
+    def refresh(self, symbols):
+        for i in range(0, len(symbols), self.batch_size):
+            if i:
+                time.sleep(self.batch_pause)
+            for symbol in symbols[i:i + self.batch_size]:
+                try:
+                    info = self.provider(symbol) or {}
+                except Exception as e:
+                    error_log.report("fundamentals", f"ファンダメンタルズ取得エラー ({symbol})", e)
+                    continue
+                if not info:
+                    # 制限中の Yahoo は空の info を返す。取得できなかったものとして次回に取り直す
+                    error_log.report("fundamentals", f"ファンダメンタルズが空でした ({symbol})")
+                    continue
+                fetched = time.time()
+                with self.lock:
+                    entry = self.entries.setdefault(symbol, {})
+                    for field, (key, _) in FUNDAMENTAL_FIELDS.items():
+                        if info.get(key) is not None:
+                            entry[field] = [info[key], fetched]
+                        elif entry.get(field, [None])[0] is None:
+                            # 一部だけの応答でも既存の値は消さない。元から無い項目は FUNDAMENTALS_MISSING_RETRY 後に取り直す
+                            entry[field] = [None, fetched]
+            try:
+                self._save()
+            except Exception as e:
+                error_log.report("fundamentals", "ファンダメンタルズキャッシュの保存エラー", e)
+
+    def refresh_async(self, symbols):
+        """期限切れのシンボルだけを裏で取り直す（すでに実行中なら何もしない）"""
+        due = self.due_symbols(symbols)
+        if not due or not self.refreshing.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.refresh(due)
+            finally:
+                self.refreshing.release()
+
+        threading.Thread(target=run, name="fundamentals", daemon=True).start()
+
+fundamentals_store = FundamentalsStore()
+
+def format_market_cap(value, rate=1.0):
+    """時価総額を円建ての「兆円・億円」表記にする"""
+    if not value:
+        return ""
+    yen = value * rate
+    if yen >= 1e12:
+        return f"{yen / 1e12:.1f}兆円"
+    return f"{yen / 1e8:,.0f}億円"
+
+# --- 売買シミュレーション ---
+def valuation_frame(results):
+    """スナップショットの銘柄行を、シミュレーション用の円建て評価表（証券コード索引）にする"""
+    return pd.DataFrame({
+        "qty": [r["qty"] for r in results],
+        "cost": [r["buy_price"] * r["qty"] for r in results],
+        "price": [r["price"] for r in results],
+        "div_per_share": [r["div_per_share"] for r in results],
+        "rate": [r["rate"] for r in results],
+        "market": [r["market"] for r in results],
+    }, index=pd.Index([r["code"] for r in results], name="code"), dtype=object).astype({
+        "qty": "int64", "cost": "float64", "price": "float64", "div_per_share": "float64", "rate": "float64",
+    })
+
+def new_holding_rows(codes, trades, fx_rates):
+    """未保有の銘柄を評価表に加える行。価格はキャッシュ済みの相場、なければ入力価格を使う。
+    どちらもない（または円換算できない）銘柄は評価できないので ValueError"""
+    tickers = resolve_tickers(list(codes))
+    rows = {}
+    for code in codes:
+        ticker = tickers[code]
+        rate = fx_rates.get(ticker["currency"], 0.0)
+        cached = quote_cache.entries.get(ticker["symbol"])
+        local_price = cached[0][0] if cached and cached[0][0] > 0 else trades.loc[trades["code"] == code, "price"].max()
+        if pd.isna(local_price) or local_price <= 0:
+            raise ValueError(f"{code} は株価が取得できていないため、価格を指定してください")
+        if rate <= 0:
+            raise ValueError(f"{code} の通貨（{ticker['currency']}）の為替レートがないため評価できません")
+        rows[code] = {"qty": 0, "cost": 0.0, "price": float(local_price) * rate,
+                      "div_per_share": 0.0, "rate": rate, "market": ticker["market"]}
+    return pd.DataFrame.from_dict(rows, orient="index")
+
+def summarize_valuation(frame):
+    held = frame[frame["qty"] > 0]
+    market_value = held["qty"] * held["price"]
+    total_assets = float(market_value.sum())
+    total_cost = float(held["cost"].sum())
+    total_div = float((held["qty"] * held["div_per_share"]).sum())
+    profit = (market_value - held["cost"]).where(held["price"] > 0, 0.0)
+    weights = (market_value / total_assets * 100).round(2) if total_assets else market_value * 0
+    return {
+        "total_assets": int(total_assets),
+        "total_profit": int(profit.sum()),
+        "total_div": int(total_div),
+        "buy_yield": round(total_div / total_cost * 100, 2) if total_cost else 0,
+        "cur_yield": round(total_div / total_assets * 100, 2) if total_assets else 0,
+        "allocation": weights.sort_values(ascending=False).to_dict(),
+        "market_allocation": (market_value.groupby(held["market"]).sum() / total_assets * 100).round(2).to_dict() if total_assets else {},
+    }
+
+def simulate_trades(valuation, trades, fx_rates):
+    """売買（株数が負なら売却）をまとめて評価表に適用し、適用後の合計・利回り・構成比を返す。
+    売却は平均取得単価で原価を減らし、差額を実現損益とする"""
+    trades = pd.DataFrame(trades, columns=["code", "qty", "price"])
+    trades["code"] = trades["code"].astype(str).str.strip().str.upper()
+    trades["qty"] = pd.to_numeric(trades["qty"], errors="coerce").fillna(0).astype("int64")
+    trades["price"] = pd.to_numeric(trades["price"], errors="coerce")
+
+    new_codes = pd.Index(trades["code"].unique()).difference(valuation.index)
+    frame = pd.concat([valuation, new_holding_rows(new_codes, trades, fx_rates)]) if len(new_codes) else valuation.copy()
+
+    held = frame.reindex(trades["code"])
+    rate = held["rate"].to_numpy()
+    price_jpy = np.where(trades["price"].notna(), trades["price"].to_numpy() * rate, held["price"].to_numpy())
+    avg_cost = np.divide(held["cost"].to_numpy(), held["qty"].to_numpy(), out=np.zeros(len(held)), where=held["qty"].to_numpy() > 0)
+    qty = trades["qty"].to_numpy()
+    buys = qty > 0
+    # 保有株数を超える売却は保有分までとする
+    qty = np.where(buys, qty, np.maximum(qty, -held["qty"].fillna(0).to_numpy()))
+    cost_delta = np.where(buys, qty * price_jpy, qty * avg_cost)
+    realized = np.where(buys, 0.0, (price_jpy - avg_cost) * -qty)
 
-        total_profit = sum(r['profit'] for r in results)
-        total_div = sum(r['div_amt'] for r in results)
-        total_assets = sum(r['market_value'] for r in results)
-        realized_gain, dividend, trust_return = get_extra_gains()
-
-        cache_storage = {
-            "last_update": current_time,
-            "results": results,
-            "total_profit": total_profit,
-            "total_div": total_div,
-            "total_assets": total_assets,
-            "realized_gain": realized_gain,
-            "dividend": dividend,
-            "trust_return": trust_return,
-            "usdjpy": usdjpy
+    deltas = pd.DataFrame({"qty": qty, "cost": cost_delta, "realized": realized}, index=trades["code"]).groupby(level=0).sum()
+    frame.loc[deltas.index, "qty"] = (frame.loc[deltas.index, "qty"] + deltas["qty"]).clip(lower=0)
+    frame.loc[deltas.index, "cost"] = (frame.loc[deltas.index, "cost"] + deltas["cost"]).where(frame.loc[deltas.index, "qty"] > 0, 0.0)
+
+    summary = summarize_valuation(frame)
+    summary["realized_gain"] = int(deltas["realized"].sum())
+    return summary
+
+# --- 資産配分（セクター・市場・通貨・口座） ---
+SECTOR_OVERRIDES_FILE = os.environ.get("SECTOR_OVERRIDES_FILE", "sectors.json")
+MARKET_LABELS = {"JP": "日本株", "US": "米国株"}
+ALLOCATION_DIMENSIONS = [("sector", "セクター"), ("market", "市場"), ("currency", "通貨"), ("account", "口座")]
+
+class SectorLookup:
+    """証券コード → セクター。sectors.json の手動設定を優先し、なければ基本情報キャッシュの業種を使う"""
+
+    def __init__(self, path=SECTOR_OVERRIDES_FILE):
+        self.path = path
+        self.mtime = None
+        self.overrides = {}
+
+    def load(self):
+        mtime = os.path.getmtime(self.path) if os.path.exists(self.path) else None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        self.overrides = {}
+        if mtime is not None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self.overrides = {str(k).strip().upper(): v for k, v in json.load(f).items()}
+            except Exception as e:
+                error_log.report("config", "セクター設定の読込エラー", e)
+
+    def sector(self, code, symbol):
+        return self.overrides.get(code) or fundamentals_store.get(symbol).get("sector") or "未分類"
+
+sector_lookup = SectorLookup()
+
+def group_table(frame, key):
+    grouped = frame.groupby(key, sort=False)[["market_value", "profit", "div_amt"]].sum().sort_values("market_value", ascending=False)
+    total = grouped["market_value"].sum()
+    return [{
+        "label": label,
+        "market_value": int(row.market_value),
+        "profit": int(row.profit),
+        "div_amt": int(row.div_amt),
+        "weight": round(row.market_value / total * 100, 1) if total else 0,
+    } for label, row in zip(grouped.index, grouped.itertuples())]
+
+def allocation_breakdown(results, lots):
+    """セクター・市場・通貨・口座ごとの評価額・損益・配当をスナップショット作成時に一度だけ集計する"""
+    sector_lookup.load()
+    frame = pd.DataFrame({
+        "market_value": [r["market_value"] for r in results],
+        "profit": [r["profit"] for r in results],
+        "div_amt": [r["div_amt"] for r in results],
+        "sector": [sector_lookup.sector(r["code"], r["symbol"]) for r in results],
+        "market": [MARKET_LABELS.get(r["market"], r["market"]) for r in results],
+        "currency": [r["currency"] for r in results],
+    })
+    breakdown = {key: group_table(frame, key) for key in ("sector", "market", "currency")}
+
+    # 口座はロット単位で持つので、ロットごとに評価し直して集計する
+    price = lots["code"].map({r["code"]: r["price"] for r in results}).fillna(0.0)
+    rate = lots["code"].map({r["code"]: r["rate"] for r in results}).fillna(0.0)
+    div_per_share = lots["code"].map({r["code"]: r["div_per_share"] for r in results}).fillna(0.0)
+    lot_frame = pd.DataFrame({
+        "account": lots["account"],
+        "market_value": (price * lots["qty"]).astype(int),
+        "profit": ((price - lots["buy_price"] * rate) * lots["qty"]).where(price > 0, 0.0),
+        "div_amt": div_per_share * lots["qty"],
+    })
+    breakdown["account"] = group_table(lot_frame, "account")
+    return breakdown
+
+# --- 日足の価格履歴（保有銘柄・ベンチマーク指数） ---
+PRICE_HISTORY_FILE = os.path.join(DATA_DIR, "price_history.json")
+PRICE_HISTORY_DAYS = 730
+
+class PriceHistoryStore:
+    """シンボルごとの日足終値をローカルに蓄積する。追加取得は最後の日付以降だけ"""
+
+    def __init__(self, path=PRICE_HISTORY_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+        self.refreshed_on = None
+        self.series = self._load()  # シンボル -> {日付(ISO): 終値}
+
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, encoding="utf-8") as f:
+                    return json.load(f)
+        except Exception as e:
+            error_log.report("price_history", "価格履歴の読込エラー", e)
+        return {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self.lock:
+            data = json.dumps(self.series)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    def add_frame(self, data, symbols):
+        """yf.download の日足結果から終値を取り込み、変化があったか返す"""
+        changed = False
+        with self.lock:
+            for symbol in symbols:
+                try:
+                    if symbol not in data.columns.get_level_values(0):
+                        continue
+                    close = data[symbol]["Close"].dropna()
+                except Exception:
+                    continue
+                series = self.series.setdefault(symbol, {})
+                for ts, value in close.items():
+                    key = ts.date().isoformat()
+                    if series.get(key) != float(value):
+                        series[key] = float(value)
+                        changed = True
+        return changed
+
+    def last_date(self, symbol):
+        series = self.series.get(symbol)
+        return date.fromisoformat(max(series)) if series else None
+
+    def closes(self, symbol):
+        with self.lock:
+            series = dict(self.series.get(symbol, {}))
+        return pd.Series(series, index=pd.Index(sorted(series), dtype=object), dtype=float)
+
+    def refresh(self, symbols, today=None):
+        today = today or today_jst()
+        starts = [self.last_date(s) for s in symbols]
+        start = min((d for d in starts if d), default=None) if all(starts) else None
+        start = start or today - timedelta(days=PRICE_HISTORY_DAYS)
+        data = offload(yf.download, symbols, start=start.isoformat(), group_by='ticker', progress=False, actions=False)
+        if data is not None and not data.empty and self.add_frame(data, symbols):
+            self.save()
+
+    def refresh_async(self, symbols):
+        """1日1回、最後の日付以降の日足を裏で取り足す"""
+        today = today_jst()
+        if self.refreshed_on == today or not self.refreshing.acquire(blocking=False):
+            return
+        self.refreshed_on = today
+
+        def run():
+            try:
+                self.refresh(symbols, today)
+            except Exception as e:
+                error_log.report("price_history", "価格履歴の取得エラー", e)
+            finally:
+                self.refreshing.release()
+
+        threading.Thread(target=run, name="price-history", daemon=True).start()
+
+price_store = PriceHistoryStore()
+
+# --- ベンチマーク比較（時間加重収益率） ---
+PERFORMANCE_FILE = os.path.join(DATA_DIR, "performance.json")
+# TOPIX 指数は Yahoo で安定して取れないため TOPIX 連動 ETF で代用する
+BENCHMARKS = {"^N225": "日経平均", "1306.T": "TOPIX (1306)", "^GSPC": "S&P 500"}
+
+class PerformanceTracker:
+    """日ごとのポートフォリオ評価額と保有株数を記録し、時間加重収益率の指数（初日=100）を1日ずつ伸ばす。
+    株数の増減は当日の株価で評価した入出金として扱い、収益率から除く"""
+
+    def __init__(self, path=PERFORMANCE_FILE):
+        self.path = path
+        self.days = self._load()  # 日付(ISO) -> {"value", "qty", "prices", "index"}
+        self.comparison_key = None
+        self.comparison_cache = None
+
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, encoding="utf-8") as f:
+                    return json.load(f)
+        except Exception as e:
+            error_log.report("performance", "運用成績の読込エラー", e)
+        return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.days, f)
+        os.replace(tmp, self.path)
+
+    def record(self, results, today=None):
+        """当日の評価額を記録し、前日からの収益率で当日の指数だけを計算する"""
+        today = (today or today_jst()).isoformat()
+        value = float(sum(r["market_value"] for r in results))
+        qty = {r["code"]: r["qty"] for r in results}
+        prices = {r["code"]: r["price"] for r in results}
+        previous = [d for d in self.days if d < today]
+        index = 100.0
+        if previous:
+            prev = self.days[max(previous)]
+            flow = sum((qty.get(c, 0) - prev["qty"].get(c, 0)) * prices.get(c, prev["prices"].get(c, 0.0))
+                       for c in set(qty) | set(prev["qty"]))
+            if prev["value"] > 0:
+                index = prev["index"] * (value - flow) / prev["value"]
+        entry = {"value": value, "qty": qty, "prices": prices, "index": index}
+        if self.days.get(today) != entry:
+            self.days[today] = entry
+            try:
+                self._save()
+            except Exception as e:
+                error_log.report("performance", "運用成績の保存エラー", e)
+
+    def comparison(self, store, benchmarks=BENCHMARKS):
+        """ポートフォリオと各指数を記録開始日=100 にそろえた系列。記録や指数が増えた時だけ作り直す"""
+        key = (max(self.days, default=None), len(self.days),
+               tuple(store.last_date(s) for s in benchmarks))
+        if key == self.comparison_key:
+            return self.comparison_cache
+        dates = sorted(self.days)
+        series = {"ポートフォリオ": pd.Series({d: self.days[d]["index"] for d in dates}, dtype=float)}
+        if dates:
+            for symbol, label in benchmarks.items():
+                closes = store.closes(symbol)
+                closes = closes[closes.index <= dates[-1]]
+                if closes.empty:
+                    continue
+                # 記録日にそろえ、休場日は直前の終値で埋める
+                aligned = closes.reindex(sorted(set(closes.index) | set(dates))).ffill().reindex(dates).bfill()
+                series[label] = aligned / aligned.iloc[0] * 100
+        returns = {label: round(float(s.iloc[-1]) - 100, 2) for label, s in series.items() if len(s)}
+        self.comparison_cache = {
+            "dates": dates,
+            "series": {label: [round(float(v), 2) for v in s] for label, s in series.items()},
+            "returns": returns,
+            "lines": chart_polylines(series),
         }
-        return render_template_string(HTML_TEMPLATE, results=results, total_profit=total_profit,
-                                      total_dividend_income=total_div, total_assets=total_assets,
-                                      realized_gain=realized_gain, dividend=dividend, trust_return=trust_return,
-                                      usdjpy=round(usdjpy, 2))
+        self.comparison_key = key
+        return self.comparison_cache
+
+def chart_polylines(series, width=300, height=120):
+    """複数系列を共通の縦軸で SVG polyline の座標列にする"""
+    values = [v for s in series.values() for v in s if pd.notna(v)]
+    if not values:
+        return {}
+    lo, hi = min(values), max(values)
+    span = (hi - lo) or 1.0
+    lines = {}
+    for label, s in series.items():
+        if len(s) < 2:
+            continue
+        xs = np.linspace(0, width, len(s))
+        ys = height - (s.to_numpy(dtype=float) - lo) / span * height
+        lines[label] = " ".join(f"{x:.1f},{y:.1f}" for x, y in zip(xs, ys))
+    return lines
+
+
+# --- 税引後の損益・配当 ---
+CAPITAL_GAINS_TAX_RATE = 0.20315  # 譲渡益課税（所得税・復興特別所得税・住民税）
+DIVIDEND_TAX_RATE = 0.20315
+FOREIGN_WITHHOLDING_RATES = {"US": 0.10}  # 外国での源泉徴収（NISA でもかかる）
+
+def after_tax(results, lots):
+    """ロットごとに口座区分（NISA/特定など）を見て税引後の損益・年間配当を計算し、銘柄別とポートフォリオ合計を返す。
+    ポートフォリオの譲渡益税は課税口座内の損益を通算してから掛ける。外国税額控除は考えない"""
+    by_code = {r["code"]: r for r in results}
+    price = lots["code"].map({c: r["price"] for c, r in by_code.items()}).fillna(0.0).to_numpy()
+    rate = lots["code"].map({c: r["rate"] for c, r in by_code.items()}).fillna(0.0).to_numpy()
+    div_per_share = lots["code"].map({c: r["div_per_share"] for c, r in by_code.items()}).fillna(0.0).to_numpy()
+    withholding = lots["code"].map({c: FOREIGN_WITHHOLDING_RATES.get(r["market"], 0.0) for c, r in by_code.items()}).fillna(0.0).to_numpy()
+    qty = lots["qty"].to_numpy()
+    taxable = ~lots["account"].str.upper().str.contains("NISA").to_numpy()
+
+    gain = np.where(price > 0, (price - lots["buy_price"].to_numpy() * rate) * qty, 0.0)
+    gain_tax = np.where(taxable, np.maximum(gain, 0.0) * CAPITAL_GAINS_TAX_RATE, 0.0)
+    gross_div = div_per_share * qty
+    net_div = gross_div * (1 - withholding) * np.where(taxable, 1 - DIVIDEND_TAX_RATE, 1.0)
+
+    per_lot = pd.DataFrame({"code": lots["code"].to_numpy(), "net_profit": gain - gain_tax, "net_div": net_div})
+    per_code = per_lot.groupby("code", sort=False).sum()
+    taxable_gain = gain[taxable].sum()
+    return {
+        "by_code": {c: (int(row.net_profit), int(row.net_div)) for c, row in zip(per_code.index, per_code.itertuples())},
+        "net_total_profit": int(gain.sum() - max(taxable_gain, 0.0) * CAPITAL_GAINS_TAX_RATE),
+        "net_total_div": int(net_div.sum()),
+    }
+
+# --- 銘柄ごとの HTML 断片キャッシュ ---
+def holding_hash(r):
+    """表示に使う銘柄行の内容から断片キャッシュのキーを作る"""
+    return hashlib.sha1(json.dumps(r, sort_keys=True, default=str, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class FragmentCache:
+    """銘柄ごとの HTML 断片（表の行・メモ欄）を内容のハッシュで使い回す。
+    スナップショットが変わっても、内容が同じ銘柄は描画し直さない"""
+
+    def __init__(self, template_name):
+        self.template_name = template_name
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.stats = {"rendered": 0, "reused": 0}
+
+    def render(self, results, sparklines=None):
+        template = app.jinja_env.get_template(self.template_name)  # コンパイル済みテンプレートは Jinja 側でキャッシュされる
+        sparklines = sparklines or {}
+        fragments = []
+        fresh = {}
+        with self.lock:
+            for r in results:
+                spark = sparklines.get(r["symbol"])
+                key = (r["fragment_key"], spark)
+                html = self.cache.get(key)
+                if html is None:
+                    html = Markup(template.render(r=r, spark=spark))
+                    self.stats["rendered"] += 1
+                else:
+                    self.stats["reused"] += 1
+                fresh[key] = html
+                fragments.append(html)
+            # 今のスナップショットにない断片は捨てる（メモリを銘柄数で頭打ちにする）
+            self.cache = fresh
+        return fragments
+
+
+# --- 静的アセット（CSS/JS の結合・圧縮・内容ハッシュ付きファイル名） ---
+ASSET_SOURCE_DIR = os.path.join(app.root_path, "assets")
+ASSET_BUILD_DIR = os.path.join(DATA_DIR, "assets")
+# 配信名 → assets/ 内の元ファイル（この順に結合する）
+ASSET_BUNDLES = {
+    "app.js": ["tablesort.js", "index.js"],
+    "index.css": ["index.css"],
+    "earnings.css": ["earnings.css"],
+    "performance.css": ["performance.css"],
+}
+ASSET_MIMETYPES = {".js": "text/javascript", ".css": "text/css"}
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+def minify_css(text):
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    text = re.sub(r"\s+", " ", text)
+    return re.sub(r"\s*([{}:;,>])\s*", r"\1", text).replace(";}", "}").strip()
+
+def minify_js(text):
+    """行頭の字下げ・コメント行・空行だけを落とす（改行は残すので自動セミコロン挿入に影響しない）"""
+    lines = (line.strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+class AssetPipeline:
+    """assets/ の CSS/JS を結合・縮小し、内容ハッシュ入りのファイル名で gzip/brotli 版と一緒に書き出す。
+    ファイル名が内容で変わるので、ブラウザには 1 年間 immutable でキャッシュさせられる"""
+
+    def __init__(self, source_dir=ASSET_SOURCE_DIR, build_dir=ASSET_BUILD_DIR, bundles=ASSET_BUNDLES):
+        self.source_dir = source_dir
+        self.build_dir = os.path.abspath(build_dir)
+        self.bundles = bundles
+        self.manifest = {}
+        self.built = set()
+        self.mtimes = None
+        self.lock = threading.Lock()
+
+    def source_mtimes(self):
+        return tuple(os.path.getmtime(os.path.join(self.source_dir, f))
+                     for files in self.bundles.values() for f in files)
+
+    def build(self):
+        """元ファイルが変わった時だけ作り直す"""
+        with self.lock:
+            mtimes = self.source_mtimes()
+            if mtimes == self.mtimes:
+                return self.manifest
+            os.makedirs(self.build_dir, exist_ok=True)
+            manifest = {}
+            for name, files in self.bundles.items():
+                stem, ext = os.path.splitext(name)
+                parts = []
+                for f in files:
+                    with open(os.path.join(self.source_dir, f), encoding="utf-8") as fh:
+                        parts.append(fh.read())
+                minify = minify_js if ext == ".js" else minify_css
+                body = "\n".join(minify(p) for p in parts).encode("utf-8")
+                filename = f"{stem}.{hashlib.sha256(body).hexdigest()[:10]}{ext}"
+                self.write(filename, body)
+                self.write(filename + ".gz", gzip.compress(body, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    self.write(filename + ".br", brotli.compress(body, quality=11))
+                manifest[name] = filename
+            self.manifest = manifest
+            self.built = set(manifest.values())
+            self.mtimes = mtimes
+            return manifest
+
+    def write(self, filename, data):
+        path = os.path.join(self.build_dir, filename)
+        if os.path.exists(path):
+            return  # 名前が内容のハッシュなので、既にあれば同じ中身
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def url(self, name):
+        return url_for("asset", filename=self.build()[name])
+
+    def response(self, filename, accept_encoding):
+        """Accept-Encoding に応じて事前圧縮済みファイルを返す。ハッシュ付きの名前以外は 404"""
+        self.build()
+        if filename not in self.built:
+            abort(404)
+        path = os.path.join(self.build_dir, filename)
+        encoding = None
+        for enc, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if enc in accept_encoding and os.path.exists(path + suffix):
+                path, encoding = path + suffix, enc
+                break
+        resp = send_file(path, mimetype=ASSET_MIMETYPES[os.path.splitext(filename)[1]],
+                         max_age=ASSET_MAX_AGE, conditional=True, etag=False)
+        resp.cache_control.public = True
+        resp.cache_control.immutable = True
+        resp.headers["Vary"] = "Accept-Encoding"
+        if encoding:
+            resp.headers["Content-Encoding"] = encoding
+        return resp
+
+asset_pipeline = AssetPipeline()
+
+@app.context_processor
+def inject_asset_url():
+    return {"asset_url": asset_pipeline.url}
+
+# --- HTTP 応答の圧縮とキャッシュ指定 ---
+# エンドポイントごとの Cache-Control（無いものは no-cache = ETag で再検証）
+CACHE_POLICIES = {
+    "static": "public, max-age=86400",
+    "earnings_ics": "private, max-age=3600",
+    "simulate": "no-store",
+    "profiles": "no-store",
+    "profile_detail": "no-store",
+    "users": "no-store",
+    "remove_user": "no-store",
+    "errors": "no-store",
+}
+COMPRESSIBLE_MIMETYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+COMPRESS_MIN_BYTES = 512
+
+class ResponseCompressor:
+    """応答本文を br/gzip で圧縮する。本文のハッシュで圧縮結果を覚えておくので、
+    スナップショットが変わらない間はメインページを何度開いても圧縮し直さない"""
+
+    def __init__(self, max_entries=32):
+        self.cache = {}
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.stats = {"compressed": 0, "reused": 0, "bytes_in": 0, "bytes_out": 0}
+
+    @staticmethod
+    def choose_encoding(accept_encoding):
+        if brotli is not None and "br" in accept_encoding:
+            return "br"
+        if "gzip" in accept_encoding:
+            return "gzip"
+        return None
+
+    def compress(self, body, digest, encoding):
+        key = (digest, encoding)
+        with self.lock:
+            data = self.cache.get(key)
+            if data is not None:
+                self.stats["reused"] += 1
+        if data is None:
+            # 応答ごとに作り直すので、ファイル用の最大圧縮より速さを優先する
+            data = brotli.compress(body, quality=5) if encoding == "br" else gzip.compress(body, compresslevel=6, mtime=0)
+            with self.lock:
+                if len(self.cache) >= self.max_entries:
+                    self.cache.pop(next(iter(self.cache)))
+                self.cache[key] = data
+                self.stats["compressed"] += 1
+        with self.lock:
+            self.stats["bytes_in"] += len(body)
+            self.stats["bytes_out"] += len(data)
+        return data
+
+response_compressor = ResponseCompressor()
+
+@app.after_request
+def compress_and_cache(resp):
+    """Cache-Control・ETag を付け、条件付きリクエストには 304、それ以外は圧縮して返す。
+    /assets は事前圧縮済みで immutable 指定も済んでいるので触らない"""
+    if request.endpoint == "asset" or resp.status_code != 200 or request.method not in ("GET", "HEAD", "POST"):
+        return resp
+    policy = CACHE_POLICIES.get(request.endpoint, "no-cache")
+    resp.headers["Cache-Control"] = policy
+    if "Content-Encoding" in resp.headers or not resp.mimetype.startswith(COMPRESSIBLE_MIMETYPES):
+        return resp
+    if resp.direct_passthrough:
+        resp.direct_passthrough = False  # send_file の応答（favicon など）も本文を読んで圧縮する
+    body = resp.get_data()
+    digest = hashlib.sha256(body).hexdigest()[:20]
+    encoding = None
+    if len(body) >= COMPRESS_MIN_BYTES:
+        encoding = response_compressor.choose_encoding(request.headers.get("Accept-Encoding", ""))
+    if encoding:
+        resp.set_data(response_compressor.compress(body, digest, encoding))
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    if policy != "no-store":
+        # 表現（圧縮方式）ごとに異なる強い ETag にする
+        resp.set_etag(f"{digest}-{encoding}" if encoding else digest)
+        resp.make_conditional(request)
+    return resp
+
+# --- 保有銘柄のローカル DB（シートからの一方向同期） ---
+# "sqlite" にすると、保有銘柄はシートではなくローカルの SQLite から読む（シートは定期同期で取り込むだけ）
+HOLDINGS_BACKEND = os.environ.get("HOLDINGS_BACKEND", "sheet")
+HOLDINGS_SYNC_INTERVAL = int(os.environ.get("HOLDINGS_SYNC_INTERVAL", "300"))
+HOLDINGS_SQL_COLUMNS = ", ".join(f'"{c}"' for c in HOLDING_COLUMNS)
+
+class HoldingsStore:
+    """保有銘柄シートと同じ列を持つ SQLite の表。同期はシートの本文が変わった時だけ全行を入れ替えて世代を進める。
+    読み出しは世代番号を 1 行読むだけで、世代が同じならメモリ上の集約結果をそのまま返す"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+        self.parsed = None
+        self.parsed_version = None
+        self.stats = {"syncs": 0, "imports": 0, "rows": 0, "last_sync": None, "reads": 0, "rebuilds": 0}
+
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            columns = ", ".join(f'"{c}" TEXT' for c in HOLDING_COLUMNS)
+            conn.executescript(f"""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS holdings (row_no INTEGER PRIMARY KEY, {columns});
+                CREATE INDEX IF NOT EXISTS holdings_code ON holdings("証券コード");
+                CREATE TABLE IF NOT EXISTS holdings_meta (
+                    id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER, digest TEXT, synced_at REAL);
+                INSERT OR IGNORE INTO holdings_meta VALUES (1, 0, NULL, NULL);
+            """)
+            self.conn = conn
+        return self.conn
+
+    def import_frame(self, frame, digest):
+        """シートの銘柄行で表を入れ替える。DB が同じ本文から取り込み済みなら何もしない。入れ替えたら True"""
+        frame = frame.reindex(columns=HOLDING_COLUMNS)
+        rows = frame.astype(object).where(frame.notna(), None).values.tolist()
+        placeholders = ", ".join("?" * len(HOLDING_COLUMNS))
+        with self.lock:
+            conn = self.connect()
+            self.stats["syncs"] += 1
+            self.stats["last_sync"] = time.time()
+            # 複数ワーカーがそれぞれ同期しても、同じ本文なら世代を進めない
+            if conn.execute("SELECT digest FROM holdings_meta").fetchone()[0] == digest:
+                return False
+            with conn:
+                conn.execute("DELETE FROM holdings")
+                conn.executemany(f"INSERT INTO holdings ({HOLDINGS_SQL_COLUMNS}) VALUES ({placeholders})", rows)
+                conn.execute("UPDATE holdings_meta SET version = version + 1, digest = ?, synced_at = ?",
+                             (digest, time.time()))
+            self.stats["imports"] += 1
+            self.stats["rows"] = len(rows)
+            return True
+
+    def read(self):
+        """(holdings, lots, tickers)。まだ一度も取り込んでいなければ None"""
+        with self.lock:
+            conn = self.connect()
+            self.stats["reads"] += 1
+            version = conn.execute("SELECT version FROM holdings_meta").fetchone()[0]
+            if version == self.parsed_version:
+                return self.parsed
+            if version == 0:
+                return None
+            frame = pd.read_sql_query(f"SELECT {HOLDINGS_SQL_COLUMNS} FROM holdings ORDER BY row_no", conn)
+            self.parsed = holdings_from_frame(frame)
+            self.parsed_version = version
+            self.stats["rebuilds"] += 1
+            return self.parsed
+
+# --- ユーザーごとのポートフォリオ ---
+USERS_FILE = os.path.join(DATA_DIR, "users.json")
+DEFAULT_USER = "default"
+USER_ID_PATTERN = re.compile(r"^[a-z0-9_-]{1,32}$")
+USER_COOKIE = "portfolio"
+
+class Portfolio:
+    """1 人分のシート取得・スナップショット・台帳・運用成績。株価・為替・配当履歴・基本情報のキャッシュは
+    シンボル単位で全員共有なので、ユーザーを足しても増えるのはシートの取得（と新しい銘柄の分）だけ"""
+
+    def __init__(self, user_id, name, holdings_url, realized_url, data_dir):
+        self.user_id = user_id
+        self.name = name
+        if HOLDINGS_BACKEND == "sqlite":
+            # シートは同期用に銘柄行の表まで読むだけで、集約は DB から読む時に行う
+            self.holdings_fetcher = SheetFetcher(holdings_url, read_holdings_frame)
+            self.holdings_store = HoldingsStore(os.path.join(data_dir, "holdings.db"))
+        else:
+            self.holdings_fetcher = SheetFetcher(holdings_url, parse_holdings_csv)
+            self.holdings_store = None
+        self.realized_fetcher = SheetFetcher(realized_url, parse_realized_csv)
+        self.ledger_store = LedgerStore(os.path.join(data_dir, "ledger.db"))
+        self.performance_tracker = PerformanceTracker(os.path.join(data_dir, "performance.json"))
+        self.dividend_projector = DividendProjector()
+        self.row_fragments = FragmentCache("_holding_row.html")
+        self.memo_fragments = FragmentCache("_memo_box.html")
+        self.snapshot = dict(EMPTY_SNAPSHOT)
+        self.last_extra_gains = (0.0, 0.0, 0.0)
+        self.lock = threading.Lock()        # 作り直しは同時に 1 つだけ
+        self.refreshing = threading.Lock()  # 裏での作り直しが走っているか
+        self.status = {"failed_at": 0, "error": None}
+
+    def load_holdings(self):
+        """(holdings, lots, tickers)。sqlite モードではローカル DB から読み、まだ空ならその場で 1 回同期する"""
+        if self.holdings_store is None:
+            return self.holdings_fetcher.fetch()[0]
+        parsed = self.holdings_store.read()
+        if parsed is None:
+            sync_holdings(self)
+            parsed = self.holdings_store.read()
+        return parsed
+
+    def describe(self):
+        return {"id": self.user_id, "name": self.name,
+                "holdings_url": self.holdings_fetcher.url, "realized_url": self.realized_fetcher.url,
+                "holdings": len(self.snapshot["results"] or []), "last_update": self.snapshot["last_update"]}
+
+class PortfolioRegistry:
+    """ユーザー（表示名・保有銘柄シート・実利シートの URL）を users.json に保存して管理する。
+    既定ユーザーは環境変数の URL を使い、データも従来どおり DATA_DIR 直下に置く。
+    gunicorn の他のワーカーが登録・削除することもあるので、users.json が更新されていたら読み直す"""
+
+    def __init__(self, path=USERS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.portfolios = {DEFAULT_USER: Portfolio(DEFAULT_USER, "", SPREADSHEET_CSV_URL,
+                                                   SPREADSHEET_REALIZED_URL, DATA_DIR)}
+        self.reload()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        """users.json の内容。読めなかった時は None"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            error_log.report("config", "ユーザー設定の読込エラー", e)
+            return None
+
+    def _create(self, user_id, entry):
+        return Portfolio(user_id, entry.get("name") or user_id, entry["holdings_url"],
+                         entry.get("realized_url") or "", os.path.join(DATA_DIR, "users", user_id))
+
+    def _upsert(self, user_id, entry):
+        """URL が変わらなければ手元の Portfolio（スナップショット）をそのまま使う"""
+        current = self.portfolios.get(user_id)
+        urls = (entry["holdings_url"], entry.get("realized_url") or "")
+        if current and (current.holdings_fetcher.url, current.realized_fetcher.url) == urls:
+            current.name = entry.get("name") or user_id
+            return current
+        return self._create(user_id, entry)
+
+    def reload(self):
+        """users.json が前回読んだ時から変わっていれば読み直す"""
+        mtime = self._mtime()
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            mtime = self._mtime()
+            if mtime == self.mtime:
+                return
+            entries = self._load()
+            if entries is None:
+                return  # 壊れたファイルでユーザーを消さない（直るまで手元の一覧を使う）
+            portfolios = {DEFAULT_USER: self.portfolios[DEFAULT_USER]}
+            for user_id, entry in entries.items():
+                portfolios[user_id] = self._upsert(user_id, entry)
+            self.portfolios = portfolios
+            self.mtime = mtime
+
+    def _file_lock(self):
+        """users.json の読み直し〜書き込みをワーカー間で排他する（fcntl がない環境では何もしない）"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        lock = open(self.path + ".lock", "w")
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def save(self):
+        entries = {p.user_id: {"name": p.name, "holdings_url": p.holdings_fetcher.url,
+                               "realized_url": p.realized_fetcher.url}
+                   for p in self.portfolios.values() if p.user_id != DEFAULT_USER}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+        self.mtime = self._mtime()
+
+    def get(self, user_id):
+        self.reload()
+        return self.portfolios.get(user_id)
+
+    def all(self):
+        self.reload()
+        return list(self.portfolios.values())
+
+    def register(self, user_id, name, holdings_url, realized_url=""):
+        """登録・更新。URL が変わらなければ手元のスナップショットはそのまま使う"""
+        if user_id == DEFAULT_USER or not USER_ID_PATTERN.match(user_id or ""):
+            raise ValueError(f"使えないユーザー ID です: {user_id}")
+        if not str(holdings_url).startswith(("http://", "https://")):
+            raise ValueError("holdings_url には http(s) の URL を指定してください")
+        # 他のワーカーの登録・削除を取り込んでから書く（古い一覧で上書きしない）
+        with self._file_lock():
+            self.reload()
+            with self.lock:
+                entry = {"name": name, "holdings_url": holdings_url, "realized_url": realized_url}
+                self.portfolios[user_id] = self._upsert(user_id, entry)
+                self.save()
+                return self.portfolios[user_id]
+
+    def remove(self, user_id):
+        with self._file_lock():
+            self.reload()
+            with self.lock:
+                if user_id == DEFAULT_USER or self.portfolios.pop(user_id, None) is None:
+                    return False
+                self.save()
+                return True
+
+portfolios = PortfolioRegistry()
+
+def sync_holdings(portfolio):
+    """シートを条件付き GET で取り、本文が変わっていればローカル DB に取り込む（シート → DB の一方向）"""
+    frame, _ = portfolio.holdings_fetcher.fetch()
+    return portfolio.holdings_store.import_frame(frame, portfolio.holdings_fetcher.digest)
+
+def holdings_sync_loop():
+    """全ユーザーの保有銘柄シートを HOLDINGS_SYNC_INTERVAL 秒ごとに同期する"""
+    while True:
+        for portfolio in portfolios.all():
+            try:
+                sync_holdings(portfolio)
+            except Exception as e:
+                error_log.report("holdings_sheet", f"保有銘柄シート同期エラー ({portfolio.user_id})", e)
+        time.sleep(HOLDINGS_SYNC_INTERVAL)
+
+def start_holdings_sync():
+    thread = threading.Thread(target=holdings_sync_loop, name="holdings-sync", daemon=True)
+    thread.start()
+    return thread
+
+def build_snapshot(portfolio, force_quotes=False):
+    """スプレッドシートと株価データから表示用のスナップショットを組み立てる"""
+    try:
+        holdings, lots, tickers = portfolio.load_holdings()
     except Exception as e:
-        return f"システムエラー: {e}"
-
-HTML_TEMPLATE = """
-<!doctype html>
-<html lang="ja">
-<head>
-    <meta charset="utf-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1, maximum-scale=1, user-scalable=no">
-    <link rel="icon" href="{{ url_for('static', filename='favicon.svg') }}" type="image/svg+xml">
-    <title>管理 Pro</title>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/tablesort/5.2.1/tablesort.min.js"></script>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/tablesort/5.2.1/sorts/tablesort.number.min.js"></script>
-    <style>
-        body { font-family: -apple-system, sans-serif; margin: 0; background: #f2f2f7; color: #1c1c1e; display: flex; justify-content: center; }
-        .container { width: 100%; max-width: 800px; padding: 8px; box-sizing: border-box; }
-        @media (min-width: 801px) { .container { width: 50%; } }
-        .summary { display: grid; grid-template-columns: 1fr 1fr; gap: 8px; margin-bottom: 8px; }
-        .card { background: #fff; padding: 12px; border-radius: 10px; text-align: center; box-shadow: 0 1px 3px rgba(0,0,0,0.1); }
-        .card small { color: #8e8e93; font-size: 10px; display: block; margin-bottom: 2px; }
-        .card div { font-size: 16px; font-weight: bold; }
-        .tabs { display: flex; background: #e5e5ea; border-radius: 8px; padding: 2px; margin-bottom: 10px; }
-        .tab { flex: 1; padding: 8px; border: none; background: none; font-size: 12px; font-weight: bold; border-radius: 6px; color: #8e8e93; cursor: pointer; }
-        .tab.active { background: #fff; color: #007aff; box-shadow: 0 1px 2px rgba(0,0,0,0.1); }
-        .content { display: none; }
-        .content.active { display: block; }
-        .ctrl-panel { display: flex; justify-content: space-between; align-items: center; margin-bottom: 10px; gap: 8px; }
-        #memo-sort { font-size: 12px; padding: 8px; border-radius: 6px; border: 1px solid #ccc; background: #fff; flex-grow: 1; }
-        .btn-update { background: #007aff; color: #fff; border: none; padding: 8px 14px; border-radius: 6px; font-size: 11px; font-weight: bold; text-decoration: none; white-space: nowrap; }
-        .table-wrap { background: #fff; border-radius: 10px; box-shadow: 0 1px 3px rgba(0,0,0,0.1); overflow: hidden; }
-        table { width: 100%; border-collapse: collapse; table-layout: fixed; font-size: 11px; }
-        th { background: #f8f8f8; padding: 10px 2px; font-size: 10px; color: #8e8e93; border-bottom: 1px solid #eee; cursor: pointer; }
-        td { padding: 10px 2px; border-bottom: 1px solid #f2f2f7; text-align: center; }
-        .name-td { text-align: left; padding-left: 8px; width: 22%; }
-        .name-td a { color: #1c1c1e; text-decoration: none; font-weight: bold; }
-        .plus { color: #34c759; }
-        .minus { color: #ff3b30; }
-        .small-gray { color: #8e8e93; font-size: 9px; font-weight: normal; }
-        .us-badge { background: #ff9500; color: #fff; font-size: 8px; padding: 1px 3px; border-radius: 3px; font-weight: bold; margin-left: 2px; vertical-align: middle; }
-        .breakdown-row { display: flex; justify-content: space-between; align-items: center; gap: 6px; margin-bottom: 3px; }
-        .breakdown-label { color: #8e8e93; font-size: 10px; }
-        .breakdown-val { font-size: 12px; font-weight: bold; }
-        .memo-box { background: #fff; padding: 12px; border-radius: 10px; margin-bottom: 8px; box-shadow: 0 1px 3px rgba(0,0,0,0.1); }
-        .memo-header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 6px; border-bottom: 1px solid #f2f2f7; padding-bottom: 6px; }
-        .memo-title { font-weight: bold; font-size: 13px; }
-        .memo-title a { color: #007aff; text-decoration: none; }
-        .earnings-badge { background: #f0f7ff; color: #007aff; font-size: 10px; padding: 2px 8px; border-radius: 10px; font-weight: bold; border: 1px solid #cce5ff; }
-        .memo-market-val { margin: 8px 0; font-size: 12px; display: flex; justify-content: space-between; }
-        .memo-text { font-size: 12px; color: #3a3a3c; white-space: pre-wrap; line-height: 1.5; background: #f9f9f9; padding: 10px; border-radius: 6px; border: 1px solid #eee; }
-    </style>
-</head>
-<body>
-    <div class="container">
-        {% set actual_profit = total_profit + realized_gain + dividend + trust_return %}
-        <div class="summary">
-            <div class="card"><small>評価損益</small><div class="{{ 'plus' if total_profit >= 0 else 'minus' }}">¥{{ "{:,}".format(total_profit) }}</div></div>
-            <div class="card"><small>年配当予想</small><div style="color: #007aff;">¥{{ "{:,}".format(total_dividend_income) }}</div></div>
-        </div>
-        <div class="summary">
-            <div class="card">
-                <div class="breakdown-row"><span class="breakdown-label">実利</span><span class="{{ 'plus' if realized_gain >= 0 else 'minus' }} breakdown-val">¥{{ "{:,}".format(realized_gain|int) }}</span></div>
-                <div class="breakdown-row"><span class="breakdown-label">配当金</span><span style="color:#007aff;" class="breakdown-val">¥{{ "{:,}".format(dividend|int) }}</span></div>
-                <div class="breakdown-row"><span class="breakdown-label">投信リターン</span><span class="{{ 'plus' if trust_return >= 0 else 'minus' }} breakdown-val">¥{{ "{:,}".format(trust_return|int) }}</span></div>
-            </div>
-            <div class="card">
-                <small>総資産合計</small>
-                <div style="color: #1c1c1e; margin-bottom: 6px;">¥{{ "{:,}".format(total_assets) }}</div>
-                <hr style="border: 0; border-top: 1px solid #f2f2f7; margin: 4px 0;">
-                <small style="margin-top: 4px;">実利（全損益合計）</small>
-                <div class="{{ 'plus' if actual_profit >= 0 else 'minus' }}">¥{{ "{:,}".format(actual_profit|int) }}</div>
-            </div>
-        </div>
+        error_log.report("holdings_sheet", "保有銘柄シート取得エラー", e)
+        raise
+    symbol_markets = {t["symbol"]: t["market"] for t in tickers.values()}
+    currencies = {t["currency"] for t in tickers.values()}
+    
+    # 期限切れの銘柄・為替だけをダウンロード（USDJPY は常に表示するので必ず含める）
+    quotes, fx_rates = quote_cache.get(symbol_markets, currencies | {"USD"}, force=force_quotes)
+    usdjpy = fx_rates["USD"]
+    results = []
+    today = today_jst()
+    rates = {}
+    prices_jpy = {}
+    
+    for h in holdings.itertuples():
+        c = h.Index
+        ticker = tickers[c]
+        is_us_stock = ticker["is_us"]
+        price, day_change, day_change_pct = quotes[ticker["symbol"]]
+
+        annual_div = h.annual_div
+        buy_price = h.buy_price
+        qty = int(h.qty)
+
+        rate = fx_rates.get(ticker["currency"], 0.0)
         
-        <div class="tabs">
-            <button class="tab active" onclick="tab('list')">資産状況</button>
-            <button class="tab" onclick="tab('memo')">メモ / 決算日</button>
-        </div>
-
-        <div id="list" class="content active">
-            <div class="table-wrap">
-                <table id="stock-table">
-                    <thead>
-                        <tr>
-                            <th style="width:20%">銘柄</th>
-                            <th style="width:20%">現在/取得</th>
-                            <th style="width:20%">前日/比率</th>
-                            <th style="width:20%">評価損益</th>
-                            <th style="width:20%">取得/現利</th>
-                        </tr>
-                    </thead>
-                    <tbody>
-                        {% for r in results %}
-                        <tr>
-                            <td class="name-td">
-                                <a href="{{ r.link_url }}" target="_blank">{{ r.name }}</a>{% if r.is_us %}<span class="us-badge">米</span>{% endif %}<br>
-                                <span class="small-gray">{{ r.qty }}株</span>
-                            </td>
-                            <td><strong>{{ "{:,}".format(r.price|int) }}</strong><br><span class="small-gray">{{ "{:,}".format(r.buy_price|int) }}</span></td>
-                            <td class="{{ 'plus' if r.day_change >= 0 else 'minus' }}" data-sort="{{ r.day_change }}">
-                                {{ "{:+,}".format(r.day_change|int) }}<br><span>{{ "{:+.2f}".format(r.day_change_pct) }}%</span>
-                            </td>
-                            <td class="{{ 'plus' if r.profit >= 0 else 'minus' }}" data-sort="{{ r.profit }}">
-                                {{ "{:+,}".format(r.profit) }}<br><span>{{ r.profit_pct }}%</span>
-                            </td>
-                            <td data-sort="{{ r.buy_yield }}"><strong>{{ r.buy_yield }}%</strong><br><span class="small-gray">{{ r.cur_yield }}%</span></td>
-                        </tr>
-                        {% endfor %}
-                    </tbody>
-                </table>
-            </div>
-        </div>
-
-        <div id="memo" class="content">
-            <div class="ctrl-panel">
-                <select id="memo-sort" onchange="sortMemos()">
-                    <option value="code">コード順</option>
-                    <option value="earnings">決算日順</option>
-                    <option value="profit">損益(多)順</option>
-                    <option value="market_value">評価額(大)順</option>
-                </select>
-                <a href="/?update_earnings=1" class="btn-update" onclick="this.innerText='更新中...'">シート反映</a>
-            </div>
-            <div id="memo-container">
-                {% for r in results %}
-                <div class="memo-box" data-code="{{ r.code }}" data-earnings="{{ r.earnings }}" data-profit="{{ r.profit }}" data-market_value="{{ r.market_value }}">
-                    <div class="memo-header">
-                        <span class="memo-title">
-                            <a href="{{ r.link_url }}" target="_blank">{{ r.full_name }} ({{ r.code }})</a>{% if r.is_us %}<span class="us-badge">米国株</span>{% endif %}
-                        </span>
-                        <span class="earnings-badge">決算: {{ r.display_earnings }}</span>
-                    </div>
-                    <div class="memo-market-val">
-                        <span>評価額: <strong>¥{{ "{:,}".format(r.market_value) }}</strong> <small class="small-gray">({{ r.qty }}株)</small></span>
-                        <span class="{{ 'plus' if r.profit >= 0 else 'minus' }}">{{ "{:+,}".format(r.profit) }} ({{ r.profit_pct }}%)</span>
-                    </div>
-                    <div class="memo-text">{{ r.memo if r.memo else '---' }}</div>
-                </div>
-                {% endfor %}
-            </div>
-        </div>
-
-        <p style="text-align:center; margin-top: 20px; color:#8e8e93; font-size:11px;">
-            適用為替レート: 1ドル = ￥{{ usdjpy }}<br>
-            <a href="/" style="color:#007aff; text-decoration:none; font-weight:bold; font-size:12px; display:inline-block; margin-top:8px;">最新の情報に更新</a>
-        </p>
-    </div>
-
-    <script>
-        function tab(id) {
-            document.querySelectorAll('.content').forEach(c => c.classList.remove('active'));
-            document.querySelectorAll('.tab').forEach(t => t.classList.remove('active'));
-            document.getElementById(id).classList.add('active');
-            event.currentTarget.classList.add('active');
-        }
-        function sortMemos() {
-            const container = document.getElementById('memo-container');
-            const memos = Array.from(container.getElementsByClassName('memo-box'));
-            const sortBy = document.getElementById('memo-sort').value;
-            memos.sort((a, b) => {
-                let valA = a.getAttribute('data-' + sortBy);
-                let valB = b.getAttribute('data-' + sortBy);
-                if (sortBy === 'profit' || sortBy === 'market_value') { return parseFloat(valB) - parseFloat(valA); }
-                return valA.localeCompare(valB);
-            });
-            memos.forEach(m => container.appendChild(m));
+        price_jpy = price * rate
+        buy_price_jpy = buy_price * rate
+        annual_div_jpy = annual_div * rate
+        day_change_jpy = day_change * rate
+        rates[c] = rate
+        prices_jpy[c] = price_jpy
+
+        profit = int((price_jpy - buy_price_jpy) * qty) if price > 0 else 0
+        market_value = int(price_jpy * qty)
+        div_amt = int(annual_div_jpy * qty)
+
+        display_earnings = "---" if pd.isna(h.earnings) else str(h.earnings)
+        if display_earnings == "nan" or display_earnings == "":
+            display_earnings = "---"
+
+        earnings_date = parse_earnings_date(display_earnings, today)
+        earnings_sort = earnings_date.isoformat() if earnings_date else EARNINGS_SORT_SENTINEL
+        name = "" if pd.isna(h.name) else str(h.name)
+        
+        results.append({
+            "code": c, "name": name[:4], "full_name": name,
+            "price": price_jpy, "buy_price": buy_price_jpy, "qty": qty, "local_price": price,
+            "market_value": market_value,
+            "day_change": day_change_jpy, "day_change_pct": round(day_change_pct, 2),
+            "profit": profit, "profit_pct": round(((price_jpy - buy_price_jpy) / buy_price_jpy * 100), 1) if buy_price_jpy > 0 else 0,
+            "memo": h.memo,
+            "earnings": earnings_sort, "display_earnings": display_earnings,
+            "earnings_date": earnings_date,
+            "buy_yield": round((annual_div_jpy / buy_price_jpy * 100), 2) if buy_price_jpy > 0 else 0,
+            "cur_yield": round((annual_div_jpy / price_jpy * 100), 2) if price_jpy > 0 else 0,
+            "div_amt": div_amt,
+            "div_per_share": annual_div_jpy,
+            "rate": rate,
+            "link_url": ticker["link_url"],
+            "symbol": ticker["symbol"],
+            "is_us": is_us_stock,
+            "market": ticker["market"],
+            "currency": ticker["currency"],
+            "lots": []
+        })
+
+    # 複数ロットの内訳（ロット単位の損益はまとめて計算）
+    breakdown = lot_breakdown(lots, prices_jpy, rates)
+    for r in results:
+        r["lots"] = breakdown.get(r["code"], [])
+        # 基本情報はキャッシュにあるものだけを使う（取得は裏で行う）
+        fundamentals = fundamentals_store.get(r["symbol"])
+        r["per"] = fundamentals.get("per")
+        r["pbr"] = fundamentals.get("pbr")
+        r["market_cap"] = format_market_cap(fundamentals.get("market_cap"), rates.get(r["code"], 0.0))
+        r["sector"] = fundamentals.get("sector") or ""
+        r["long_name"] = fundamentals.get("long_name") or r["full_name"]
+    fundamentals_store.refresh_async([r["symbol"] for r in results])
+
+    # アラートのルールは既定ユーザーのもの
+    if portfolio.user_id == DEFAULT_USER:
+        try:
+            alert_engine.evaluate(results, today)
+        except Exception as e:
+            error_log.report("alerts", "アラート評価エラー", e)
+
+    # 配当履歴は裏で取得し、手元にある履歴で月別の受取予定を組み立てる
+    dividend_store.refresh_async([r["symbol"] for r in results if r["div_amt"] > 0])
+    dividend_calendar = portfolio.dividend_projector.project(results, dividend_store, today)
+
+    # 税引後の損益・配当（口座区分はロット単位）
+    taxes = after_tax(results, lots)
+    for r in results:
+        r["net_profit"], r["net_div_amt"] = taxes["by_code"].get(r["code"], (0, 0))
+        r["net_buy_yield"] = round(r["net_div_amt"] / (r["buy_price"] * r["qty"]) * 100, 2) if r["buy_price"] > 0 and r["qty"] > 0 else 0
+
+    for r in results:
+        r["fragment_key"] = holding_hash(r)
+
+    # 日次の運用成績を記録し、ベンチマーク指数の日足は裏で取り足す
+    portfolio.performance_tracker.record(results, today)
+    price_store.refresh_async(list(BENCHMARKS))
+
+    total_profit = sum(r['profit'] for r in results)
+    total_div = sum(r['div_amt'] for r in results)
+    total_assets = sum(r['market_value'] for r in results)
+    realized_gain, dividend, trust_return = get_extra_gains(portfolio)
+
+    return {
+        "last_update": time.time(),
+        "results": results,
+        "total_profit": total_profit,
+        "total_div": total_div,
+        "total_assets": total_assets,
+        "realized_gain": realized_gain,
+        "dividend": dividend,
+        "trust_return": trust_return,
+        "usdjpy": usdjpy,
+        "fx_rates": fx_rates,
+        "valuation": valuation_frame(results),
+        "allocation": allocation_breakdown(results, lots),
+        "net_total_profit": taxes["net_total_profit"],
+        "net_total_div": taxes["net_total_div"],
+        "earnings_index": EarningsIndex(results),
+        "dividend_calendar": dividend_calendar
+    }
+
+# --- スナップショット再構築のプロファイル ---
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+PROFILE_KEEP = 20
+# 1 にすると全ての再構築を記録する（既定では管理者の ?profile=1 の時だけ。無効時は分岐 1 つ分のコストしかない）
+PROFILE_REBUILDS = os.environ.get("PROFILE_REBUILDS") == "1"
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+def is_admin():
+    """ADMIN_TOKEN が設定され、?token= か X-Admin-Token ヘッダが一致する時だけ True"""
+    supplied = request.args.get("token") or request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode())
+
+class RebuildProfiler:
+    """再構築を cProfile で計測し、.prof（snakeviz などで開ける）と累積時間順の要約を保存する。
+    新しい順に keep 件だけ残す"""
+
+    def __init__(self, directory=PROFILE_DIR, keep=PROFILE_KEEP):
+        self.directory = os.path.abspath(directory)
+        self.keep = keep
+        self.active = threading.Lock()  # cProfile は同時に 1 つだけ
+
+    def run(self, trigger, fn, *args, **kwargs):
+        if not self.active.acquire(blocking=False):
+            return fn(*args, **kwargs)
+        import cProfile
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            return profiler.runcall(fn, *args, **kwargs)
+        finally:
+            self.active.release()
+            try:
+                self.save(profiler, trigger, time.perf_counter() - started)
+            except Exception as e:
+                error_log.report("profiler", "プロファイル保存エラー", e)
+
+    def save(self, profiler, trigger, duration):
+        import pstats
+        os.makedirs(self.directory, exist_ok=True)
+        name = datetime.now(JST).strftime("%Y%m%d-%H%M%S-%f")
+        base = os.path.join(self.directory, name)
+        profiler.dump_stats(base + ".prof")
+        text = io.StringIO()
+        stats = pstats.Stats(profiler, stream=text)
+        stats.sort_stats("cumulative").print_stats(40)
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(text.getvalue())
+        # 自分の時間が長い関数の上位（一覧で原因の見当をつける用）
+        top = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:5]
+        meta = {
+            "name": name,
+            "trigger": trigger,
+            "duration_ms": round(duration * 1000, 1),
+            "top_self_time": [{"function": f"{os.path.basename(path)}:{line}({func})", "seconds": round(tt, 4)}
+                              for (path, line, func), (_, _, tt, _, _) in top],
         }
-        new Tablesort(document.getElementById('stock-table'));
-    </script>
-</body>
-</html>
-"""
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        self.prune()
+
+    def names(self):
+        try:
+            return sorted((f[:-5] for f in os.listdir(self.directory) if f.endswith(".json")), reverse=True)
+        except FileNotFoundError:
+            return []
+
+    def prune(self):
+        for name in self.names()[self.keep:]:
+            for ext in (".json", ".prof", ".txt"):
+                try:
+                    os.remove(os.path.join(self.directory, name + ext))
+                except FileNotFoundError:
+                    pass
+
+    def recent(self, limit=PROFILE_KEEP):
+        out = []
+        for name in self.names()[:limit]:
+            try:
+                with open(os.path.join(self.directory, name + ".json"), encoding="utf-8") as f:
+                    out.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return out
+
+    def path(self, name, ext):
+        if name not in self.names():
+            return None
+        return os.path.join(self.directory, name + ext)
+
+rebuild_profiler = RebuildProfiler()
+
+SNAPSHOT_RETRY_BACKOFF = 60  # 作り直しに失敗したら、この秒数は取り直さずに最後の成功分を使う
+
+def snapshot_fresh(portfolio):
+    snapshot = portfolio.snapshot
+    return bool(snapshot["results"]) and time.time() - snapshot["last_update"] < CACHE_TIMEOUT
+
+def refresh_snapshot(portfolio, force_quotes=False, profile=None):
+    """スナップショットを作り直す。待っている間に他のリクエストが作り直していれば、それを使う。
+    profile（記録のきっかけ）を渡すか PROFILE_REBUILDS=1 なら、作り直しをプロファイルに残す"""
+    status = portfolio.status
+    with portfolio.lock:
+        if not (profile or force_quotes or not snapshot_fresh(portfolio)):
+            return portfolio.snapshot
+        if not profile and time.time() - status["failed_at"] < SNAPSHOT_RETRY_BACKOFF:
+            # 失敗直後に更新を連打されても上流へ取りに行かない
+            if portfolio.snapshot["results"]:
+                return portfolio.snapshot
+            raise RuntimeError(status["error"])
+        trigger = profile or ("env" if PROFILE_REBUILDS else None)
+        error_log.begin_collect()
+        try:
+            if trigger:
+                snapshot = rebuild_profiler.run(trigger, build_snapshot, portfolio, force_quotes=force_quotes)
+            else:
+                snapshot = build_snapshot(portfolio, force_quotes=force_quotes)
+        except Exception as e:
+            error_log.end_collect()
+            error_log.report("snapshot", f"スナップショット作成エラー ({portfolio.user_id})", e)
+            status.update(failed_at=time.time(), error=str(e))
+            if portfolio.snapshot["results"]:
+                return portfolio.snapshot  # 最後に作れたスナップショットを警告付きで出し続ける
+            raise
+        # 作れたが一部の取得元が失敗した（代替値を使った）場合は、その取得元を画面に出す
+        snapshot["warnings"] = error_log.end_collect()
+        status.update(failed_at=0, error=None)
+        portfolio.snapshot = snapshot
+        return snapshot
+
+def refresh_snapshot_async(portfolio):
+    """期限切れのスナップショットを裏で作り直す（すでに実行中なら何もしない）"""
+    if not portfolio.refreshing.acquire(blocking=False):
+        return
+    def run():
+        try:
+            refresh_snapshot(portfolio)
+        except Exception:
+            pass  # refresh_snapshot の中で記録済み
+        finally:
+            portfolio.refreshing.release()
+    threading.Thread(target=run, name=f"snapshot-refresh-{portfolio.user_id}", daemon=True).start()
+
+# --- 強制更新（?update_earnings=1）の回数制限 ---
+FORCE_REFRESH_WINDOW = 600      # この秒数あたりの回数で制限する
+FORCE_REFRESH_PER_CLIENT = 3    # 1 クライアントあたり
+FORCE_REFRESH_GLOBAL = 10       # 全体
+FORCE_REFRESH_DEBOUNCE = 30     # 直近の強制更新からこの秒数以内（または実行中）なら、その結果に相乗りする
+
+FORCE_REFRESH_STATE_FILE = os.path.join(DATA_DIR, "forced_refresh.json")
+
+class RefreshLimiter:
+    """強制更新をクライアントごと・全体の回数で制限する。実行中や直後の強制更新には相乗りさせ、
+    シート全体と全銘柄の株価を取り直す回数を抑える（Yahoo に制限されると全員が困る）。
+    回数と実行中の印は state ファイルに置き、ワーカー間でロックファイルを使って共有する
+    （fcntl がない環境ではワーカーごとの制限になる）"""
+
+    def __init__(self, path=FORCE_REFRESH_STATE_FILE, window=FORCE_REFRESH_WINDOW,
+                 per_client=FORCE_REFRESH_PER_CLIENT, global_limit=FORCE_REFRESH_GLOBAL,
+                 debounce=FORCE_REFRESH_DEBOUNCE, poll_interval=0.2):
+        self.path = path
+        self.window = window
+        self.per_client = per_client
+        self.global_limit = global_limit
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.running_timeout = SHEET_FETCH_TIMEOUT * 4  # これより古い実行中の印は落ちたワーカーの残りとみなす
+        self.done = {}  # ポートフォリオ -> このワーカーで実行中の強制更新が終わったら set される Event
+        self.lock = threading.Lock()
+        self.stats = {"run": 0, "joined": 0, "limited": 0}
+
+    def _file_lock(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        lock = open(self.path + ".lock", "w")
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _load(self):
+        """{"events": [[時刻, クライアント], ...], "running": {ポートフォリオ: 開始時刻}, "last_started": {...}}"""
+        state = {"events": [], "running": {}, "last_started": {}}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            error_log.report("config", f"{self.path} 読込エラー", e)
+        return state
+
+    def _save(self, state):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def acquire(self, client, key=DEFAULT_USER, now=None):
+        """("run", 0) なら呼び出し側が更新して finish() を呼ぶ。("join", 0) は同じポートフォリオの実行中・直後の
+        更新を使う（実行中なら wait_joined() で終わりを待つ）。("limit", 秒) は制限超過で、その秒数後なら受け付ける"""
+        now = now or time.time()
+        with self.lock, self._file_lock():
+            state = self._load()
+            started = state["running"].get(key)
+            if started is not None and now - started >= self.running_timeout:
+                started = None
+            if started is not None or now - state["last_started"].get(key, 0.0) < self.debounce:
+                self.stats["joined"] += 1
+                return "join", 0
+            events = [(t, c) for t, c in state["events"] if t > now - self.window]
+            mine = [t for t, c in events if c == client]
+            retry_after = 0
+            if len(mine) >= self.per_client:
+                retry_after = mine[0] + self.window - now
+            if len(events) >= self.global_limit:
+                retry_after = max(retry_after, events[0][0] + self.window - now)
+            if retry_after > 0:
+                self.stats["limited"] += 1
+                return "limit", int(retry_after) + 1
+            events.append((now, client))
+            state["events"] = events
+            state["running"][key] = now
+            state["last_started"][key] = now
+            self._save(state)
+            self.done[key] = threading.Event()
+            self.stats["run"] += 1
+            return "run", 0
+
+    def finish(self, key=DEFAULT_USER):
+        with self.lock:
+            try:
+                with self._file_lock():
+                    state = self._load()
+                    state["running"].pop(key, None)
+                    self._save(state)
+            except Exception as e:
+                error_log.report("config", f"{self.path} 書込エラー", e)
+            self.done[key].set()
+
+    def wait_joined(self, key=DEFAULT_USER, timeout=None):
+        """同じワーカーの実行なら Event を、別のワーカーの実行なら state ファイルの印が消えるのを待つ"""
+        timeout = self.running_timeout if timeout is None else timeout
+        with self.lock:
+            done = self.done.get(key)
+        if done is not None and not done.is_set():
+            return done.wait(timeout)
+        deadline = time.time() + timeout
+        while True:
+            with self._file_lock():
+                started = self._load()["running"].get(key)
+            if started is None or time.time() - started >= self.running_timeout:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+
+refresh_limiter = RefreshLimiter()
+
+def client_id():
+    """接続元 IP。プロキシ越しの時は ProxyFix が信用できる段の X-Forwarded-For に置き換えている"""
+    return request.remote_addr or ""
+
+def forced_snapshot(portfolio):
+    """回数制限を通した強制更新。相乗りの時は実行中の作り直しが終わるのを待ってその結果を返す。
+    制限超過なら (None, 再試行までの秒数)"""
+    key = portfolio.user_id
+    action, retry_after = refresh_limiter.acquire(client_id(), key)
+    if action == "limit":
+        return None, retry_after
+    if action == "join":
+        refresh_limiter.wait_joined(key)
+        return refresh_snapshot(portfolio), 0
+    try:
+        return refresh_snapshot(portfolio, force_quotes=True), 0
+    finally:
+        refresh_limiter.finish(key)
+
+def current_portfolio():
+    """?user=ID（以後は Cookie で覚える）のポートフォリオ。指定がなければ既定ユーザー。
+    ?user= の ID が未登録なら 404。Cookie の ID が消されていたら既定ユーザーに戻す（Cookie は after_request で消す）"""
+    user_id = request.args.get("user")
+    if user_id:
+        portfolio = portfolios.get(user_id)
+        if portfolio is None:
+            abort(404)
+        return portfolio
+    return portfolios.get(request.cookies.get(USER_COOKIE) or DEFAULT_USER) or portfolios.get(DEFAULT_USER)
+
+@app.after_request
+def remember_portfolio(resp):
+    user_id = request.args.get("user")
+    if user_id and portfolios.get(user_id) is not None and request.cookies.get(USER_COOKIE) != user_id:
+        resp.set_cookie(USER_COOKIE, user_id, max_age=365 * 24 * 3600, httponly=True, samesite="Lax")
+    elif not user_id and request.cookies.get(USER_COOKIE) and portfolios.get(request.cookies[USER_COOKIE]) is None:
+        resp.delete_cookie(USER_COOKIE, httponly=True, samesite="Lax")
+    return resp
+
+def get_snapshot(portfolio=None, force_update=False, profile=False):
+    """キャッシュがあればそれを返す。期限切れなら手元の値を返しつつ裏で作り直し、
+    シートや株価の取得で閲覧者を待たせない。初回と強制更新・プロファイル指定の時だけその場で作る"""
+    portfolio = portfolio or current_portfolio()
+    if profile:
+        return refresh_snapshot(portfolio, force_quotes=force_update, profile="request"), False
+    if not force_update and portfolio.snapshot["results"]:
+        if not snapshot_fresh(portfolio):
+            refresh_snapshot_async(portfolio)
+        return portfolio.snapshot, True
+    return refresh_snapshot(portfolio, force_quotes=force_update), False
+
+def int_arg(name, default):
+    """クエリ文字列の整数引数。整数でなければ 400 で打ち切る"""
+    try:
+        return int(request.args.get(name, default))
+    except ValueError:
+        abort(Response(json.dumps({"error": f"{name} は整数で指定してください"}, ensure_ascii=False),
+                       status=400, mimetype="application/json"))
+
+def error_page(e):
+    """表示できるスナップショットが 1 つもない時だけ使う。キャッシュさせないよう 503 で返す。
+    例外の文面にはシートの URL が入ることがあるので画面には種類だけ出す（詳細は管理者が /api/errors で見る）"""
+    if isinstance(e, HTTPException):
+        raise e  # 未登録ユーザーの 404 などはそのまま返す
+    error_log.report("page", f"{request.path} の表示エラー", e)
+    return f"システムエラー: データを取得できませんでした（{type(e).__name__}）", 503
+
+@app.route("/")
+def index():
+    force_update = request.args.get('update_earnings') == '1'
+    profile = request.args.get('profile') == '1' and is_admin()
+    portfolio = current_portfolio()
+
+    try:
+        if force_update and not profile:
+            snapshot, retry_after = forced_snapshot(portfolio)
+            if snapshot is None:
+                return Response(f"更新の回数が多すぎます。{retry_after} 秒後にもう一度お試しください。", status=429,
+                                mimetype="text/plain", headers={"Retry-After": str(retry_after)})
+        else:
+            snapshot, _ = get_snapshot(portfolio, force_update, profile=profile)
+        # 実利シートはスナップショットの再構築（裏スレッド）で取り直すので、表示中はシートを待たない
+        realized_gain, dividend, trust_return = snapshot["realized_gain"], snapshot["dividend"], snapshot["trust_return"]
+        sparklines = intraday_store.sparklines([r["symbol"] for r in snapshot["results"]]) if INTRADAY_MODE else {}
+        return render_template("index.html",
+                               portfolio_name=portfolio.name,
+                               row_fragments=portfolio.row_fragments.render(snapshot["results"], sparklines),
+                               memo_fragments=portfolio.memo_fragments.render(snapshot["results"]),
+                               total_profit=snapshot["total_profit"], net_total_profit=snapshot["net_total_profit"],
+                               total_dividend_income=snapshot["total_div"], net_total_div=snapshot["net_total_div"],
+                               total_assets=snapshot["total_assets"],
+                               realized_gain=realized_gain, dividend=dividend, trust_return=trust_return,
+                               usdjpy=round(snapshot.get("usdjpy", 160.0), 2),
+                               dividend_calendar=snapshot["dividend_calendar"],
+                               allocation=snapshot["allocation"], allocation_dimensions=ALLOCATION_DIMENSIONS,
+                               degraded=portfolio.status["error"] is not None,
+                               updated_at=datetime.fromtimestamp(snapshot["last_update"], JST).strftime("%m/%d %H:%M"),
+                               warnings=[ERROR_SOURCE_LABELS.get(s, s) for s in snapshot.get("warnings", [])])
+    except Exception as e:
+        return error_page(e)
+
+@app.route("/assets/<filename>")
+def asset(filename):
+    return asset_pipeline.response(filename, request.headers.get("Accept-Encoding", ""))
+
+@app.route("/earnings")
+def earnings():
+    range_key = request.args.get('range', '30d')
+    if range_key not in EARNINGS_RANGES:
+        range_key = '30d'
+    try:
+        snapshot, _ = get_snapshot()
+        entries = query_earnings(snapshot["earnings_index"], range_key)
+        return render_template("earnings.html", entries=entries, range_key=range_key,
+                               ranges=EARNINGS_RANGES, today=today_jst())
+    except Exception as e:
+        return error_page(e)
+
+@app.route("/earnings.ics")
+def earnings_ics():
+    try:
+        snapshot, _ = get_snapshot()
+        return Response(build_earnings_ics(snapshot["earnings_index"]), mimetype="text/calendar",
+                        headers={"Content-Disposition": "inline; filename=earnings.ics"})
+    except Exception as e:
+        return error_page(e)
+
+@app.route("/api/dividends")
+def dividends():
+    """月別の配当受取予定（スナップショットから返す）"""
+    try:
+        snapshot, _ = get_snapshot()
+        return snapshot["dividend_calendar"]
+    except Exception as e:
+        return error_page(e)
+
+@app.route("/api/fundamentals")
+def fundamentals():
+    """保有銘柄の基本情報（キャッシュ済みの値のみ）"""
+    results = current_portfolio().snapshot["results"] or []
+    return {r["code"]: fundamentals_store.get(r["symbol"]) for r in results}
+
+@app.route("/performance")
+def performance():
+    portfolio = current_portfolio()
+    try:
+        get_snapshot(portfolio)
+        comparison = portfolio.performance_tracker.comparison(price_store)
+        return render_template("performance.html", comparison=comparison, colors=CHART_COLORS)
+    except Exception as e:
+        return error_page(e)
+
+@app.route("/api/performance")
+def performance_api():
+    portfolio = current_portfolio()
+    try:
+        get_snapshot(portfolio)
+        comparison = portfolio.performance_tracker.comparison(price_store)
+        return {k: comparison[k] for k in ("dates", "series", "returns")}
+    except Exception as e:
+        return error_page(e)
+
+@app.route("/api/simulate", methods=["POST"])
+def simulate():
+    """売買シナリオ（複数可）を現在のスナップショットに適用した結果を返す。
+    {"scenarios": [{"name": ..., "trades": [{"code", "qty", "price"}]}]} または {"trades": [...]}"""
+    payload = request.get_json(silent=True) or {}
+    scenarios = payload.get("scenarios") or [{"name": "", "trades": payload.get("trades", [])}]
+    try:
+        snapshot, _ = get_snapshot()
+    except Exception as e:
+        return error_page(e)
+    try:
+        base = summarize_valuation(snapshot["valuation"])
+        out = []
+        for scenario in scenarios:
+            result = simulate_trades(snapshot["valuation"], scenario.get("trades", []), snapshot["fx_rates"])
+            result["name"] = scenario.get("name", "")
+            result["diff"] = {k: result[k] - base[k] for k in ("total_assets", "total_profit", "total_div")}
+            out.append(result)
+        return {"base": base, "scenarios": out}
+    except Exception as e:
+        return {"error": str(e)}, 400
+
+@app.route("/api/realized")
+def realized():
+    """実利台帳の集計（?year=2026&kind=realized|dividend|trust で銘柄別）。
+    台帳の同期はスナップショットの再構築で行うので、ここでは集計表を読むだけ"""
+    year = int_arg("year", today_jst().year)
+    kind = request.args.get("kind")
+    if kind and kind not in LEDGER_KINDS:
+        return {"error": f"kind は {', '.join(LEDGER_KINDS)} のいずれかで指定してください"}, 400
+    ledger = current_portfolio().ledger_store
+    return {"year": year, "by_ticker": ledger.by_ticker(year, kind), "by_year": ledger.by_year()}
+
+@app.route("/api/alerts")
+def alerts():
+    """最近発火したアラート（新しい順）"""
+    return {"alerts": alert_engine.recent(int_arg("limit", 50))}
+
+@app.route("/api/quote_stats")
+def quote_stats():
+    """相場キャッシュのヒット状況と、銘柄ごとの次回取得予定"""
+    now = time.time()
+    return {
+        "stats": quote_cache.stats,
+        "forced_refresh": refresh_limiter.stats,
+        "expires_in": {s: int(expires - now) for s, (_, expires) in quote_cache.entries.items()},
+    }
+
+@app.route("/api/profiles")
+def profiles():
+    """最近の再構築プロファイルの一覧（管理者のみ）"""
+    if not is_admin():
+        abort(403)
+    return {"profiles": rebuild_profiler.recent(int_arg("limit", PROFILE_KEEP))}
+
+@app.route("/api/profiles/<name>")
+def profile_detail(name):
+    """?format=prof で cProfile の生データ、既定は累積時間順の要約テキスト（管理者のみ）"""
+    if not is_admin():
+        abort(403)
+    fmt = request.args.get("format", "txt")
+    path = rebuild_profiler.path(name, ".prof" if fmt == "prof" else ".txt")
+    if path is None:
+        abort(404)
+    if fmt == "prof":
+        return send_file(path, mimetype="application/octet-stream", as_attachment=True, download_name=name + ".prof")
+    return send_file(path, mimetype="text/plain")
+
+@app.route("/api/errors")
+def errors():
+    """取得元ごとのエラー件数・直近のエラーと、最後に成功したスナップショットの状態（管理者のみ）。
+    エラーには全ユーザーのシート URL が含まれるので、管理者以外には見せない"""
+    if not is_admin():
+        abort(403)
+    portfolio = current_portfolio()
+    status = portfolio.status
+    last_update = portfolio.snapshot["last_update"]
+    return dict(error_log.summary(int_arg("limit", 50)), snapshot={
+        "degraded": status["error"] is not None,
+        "error": status["error"],
+        "failed_at": datetime.fromtimestamp(status["failed_at"], timezone.utc).isoformat(timespec="seconds")
+                     if status["failed_at"] else None,
+        "last_good": datetime.fromtimestamp(last_update, timezone.utc).isoformat(timespec="seconds")
+                     if last_update else None,
+        "warnings": portfolio.snapshot.get("warnings", []),
+    })
+
+@app.route("/api/users", methods=["GET", "POST"])
+def users():
+    """登録ユーザーの一覧と登録・更新（管理者のみ）。
+    POST {"id", "name", "holdings_url", "realized_url"}。閲覧は /?user=ID"""
+    if not is_admin():
+        abort(403)
+    if request.method == "POST":
+        payload = request.get_json(silent=True) or {}
+        try:
+            portfolio = portfolios.register(payload.get("id"), payload.get("name", ""),
+                                            payload.get("holdings_url", ""), payload.get("realized_url", ""))
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        return portfolio.describe(), 201
+    return {"users": [p.describe() for p in portfolios.all()]}
+
+@app.route("/api/users/<user_id>", methods=["DELETE"])
+def remove_user(user_id):
+    if not is_admin():
+        abort(403)
+    if not portfolios.remove(user_id):
+        abort(404)
+    return {"removed": user_id}
+
+@app.route("/api/sheet_stats")
+def sheet_stats():
+    """シート取得の転送量・解析時間の節約状況"""
+    portfolio = current_portfolio()
+    return {
+        "holdings": portfolio.holdings_fetcher.stats,
+        "realized": portfolio.realized_fetcher.stats,
+        "holdings_store": portfolio.holdings_store.stats if portfolio.holdings_store else None,
+    }
+
+@app.route("/api/http_stats")
+def http_stats():
+    """応答圧縮の件数と圧縮前後のバイト数"""
+    return response_compressor.stats
+
+CHART_COLORS = ["#007aff", "#ff9500", "#34c759", "#af52de"]
+
+if INTRADAY_MODE:
+    start_intraday_poller()
+
+if HOLDINGS_BACKEND == "sqlite":
+    start_holdings_sync()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
@@ -0,0 +1,28 @@
+# テスト共通設定: stock_check を読み込む前にデータ置き場を一時ディレクトリへ向ける
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("STOCK_DATA_DIR", tempfile.mkdtemp(prefix="stock-test-"))
+
+from fake_upstreams import FakeSheetServer, FakeYahoo, sample_holdings_csv, sample_realized_csv  # noqa: E402
+
+@pytest.fixture
+def fake_yahoo(monkeypatch):
+    """yf.download / yf.Ticker を見本データに差し替える"""
+    import stock_check as sc
+    yahoo = FakeYahoo()
+    monkeypatch.setattr(sc.yf, "download", yahoo.download)
+    monkeypatch.setattr(sc.yf, "Ticker", yahoo.ticker)
+    return yahoo
+
+@pytest.fixture
+def sheets():
+    """見本の保有銘柄シート・実利シートを配信するローカルサーバ"""
+    server = FakeSheetServer({"/holdings.csv": sample_holdings_csv(10), "/realized.csv": sample_realized_csv()}).start()
+    yield server
+    server.stop()
@@ -0,0 +1,46 @@
+import json
+from datetime import date
+
+import stock_check as sc
+
+TODAY = date(2025, 6, 2)
+
+def row(price):
+    return {"code": "7203", "full_name": "トヨタ自動車", "local_price": price, "day_change_pct": 0.0,
+            "buy_yield": 0.0, "earnings_date": None}
+
+def engine(tmp_path):
+    rules = tmp_path / "rules.json"
+    rules.write_text(json.dumps([{"code": "7203", "type": "price_above", "value": 3000}]))
+    return sc.AlertEngine(rules_file=str(rules), outbox_file=str(tmp_path / "outbox.jsonl"), webhook_url=None)
+
+def test_alert_fires_once_per_day(tmp_path):
+    alerts = engine(tmp_path)
+    assert len(alerts.evaluate([row(3100)], TODAY)) == 1
+    assert alerts.evaluate([row(2900)], TODAY) == []
+    assert alerts.evaluate([row(3200)], TODAY) == []          # 同じ日は再通知しない
+    assert len(alerts.evaluate([row(2900)], date(2025, 6, 3)) + alerts.evaluate([row(3300)], date(2025, 6, 3))) == 1
+    assert alerts.sent == {"7203:price_above:3000.0@2025-06-03"}  # 前日分は捨てる
+
+def test_workers_share_outbox_dedup(tmp_path):
+    # gunicorn の 2 ワーカーが同じルールを評価しても outbox には 1 件だけ
+    first, second = engine(tmp_path), engine(tmp_path)
+    assert len(first.evaluate([row(3100)], TODAY)) == 1
+    assert second.evaluate([row(3100)], TODAY) == []
+    assert len((tmp_path / "outbox.jsonl").read_text().splitlines()) == 1
+
+def test_alerts_limit_must_be_integer():
+    client = sc.app.test_client()
+    assert client.get("/api/alerts?limit=x").status_code == 400
+    assert client.get("/api/alerts?limit=5").status_code == 200
+
+def test_bad_rules_are_skipped(tmp_path):
+    rules = tmp_path / "rules.json"
+    rules.write_text(json.dumps([
+        {"code": "7203", "type": "price_above", "value": "abc"},
+        {"type": "price_above", "value": 1},
+        "price_above",
+        {"code": "7203", "type": "price_above", "value": 1},
+    ]))
+    alerts = sc.AlertEngine(rules_file=str(rules), outbox_file=str(tmp_path / "outbox.jsonl"), webhook_url=None)
+    assert [a["rule_id"] for a in alerts.evaluate([row(3100)], TODAY)] == ["7203:price_above:1.0"]
@@ -0,0 +1,23 @@
+import pytest
+
+import stock_check as sc
+
+@pytest.fixture
+def relative_build_dir(tmp_path, monkeypatch):
+    # リポジトリ以外のディレクトリから相対パスの置き場所で起動した場合
+    monkeypatch.chdir(tmp_path)
+    pipeline = sc.AssetPipeline(build_dir="data/assets")
+    monkeypatch.setattr(sc, "asset_pipeline", pipeline)
+    return pipeline
+
+@pytest.mark.parametrize("encoding, expected", [("", None), ("gzip", "gzip")])
+def test_hashed_asset_served_from_relative_build_dir(relative_build_dir, encoding, expected):
+    with sc.app.test_request_context():
+        url = relative_build_dir.url("app.js")
+    response = sc.app.test_client().get(url, headers={"Accept-Encoding": encoding})
+    assert response.status_code == 200
+    assert response.headers.get("Content-Encoding") == expected
+    assert "immutable" in response.headers["Cache-Control"]
+
+def test_unknown_asset_is_404(relative_build_dir):
+    assert sc.app.test_client().get("/assets/app.0000000000.js").status_code == 404
@@ -0,0 +1,57 @@
+from datetime import date
+
+import pytest
+
+import stock_check as sc
+
+TODAY = date(2025, 6, 1)
+
+@pytest.mark.parametrize("text, expected", [
+    ("2025/5/14", date(2025, 5, 14)),
+    ("2025/05/14", date(2025, 5, 14)),
+    ("2025-05-14", date(2025, 5, 14)),
+    ("2025.5.14", date(2025, 5, 14)),
+    ("2025年5月14日", date(2025, 5, 14)),
+    ("２０２５／５／１４", date(2025, 5, 14)),        # 全角
+    ("2025/5/14(水)", date(2025, 5, 14)),
+    ("2025/5/14 15:00", date(2025, 5, 14)),
+    ("7/30", date(2025, 7, 30)),
+    ("7/30(水)", date(2025, 7, 30)),
+    ("7月30日", date(2025, 7, 30)),
+    ("７月３０日", date(2025, 7, 30)),
+    ("5/14", date(2025, 5, 14)),                     # 少し前の日付は今年のまま
+    ("2/10", date(2026, 2, 10)),                     # 猶予より前なら翌年
+])
+def test_parse_earnings_date_formats(text, expected):
+    assert sc.parse_earnings_date(text, today=TODAY) == expected
+
+@pytest.mark.parametrize("text", [None, "", "nan", "---", "99/99", "未定", "2025/2/30", "13/1"])
+def test_parse_earnings_date_unparseable(text):
+    assert sc.parse_earnings_date(text, today=TODAY) is None
+
+def entry(code, day, name="テスト銘柄"):
+    return {"code": code, "earnings_date": day, "full_name": name,
+            "link_url": f"https://kabutan.jp/stock/?code={code}"}
+
+def test_earnings_index_ranges():
+    index = sc.EarningsIndex([
+        entry("7203", date(2025, 6, 5)),
+        entry("9432", date(2025, 6, 30)),
+        entry("6758", date(2025, 7, 2)),
+        {"code": "AAPL", "earnings_date": None},
+    ])
+    assert len(index) == 3
+    assert [r["code"] for r in sc.query_earnings(index, "7d", TODAY)] == ["7203"]
+    assert [r["code"] for r in sc.query_earnings(index, "month", TODAY)] == ["7203", "9432"]
+    assert [r["code"] for r in sc.query_earnings(index, "30d", TODAY)] == ["7203", "9432"]
+    assert [r["code"] for r in sc.query_earnings(index, "all", TODAY)] == ["7203", "9432", "6758"]
+
+def test_ics_lines_are_folded_to_75_octets():
+    name = "三菱ＵＦＪフィナンシャル・グループ株式会社（長い社名のテスト用）"
+    ics = sc.build_earnings_ics(sc.EarningsIndex([entry("8306", date(2025, 6, 5), name)]))
+    lines = ics.split("\r\n")
+    assert all(len(line.encode("utf-8")) <= 75 for line in lines)
+    # 折り返しを戻すと元の SUMMARY になる
+    unfolded = ics.replace("\r\n ", "")
+    assert f"SUMMARY:決算: {name} (8306)" in unfolded
+    assert "DTSTART;VALUE=DATE:20250605" in unfolded
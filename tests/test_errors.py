@@ -0,0 +1,39 @@
+import pytest
+
+import stock_check as sc
+
+SECRET_URL = "http://127.0.0.1:9/secret-sheet-id/h.csv"
+
+@pytest.fixture
+def failing_portfolio(monkeypatch):
+    portfolio = sc.portfolios.register("bob", "Bob", SECRET_URL)
+    monkeypatch.setattr(sc, "SNAPSHOT_RETRY_BACKOFF", 0)
+    yield portfolio
+    sc.portfolios.remove("bob")
+
+@pytest.fixture
+def admin_token(monkeypatch):
+    monkeypatch.setattr(sc, "ADMIN_TOKEN", "s3cret")
+    return "s3cret"
+
+def test_errors_require_admin(failing_portfolio, admin_token):
+    client = sc.app.test_client()
+    client.get("/?user=bob")
+    assert client.get("/api/errors").status_code == 403
+    response = client.get("/api/errors", headers={"X-Admin-Token": admin_token})
+    assert response.status_code == 200
+    assert response.get_json()["counts"]["holdings_sheet"] >= 1
+
+def test_error_page_hides_sheet_urls(failing_portfolio):
+    response = sc.app.test_client().get("/?user=bob")
+    assert response.status_code == 503
+    assert "secret-sheet-id" not in response.get_data(as_text=True)
+
+def test_report_logs_traceback(caplog):
+    try:
+        raise RuntimeError("boom")
+    except RuntimeError as e:
+        sc.error_log.report("test", "失敗", e)
+    record = caplog.records[-1]
+    assert record.getMessage() == "失敗: boom"
+    assert record.exc_info and record.exc_info[0] is RuntimeError
@@ -0,0 +1,41 @@
+import time
+
+import stock_check as sc
+from fake_upstreams import FakeFundamentalsProvider
+
+def store(tmp_path, provider):
+    return sc.FundamentalsStore(path=str(tmp_path / "fundamentals.json"), provider=provider, batch_pause=0)
+
+def test_refresh_caches_all_fields(tmp_path):
+    provider = FakeFundamentalsProvider()
+    fundamentals = store(tmp_path, provider)
+    fundamentals.refresh(["7203.T", "AAPL"])
+    assert provider.calls == ["7203.T", "AAPL"]
+    assert fundamentals.get("AAPL")["long_name"] == "AAPL Holdings"
+    assert fundamentals.due_symbols(["7203.T", "AAPL"]) == []
+    # ディスクから読み直しても同じ
+    assert store(tmp_path, provider).get("7203.T") == fundamentals.get("7203.T")
+
+def test_empty_info_is_not_cached(tmp_path):
+    fundamentals = store(tmp_path, lambda symbol: {})
+    fundamentals.refresh(["AAPL"])
+    assert fundamentals.get("AAPL") == {}
+    assert fundamentals.due_symbols(["AAPL"]) == ["AAPL"]
+
+def test_partial_info_keeps_existing_values(tmp_path):
+    fundamentals = store(tmp_path, FakeFundamentalsProvider())
+    fundamentals.refresh(["AAPL"])
+    before = fundamentals.get("AAPL")
+    fundamentals.provider = lambda symbol: {"trailingPE": 99}
+    fundamentals.refresh(["AAPL"])
+    assert fundamentals.get("AAPL") == dict(before, per=99)
+
+def test_missing_fields_are_not_refetched_every_rebuild(tmp_path):
+    # ETF のように PER が無い銘柄は、毎回の再構築ではなく FUNDAMENTALS_MISSING_RETRY 後に取り直す
+    fundamentals = store(tmp_path, lambda symbol: {"longName": "ETF", "sector": "Fund", "industry": "ETF",
+                                                   "marketCap": 10**12, "priceToBook": 1.0})
+    fundamentals.refresh(["1306.T"])
+    assert fundamentals.get("1306.T")["per"] is None
+    now = time.time()
+    assert fundamentals.due_symbols(["1306.T"], now=now + 60) == []
+    assert fundamentals.due_symbols(["1306.T"], now=now + sc.FUNDAMENTALS_MISSING_RETRY + 1) == ["1306.T"]
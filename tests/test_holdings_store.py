@@ -0,0 +1,44 @@
+import stock_check as sc
+from fake_upstreams import sample_holdings_csv
+
+CSV = sample_holdings_csv(10).encode()
+
+def test_same_body_does_not_bump_version(tmp_path, fake_yahoo):
+    path = str(tmp_path / "holdings.db")
+    store = sc.HoldingsStore(path)
+    frame = sc.read_holdings_frame(CSV)
+    assert store.read() is None
+    assert store.import_frame(frame, "digest-1")
+    assert not store.import_frame(frame, "digest-1")
+    # 別のワーカーが同じ本文を同期しても世代は進まない
+    assert not sc.HoldingsStore(path).import_frame(frame, "digest-1")
+    assert store.connect().execute("SELECT version FROM holdings_meta").fetchone()[0] == 1
+    assert (store.stats["syncs"], store.stats["imports"], store.stats["rows"]) == (2, 1, len(frame))
+
+def test_read_is_cached_until_version_changes(tmp_path, fake_yahoo):
+    path = str(tmp_path / "holdings.db")
+    store = sc.HoldingsStore(path)
+    store.import_frame(sc.read_holdings_frame(CSV), "digest-1")
+    first = store.read()
+    assert store.read() is first
+    assert (store.stats["reads"], store.stats["rebuilds"]) == (2, 1)
+
+    # 別のワーカーが新しい本文を取り込んだら、次の読み出しで集約し直す
+    sc.HoldingsStore(path).import_frame(sc.read_holdings_frame(sample_holdings_csv(5).encode()), "digest-2")
+    second = store.read()
+    assert second is not first and len(second[0]) < len(first[0])
+    assert store.stats["rebuilds"] == 2
+
+def test_sqlite_backend_syncs_only_changed_sheets(sheets, fake_yahoo, tmp_path, monkeypatch):
+    monkeypatch.setattr(sc, "HOLDINGS_BACKEND", "sqlite")
+    portfolio = sc.Portfolio("sqlite", "SQLite", sheets.url("/holdings.csv"), sheets.url("/realized.csv"),
+                             str(tmp_path / "sqlite"))
+    holdings = portfolio.load_holdings()
+    assert portfolio.load_holdings() is holdings
+    assert not sc.sync_holdings(portfolio)
+    assert portfolio.holdings_store.stats["imports"] == 1
+
+    sheets.sheets["/holdings.csv"] = sample_holdings_csv(5)
+    assert sc.sync_holdings(portfolio)
+    assert portfolio.load_holdings() is not holdings
+    assert portfolio.holdings_store.stats["rebuilds"] == 2
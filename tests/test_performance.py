@@ -0,0 +1,18 @@
+import pytest
+
+import stock_check as sc
+
+@pytest.fixture
+def failing_portfolio(monkeypatch):
+    portfolio = sc.portfolios.register("perf", "テスト", "http://127.0.0.1:9/h.csv")
+    monkeypatch.setattr(sc, "SNAPSHOT_RETRY_BACKOFF", 0)
+    yield portfolio
+    sc.portfolios.remove("perf")
+
+@pytest.mark.parametrize("path", ["/performance", "/api/performance"])
+def test_failed_first_build_is_503(failing_portfolio, path):
+    assert sc.app.test_client().get(f"{path}?user=perf").status_code == 503
+
+@pytest.mark.parametrize("path", ["/performance", "/api/performance"])
+def test_unknown_user_is_404(path):
+    assert sc.app.test_client().get(f"{path}?user=nobody").status_code == 404
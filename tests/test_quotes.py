@@ -0,0 +1,50 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import stock_check as sc
+from fake_upstreams import FakeYahoo
+
+# 土曜日（両市場とも閉まっていて、成功した値なら月曜まで持つ）
+SATURDAY = datetime(2025, 6, 7, 3, 0, tzinfo=timezone.utc)
+
+@pytest.fixture
+def yahoo_without_fx(monkeypatch):
+    yahoo = FakeYahoo()
+
+    def download(tickers, **kwargs):
+        return yahoo.download([t for t in tickers if not t.endswith("JPY=X")], **kwargs)
+
+    def ticker(symbol):
+        raise ConnectionError("throttled")
+
+    monkeypatch.setattr(sc.yf, "download", download)
+    monkeypatch.setattr(sc.yf, "Ticker", ticker)
+
+def test_usdjpy_fallback_is_not_cached(yahoo_without_fx):
+    cache = sc.QuoteCache()
+    sc.error_log.begin_collect()
+    quotes, fx_rates = cache.get({"AAPL": "US"}, {"USD"}, now=SATURDAY)
+    assert sc.error_log.end_collect() == ["fx"]
+    assert fx_rates["USD"] == sc.USDJPY_FALLBACK
+    value, expires = cache.entries["USDJPY=X"]
+    assert value == 0.0
+    assert expires - SATURDAY.timestamp() == sc.QUOTE_TTL_FAILED
+    # 株価は普通に次の寄り付きまでキャッシュされる
+    assert cache.entries["AAPL"][1] - SATURDAY.timestamp() > 86400
+
+def test_usdjpy_fallback_warns_while_failing(yahoo_without_fx):
+    cache = sc.QuoteCache()
+    cache.get({"AAPL": "US"}, {"USD"}, now=SATURDAY)
+    sc.error_log.begin_collect()
+    _, fx_rates = cache.get({"AAPL": "US"}, {"USD"}, now=SATURDAY)   # キャッシュから読んでも警告する
+    assert sc.error_log.end_collect() == ["fx"]
+    assert fx_rates["USD"] == sc.USDJPY_FALLBACK
+
+def test_pence_quotes_use_gbp_rate(monkeypatch):
+    yahoo = FakeYahoo()
+    monkeypatch.setattr(sc.yf, "download", yahoo.download)
+    cache = sc.QuoteCache()
+    _, fx_rates = cache.get({"VOD.L": "GB"}, {"GBp", "USD"}, now=SATURDAY)
+    assert "GBPJPY=X" in cache.entries and "GBpJPY=X" not in cache.entries
+    assert fx_rates["GBp"] == pytest.approx(fx_rates["GBP"] / 100)
@@ -0,0 +1,50 @@
+import pytest
+
+import stock_check as sc
+
+LEDGER_CSV = """項目,実利,配当金,予備,投信リターン
+合計,0,0,0,0
+日付,証券コード,銘柄,種別,金額
+2025/1/10,7203,トヨタ自動車,売却,12000
+2025/3/31,7203,トヨタ自動車,配当,3000
+2025/6/30,8306,三菱UFJ,配当,1500
+2024/12/20,1306,TOPIX ETF,投信,800
+"""
+
+def ledger_frame(csv):
+    return sc.parse_realized_csv(csv.encode())["ledger"]
+
+def test_ledger_totals_update_incrementally(tmp_path):
+    ledger = sc.LedgerStore(str(tmp_path / "ledger.db"))
+    assert ledger.sync(ledger_frame(LEDGER_CSV)) == (4, 0)
+    assert ledger.totals() == (12000.0, 4500.0, 800.0)
+    assert ledger.by_ticker(2025, "dividend") == [
+        {"code": "7203", "name": "トヨタ自動車", "kind": "dividend", "amount": 3000.0},
+        {"code": "8306", "name": "三菱UFJ", "kind": "dividend", "amount": 1500.0},
+    ]
+    # 1 行追加・1 行削除
+    changed = LEDGER_CSV.replace("2025/6/30,8306,三菱UFJ,配当,1500\n", "2025/7/1,9432,NTT,配当,500\n")
+    assert ledger.sync(ledger_frame(changed)) == (1, 1)
+    assert ledger.totals() == (12000.0, 3500.0, 800.0)
+    assert ledger.by_year() == {2024: {"realized": 0.0, "dividend": 0.0, "trust": 800.0},
+                                2025: {"realized": 12000.0, "dividend": 3500.0, "trust": 0.0}}
+
+@pytest.fixture
+def sheet_unreachable(monkeypatch):
+    portfolio = sc.portfolios.get(sc.DEFAULT_USER)
+
+    def fetch():
+        raise AssertionError("/api/realized はシートを取得しない")
+
+    monkeypatch.setattr(portfolio.realized_fetcher, "fetch", fetch)
+    return portfolio
+
+def test_api_realized_reads_the_store_only(sheet_unreachable):
+    client = sc.app.test_client()
+    response = client.get("/api/realized?year=2025")
+    assert response.status_code == 200
+    assert response.get_json()["year"] == 2025
+
+@pytest.mark.parametrize("query", ["year=abc", "kind=bogus"])
+def test_api_realized_rejects_bad_arguments(sheet_unreachable, query):
+    assert sc.app.test_client().get(f"/api/realized?{query}").status_code == 400
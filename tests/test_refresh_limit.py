@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+
+import stock_check as sc
+
+@pytest.fixture
+def portfolio(sheets, fake_yahoo, monkeypatch):
+    portfolio = sc.portfolios.register("limiter", "テスト", sheets.url("/holdings.csv"), sheets.url("/realized.csv"))
+    sc.refresh_snapshot(portfolio)
+    yield portfolio
+    sc.portfolios.remove("limiter")
+
+@pytest.fixture
+def rebuilds(monkeypatch):
+    """実際に走ったスナップショットの作り直しを数える（相乗りが重なるよう少し遅くする）"""
+    calls = []
+    build = sc.build_snapshot
+
+    def slow_build(portfolio, force_quotes=False):
+        calls.append(force_quotes)
+        time.sleep(0.3)
+        return build(portfolio, force_quotes=force_quotes)
+
+    monkeypatch.setattr(sc, "build_snapshot", slow_build)
+    return calls
+
+def forced(client, ip, spoofed="198.51.100.1"):
+    # Render はクライアントが送った X-Forwarded-For の末尾に接続元を足して渡してくる
+    return client.get("/?user=limiter&update_earnings=1", headers={"X-Forwarded-For": f"{spoofed}, {ip}"})
+
+def test_concurrent_forced_refreshes_join_one_rebuild(portfolio, rebuilds, monkeypatch, tmp_path):
+    monkeypatch.setattr(sc, "refresh_limiter", sc.RefreshLimiter(str(tmp_path / "forced.json")))
+    barrier = threading.Barrier(10)
+
+    def hit(i):
+        barrier.wait()
+        return forced(sc.app.test_client(), f"203.0.113.{i}").status_code
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        statuses = list(pool.map(hit, range(10)))
+    assert statuses == [200] * 10
+    assert rebuilds == [True]
+    assert sc.refresh_limiter.stats == {"run": 1, "joined": 9, "limited": 0}
+
+def test_per_client_limit_ignores_spoofed_forwarded_for(portfolio, rebuilds, monkeypatch, tmp_path):
+    monkeypatch.setattr(sc, "refresh_limiter", sc.RefreshLimiter(str(tmp_path / "forced.json"), debounce=0))
+    client = sc.app.test_client()
+    statuses = [forced(client, "203.0.113.7", spoofed=f"10.0.0.{i}").status_code for i in range(5)]
+    assert statuses == [200, 200, 200, 429, 429]
+    assert int(forced(client, "203.0.113.7").headers["Retry-After"]) > 0
+    # 別のクライアントはまだ受け付ける
+    assert forced(client, "203.0.113.8").status_code == 200
+
+def test_global_limit(portfolio, rebuilds, monkeypatch, tmp_path):
+    monkeypatch.setattr(sc, "refresh_limiter", sc.RefreshLimiter(str(tmp_path / "forced.json"), debounce=0, global_limit=4))
+    client = sc.app.test_client()
+    statuses = [forced(client, f"203.0.113.{i}").status_code for i in range(6)]
+    assert statuses == [200, 200, 200, 200, 429, 429]
+
+def test_workers_share_limits(tmp_path):
+    """ワーカーごとの RefreshLimiter でも、同じ state ファイルを見て全体・クライアントごとの回数を数える"""
+    path = str(tmp_path / "forced.json")
+    workers = [sc.RefreshLimiter(path, debounce=0, global_limit=3, per_client=2) for _ in range(2)]
+    now = time.time()
+    assert workers[0].acquire("a", "p1", now)[0] == "run"
+    workers[0].finish("p1")
+    assert workers[1].acquire("a", "p2", now + 1)[0] == "run"
+    workers[1].finish("p2")
+    # 同じクライアントは別のワーカーでも 3 回目で止まる
+    assert workers[0].acquire("a", "p3", now + 2)[0] == "limit"
+    assert workers[1].acquire("b", "p3", now + 3)[0] == "run"
+    workers[1].finish("p3")
+    # 全体の上限も 2 ワーカー合わせて 3 回
+    action, retry_after = workers[0].acquire("c", "p4", now + 4)
+    assert action == "limit" and retry_after > 0
+
+def test_forced_refresh_on_another_worker_is_joined(tmp_path):
+    path = str(tmp_path / "forced.json")
+    first, second = (sc.RefreshLimiter(path, poll_interval=0.05) for _ in range(2))
+    assert first.acquire("a", "p1") == ("run", 0)
+    assert second.acquire("b", "p1") == ("join", 0)
+    threading.Timer(0.3, first.finish, args=("p1",)).start()
+    started = time.time()
+    assert second.wait_joined("p1", timeout=5)
+    assert time.time() - started >= 0.2
+    assert second.stats == {"run": 0, "joined": 1, "limited": 0}
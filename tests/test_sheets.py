@@ -0,0 +1,57 @@
+import pytest
+
+import stock_check as sc
+from fake_upstreams import FakeSheetServer, sample_holdings_csv
+
+CSV = sample_holdings_csv(10)
+
+@pytest.fixture
+def server(request):
+    server = FakeSheetServer({"/h.csv": CSV}, conditional=getattr(request, "param", True)).start()
+    yield server
+    server.stop()
+
+def counting_parse(calls):
+    def parse(body):
+        calls.append(len(body))
+        return sc.parse_holdings_csv(body)
+    return parse
+
+def test_not_modified_reuses_parsed_result(server):
+    calls = []
+    fetcher = sc.SheetFetcher(server.url("/h.csv"), counting_parse(calls))
+    first, changed = fetcher.fetch()
+    assert changed
+    second, changed = fetcher.fetch()
+    assert not changed and second is first
+    assert calls == [len(CSV.encode())]
+    assert server.stats["not_modified"] == 1
+    stats = fetcher.stats
+    assert (stats["requests"], stats["not_modified"], stats["parsed"]) == (2, 1, 1)
+    assert stats["bytes_transferred"] == stats["bytes_saved"] == len(CSV.encode())
+    assert stats["parse_seconds_saved"] == pytest.approx(stats["parse_seconds"])
+
+@pytest.mark.parametrize("server", [False], indirect=True)
+def test_unchanged_body_is_not_parsed_again(server):
+    calls = []
+    fetcher = sc.SheetFetcher(server.url("/h.csv"), counting_parse(calls))
+    first, _ = fetcher.fetch()
+    second, changed = fetcher.fetch()
+    assert not changed and second is first
+    assert len(calls) == 1
+    stats = fetcher.stats
+    assert (stats["not_modified"], stats["unchanged_body"], stats["parsed"]) == (0, 1, 1)
+    assert stats["bytes_transferred"] == 2 * len(CSV.encode())
+
+def test_changed_body_is_parsed(server):
+    fetcher = sc.SheetFetcher(server.url("/h.csv"), sc.parse_holdings_csv)
+    fetcher.fetch()
+    server.sheets["/h.csv"] = sample_holdings_csv(12)
+    (holdings, _, _), changed = fetcher.fetch()
+    assert changed and len(holdings) == 12
+    assert fetcher.stats["parsed"] == 2
+
+def test_http_error_raises(server):
+    fetcher = sc.SheetFetcher(server.url("/missing.csv"), sc.parse_holdings_csv)
+    with pytest.raises(sc.requests.HTTPError):
+        fetcher.fetch()
@@ -0,0 +1,34 @@
+import pytest
+
+import stock_check as sc
+
+FX = {"JPY": 1.0, "USD": 150.0}
+
+def valuation():
+    return sc.valuation_frame([
+        {"code": "7203", "qty": 100, "buy_price": 2000.0, "price": 2500.0, "div_per_share": 80.0, "rate": 1.0, "market": "JP"},
+        {"code": "AAPL", "qty": 10, "buy_price": 150.0 * 150, "price": 200.0 * 150, "div_per_share": 1.0 * 150, "rate": 150.0, "market": "US"},
+    ])
+
+def test_buy_and_sell():
+    base = sc.summarize_valuation(valuation())
+    result = sc.simulate_trades(valuation(), [{"code": "7203", "qty": -50, "price": 3000},
+                                             {"code": "AAPL", "qty": 10, "price": None}], FX)
+    assert result["total_assets"] == base["total_assets"] - 50 * 2500 + 10 * 200 * 150
+    assert result["realized_gain"] == 50 * (3000 - 2000)
+
+def test_new_code_with_price_is_added(monkeypatch):
+    monkeypatch.setattr(sc, "quote_cache", sc.QuoteCache())
+    base = sc.summarize_valuation(valuation())
+    result = sc.simulate_trades(valuation(), [{"code": "9432", "qty": 100, "price": 150}], FX)
+    assert result["total_assets"] == base["total_assets"] + 100 * 150
+
+def test_new_code_without_price_is_rejected(monkeypatch):
+    monkeypatch.setattr(sc, "quote_cache", sc.QuoteCache())
+    with pytest.raises(ValueError, match="9999"):
+        sc.simulate_trades(valuation(), [{"code": "9999", "qty": 100}], FX)
+
+def test_new_code_without_fx_rate_is_rejected(monkeypatch):
+    monkeypatch.setattr(sc, "quote_cache", sc.QuoteCache())
+    with pytest.raises(ValueError, match="HKD"):
+        sc.simulate_trades(valuation(), [{"code": "0700.HK", "qty": 100, "price": 300}], FX)
@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+
+import stock_check as sc
+
+RESULTS = [
+    # price は円建て、ロットの buy_price は現地通貨建て
+    {"code": "7203", "market": "JP", "price": 3000.0, "rate": 1.0, "div_per_share": 100.0},
+    {"code": "KO", "market": "US", "price": 60.0 * 150, "rate": 150.0, "div_per_share": 2.0 * 150},
+]
+
+def lots(*rows):
+    return pd.DataFrame(rows, columns=["code", "qty", "buy_price", "account"])
+
+# (ロット, 銘柄別の (税引後損益, 税引後配当), ポートフォリオの税引後損益)
+CASES = [
+    # 特定口座: 利益と配当に 20.315%
+    ([("7203", 100, 2000.0, "特定")], {"7203": (int(100000 * (1 - 0.20315)), int(10000 * (1 - 0.20315)))},
+     int(100000 * (1 - 0.20315))),
+    # NISA: 非課税
+    ([("7203", 100, 2000.0, "NISA")], {"7203": (100000, 10000)}, 100000),
+    # NISA の米国株: 配当は米国の 10% 源泉だけかかる
+    ([("KO", 10, 50.0, "nisa")], {"KO": (15000, int(3000 * 0.9))}, 15000),
+    # 特定口座の米国株: 10% 源泉の後に 20.315%
+    ([("KO", 10, 50.0, "特定")], {"KO": (int(15000 * (1 - 0.20315)), int(3000 * 0.9 * (1 - 0.20315)))},
+     int(15000 * (1 - 0.20315))),
+    # 同じ銘柄の NISA と特定のロット
+    ([("7203", 100, 2000.0, "NISA"), ("7203", 100, 2500.0, "特定")],
+     {"7203": (100000 + int(50000 * (1 - 0.20315)), 10000 + int(10000 * (1 - 0.20315)))},
+     int(150000 - 50000 * 0.20315)),
+    # 課税口座内の損益通算: 7203 の +100,000 と KO の -45,000 を通算してから課税
+    ([("7203", 100, 2000.0, "特定"), ("KO", 10, 90.0, "特定")],
+     {"7203": (int(100000 * (1 - 0.20315)), int(10000 * (1 - 0.20315))),
+      "KO": (-45000, int(3000 * 0.9 * (1 - 0.20315)))},
+     int(55000 * (1 - 0.20315))),
+    # 課税口座が通算で損失なら税はかからない
+    ([("KO", 10, 90.0, "特定")], {"KO": (-45000, int(3000 * 0.9 * (1 - 0.20315)))}, -45000),
+]
+
+@pytest.mark.parametrize("rows, by_code, net_total_profit", CASES)
+def test_after_tax(rows, by_code, net_total_profit):
+    taxes = sc.after_tax(RESULTS, lots(*rows))
+    for code, (profit, div) in by_code.items():
+        assert taxes["by_code"][code] == (pytest.approx(profit, abs=1), pytest.approx(div, abs=1))
+    assert taxes["net_total_profit"] == pytest.approx(net_total_profit, abs=1)
+    assert taxes["net_total_div"] == pytest.approx(sum(d for _, d in by_code.values()), abs=2)
@@ -0,0 +1,53 @@
+import pytest
+
+import stock_check as sc
+
+# 証券コード → (Yahoo シンボル, 市場, 通貨, リンク先)
+CASES = [
+    ("7203", "7203.T", "JP", "JPY", "https://kabutan.jp/stock/?code=7203"),
+    ("1306", "1306.T", "JP", "JPY", "https://kabutan.jp/stock/?code=1306"),
+    ("507A", "507A.T", "JP", "JPY", "https://kabutan.jp/stock/?code=507A"),
+    ("130A", "130A.T", "JP", "JPY", "https://kabutan.jp/stock/?code=130A"),
+    ("AAPL", "AAPL", "US", "USD", "https://finance.yahoo.com/quote/AAPL"),
+    ("T", "T", "US", "USD", "https://finance.yahoo.com/quote/T"),
+    ("BRK.B", "BRK-B", "US", "USD", "https://finance.yahoo.com/quote/BRK-B"),
+    ("BF.A", "BF-A", "US", "USD", "https://finance.yahoo.com/quote/BF-A"),
+    ("0700.HK", "0700.HK", "HK", "HKD", "https://finance.yahoo.com/quote/0700.HK"),
+    ("600519.SS", "600519.SS", "CN", "CNY", "https://finance.yahoo.com/quote/600519.SS"),
+    ("2330.TW", "2330.TW", "TW", "TWD", "https://finance.yahoo.com/quote/2330.TW"),
+    ("BHP.AX", "BHP.AX", "AU", "AUD", "https://finance.yahoo.com/quote/BHP.AX"),
+    ("RY.TO", "RY.TO", "CA", "CAD", "https://finance.yahoo.com/quote/RY.TO"),
+    ("SAP.DE", "SAP.DE", "DE", "EUR", "https://finance.yahoo.com/quote/SAP.DE"),
+    ("MC.PA", "MC.PA", "FR", "EUR", "https://finance.yahoo.com/quote/MC.PA"),
+    ("9984.T", "9984.T", "JP", "JPY", "https://kabutan.jp/stock/?code=9984"),
+    ("VOD.L", "VOD.L", "GB", "GBp", "https://finance.yahoo.com/quote/VOD.L"),
+    ("BMW.F", "BMW.F", "DE", "EUR", "https://finance.yahoo.com/quote/BMW.F"),
+    ("ABC.V", "ABC.V", "CA", "CAD", "https://finance.yahoo.com/quote/ABC.V"),
+]
+
+@pytest.mark.parametrize("code, symbol, market, currency, link_url", CASES)
+def test_classify_codes(code, symbol, market, currency, link_url):
+    info = sc.classify_codes([code], overrides={})[code]
+    assert (info["symbol"], info["market"], info["currency"], info["link_url"]) == (symbol, market, currency, link_url)
+    assert info["is_us"] == (market == "US")
+
+def test_classify_codes_whole_column():
+    codes = [c[0] for c in CASES]
+    resolved = sc.classify_codes(codes + codes[:3], overrides={})
+    assert set(resolved) == set(codes)
+    assert {code: resolved[code]["symbol"] for code in codes} == {c[0]: c[1] for c in CASES}
+
+def test_overrides_take_precedence():
+    overrides = {"2800": {"symbol": "2800.HK", "market": "HK", "currency": "HKD"}}
+    info = sc.classify_codes(["2800"], overrides=overrides)["2800"]
+    assert (info["symbol"], info["market"], info["currency"]) == ("2800.HK", "HK", "HKD")
+    assert info["link_url"] == "https://finance.yahoo.com/quote/2800.HK"
+
+def test_resolve_tickers_caches_across_calls(monkeypatch):
+    sc.ticker_cache.clear()
+    calls = []
+    classify = sc.classify_codes
+    monkeypatch.setattr(sc, "classify_codes", lambda codes, overrides=None: calls.append(list(codes)) or classify(codes, overrides))
+    sc.resolve_tickers(["7203", "AAPL"])
+    sc.resolve_tickers(["7203", "AAPL", "BRK.B"])
+    assert calls == [["7203", "AAPL"], ["BRK.B"]]
@@ -0,0 +1,83 @@
+import pytest
+
+import stock_check as sc
+from fake_upstreams import FakeSheetServer, FakeYahoo, sample_holdings_csv, sample_realized_csv
+
+USERS = 50
+
+@pytest.fixture
+def user_sheets():
+    # 50 人が先頭から 5〜25 銘柄ずつ持つ（重なりが多く、全体では 25 銘柄）
+    sheets = {f"/u{i}.csv": sample_holdings_csv(5 + i % 21, seed=i) for i in range(USERS)}
+    sheets["/realized.csv"] = sample_realized_csv()
+    server = FakeSheetServer(sheets).start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def registry(tmp_path):
+    return sc.PortfolioRegistry(str(tmp_path / "users.json"))
+
+def test_fifty_users_share_one_quote_layer(user_sheets, registry, tmp_path, monkeypatch):
+    log = str(tmp_path / "yahoo.log")
+    yahoo = FakeYahoo(log_path=log)
+    monkeypatch.setattr(sc.yf, "download", yahoo.download)
+    monkeypatch.setattr(sc.yf, "Ticker", yahoo.ticker)
+    monkeypatch.setattr(sc, "quote_cache", sc.QuoteCache())
+    users = [registry.register(f"user{i}", f"ユーザー{i}", user_sheets.url(f"/u{i}.csv"), user_sheets.url("/realized.csv"))
+             for i in range(USERS)]
+    snapshots = [sc.build_snapshot(p) for p in users]
+
+    symbols = {r["symbol"] for s in snapshots for r in s["results"]}
+    assert len(symbols) == 25
+    downloads = FakeYahoo.read_log(log)
+    # 各銘柄と USDJPY を 1 回ずつだけ取得する（ユーザー数ぶん取り直さない）
+    assert downloads["download_symbols"] == len(symbols) + 1
+    assert downloads["download"] < USERS
+    assert user_sheets.stats["requests"] == 2 * USERS
+
+    # 配当カレンダーはユーザーごとに別々に持つ（他のユーザーの再構築で混ざらない）
+    alone = sc.build_snapshot(users[0])["dividend_calendar"]
+    sc.build_snapshot(users[1])
+    assert sc.build_snapshot(users[0])["dividend_calendar"] == alone
+    assert users[0].dividend_projector is not users[1].dividend_projector
+
+def test_registry_picks_up_other_workers_changes(user_sheets, tmp_path):
+    path = str(tmp_path / "users.json")
+    first, second = sc.PortfolioRegistry(path), sc.PortfolioRegistry(path)
+    first.register("alice", "Alice", user_sheets.url("/u1.csv"))
+    assert second.get("alice").name == "Alice"
+
+    kept = first.get("alice")
+    first.register("alice", "Alice 2", user_sheets.url("/u1.csv"))
+    assert second.get("alice").name == "Alice 2"
+    assert first.get("alice") is kept  # URL が同じなら手元のスナップショットを使い続ける
+
+    second.remove("alice")
+    assert first.get("alice") is None
+    # 古い一覧のまま保存して、削除されたユーザーを復活させない
+    first.register("bob", "Bob", user_sheets.url("/u2.csv"))
+    assert sorted(p.user_id for p in second.all()) == ["bob", sc.DEFAULT_USER]
+
+def test_broken_users_file_keeps_current_users(user_sheets, tmp_path):
+    path = tmp_path / "users.json"
+    registry = sc.PortfolioRegistry(str(path))
+    registry.register("alice", "Alice", user_sheets.url("/u1.csv"))
+    path.write_text("{broken")
+    assert registry.get("alice") is not None
+
+def test_removed_users_cookie_falls_back_to_default(sheets):
+    sc.portfolios.register("carol", "Carol", sheets.url("/holdings.csv"))
+    client = sc.app.test_client()
+    assert "portfolio=carol" in client.get("/api/fundamentals?user=carol").headers["Set-Cookie"]
+    sc.portfolios.remove("carol")
+
+    cookie = {"Cookie": f"{sc.USER_COOKIE}=carol"}
+    response = client.get("/api/fundamentals", headers=cookie)
+    assert response.status_code == 200
+    assert response.headers["Set-Cookie"].startswith(f"{sc.USER_COOKIE}=;")
+    with sc.app.test_request_context("/", headers=cookie):
+        assert sc.current_portfolio() is sc.portfolios.get(sc.DEFAULT_USER)
+    # ?user= で明示した時だけ 404（スナップショットを取る API でも 503 にしない）
+    assert client.get("/api/fundamentals?user=carol").status_code == 404
+    assert client.get("/api/dividends?user=carol").status_code == 404